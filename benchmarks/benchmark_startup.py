@@ -0,0 +1,59 @@
+"""
+Startup benchmark: measures the import time of the simulator modules, each in a fresh interpreter.
+Run from the repository root:
+    python benchmarks/benchmark_startup.py [--repeat 5] [--modules simulator.utils.llm_utils ...]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+DEFAULT_MODULES = [
+    'simulator',
+    'simulator.utils.file_reading',
+    'simulator.utils.llm_utils',
+    'simulator.simulator_executor',
+]
+
+IMPORT_SCRIPT = """
+import time
+start_time = time.perf_counter()
+import {module}
+print(time.perf_counter() - start_time)
+"""
+
+
+def measure_import_time(module: str, repeat: int) -> list[float]:
+    """
+    Import the module in `repeat` fresh interpreters
+    :return: The import times (in seconds)
+    """
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(module=module)], capture_output=True,
+                                text=True, check=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of the simulator modules.")
+    parser.add_argument('--repeat', type=int, default=5, help="The number of measures per module.")
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES, help="The modules to import.")
+    parser.add_argument('--output', type=str, default=None, help="A json file to write the results to.")
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.modules:
+        times = measure_import_time(module, args.repeat)
+        results[module] = {'median': statistics.median(times), 'min': min(times), 'max': max(times)}
+        print(f"{module:<40} median {results[module]['median']:.3f}s  "
+              f"(min {results[module]['min']:.3f}s, max {results[module]['max']:.3f}s)")
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -42,4 +42,5 @@ get_reservation_details = StructuredTool.from_function(
         func=GetReservationDetails.invoke,
         name=get_reservation_details_schema['function']["name"],
         description=get_reservation_details_schema['function']["description"],
+        metadata={"read_only": True},
     )
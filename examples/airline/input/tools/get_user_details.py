@@ -37,4 +37,5 @@ get_user_details = StructuredTool.from_function(
         func=GetUserDetails.invoke,
         name=get_user_details_schema['function']["name"],
         description=get_user_details_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
@@ -73,4 +73,5 @@ list_all_airports = StructuredTool.from_function(
         func=ListAllAirports.invoke,
         name=list_all_airports_schema['function']["name"],
         description=list_all_airports_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
@@ -77,4 +77,5 @@ search_one_stop = StructuredTool.from_function(
         func=SearchOnestopFlight.invoke,
         name=search_one_stop_schema['function']["name"],
         description=search_one_stop_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
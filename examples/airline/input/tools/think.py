@@ -33,4 +33,5 @@ think = StructuredTool.from_function(
         func=Think.invoke,
         name=think_schema['function']["name"],
         description=think_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
@@ -40,4 +40,5 @@ calculate = StructuredTool.from_function(
         func=Calculate.invoke,
         name=calculate_schema['function']["name"],
         description=calculate_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
@@ -39,4 +39,5 @@ find_user_id_by_email = StructuredTool.from_function(
         func=FindUserIdByEmail.invoke,
         name=find_user_id_by_email_schema['function']["name"],
         description=find_user_id_by_email_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
@@ -54,4 +54,5 @@ find_user_id_by_name_zip = StructuredTool.from_function(
         func=FindUserIdByNameZip.invoke,
         name=find_user_id_by_name_zip_schema['function']["name"],
         description=find_user_id_by_name_zip_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
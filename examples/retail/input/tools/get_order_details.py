@@ -38,4 +38,5 @@ get_order_details = StructuredTool.from_function(
         func=GetOrderDetails.invoke,
         name=get_order_details_schema['function']["name"],
         description=get_order_details_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
@@ -37,4 +37,5 @@ get_product_details = StructuredTool.from_function(
         func=GetProductDetails.invoke,
         name=get_product_details_schema['function']["name"],
         description=get_product_details_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
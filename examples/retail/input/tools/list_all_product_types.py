@@ -33,4 +33,5 @@ list_all_product_types = StructuredTool.from_function(
         func=ListAllProductTypes.invoke,
         name=list_all_product_types_schema['function']["name"],
         description=list_all_product_types_schema['function']["description"],
+        metadata={"read_only": True},
     )
\ No newline at end of file
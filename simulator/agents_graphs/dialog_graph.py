@@ -2,15 +2,23 @@ from langchain_core.runnables.base import Runnable
 from typing import Callable
 from langgraph.graph import END
 from typing import Annotated
+import operator
 from langgraph.graph import StateGraph, START
 from typing_extensions import TypedDict
 from typing import Optional
-import time
 from langgraph.graph.message import add_messages
 from langchain_core.messages.base import BaseMessage
 from langchain_core.messages import HumanMessage, AIMessage
-from simulator.utils.llm_utils import convert_messages_to_str
+from simulator.utils.llm_utils import convert_message_to_str
+from langgraph.utils.runnable import RunnableCallable, RunnableConfig
+from langgraph.errors import GraphRecursionError
+from simulator.utils.logger_config import get_logger, ConsoleColor
+import asyncio
 import json
+import time
+
+# The stop signal of the dialogs that exceeded their budget (turns, time, tokens or critique retries)
+BUDGET_EXHAUSTED = '###STOP BUDGET_EXHAUSTED'
 
 
 class DialogState(TypedDict):
@@ -21,6 +29,82 @@ class DialogState(TypedDict):
     user_thoughts: Optional[list]
     critique_feedback: Optional[str]
     stop_signal: Optional[str]
+    # The rendered conversation of chatbot_messages (without and with the tool calls), appended with the new messages
+    transcript: Annotated[str, operator.add]
+    transcript_with_tools: Annotated[str, operator.add]
+    num_turns: Annotated[int, operator.add]  # The number of user messages
+    num_critiques: Annotated[int, operator.add]
+    budget_exhausted: Optional[str]  # The exhausted budget of a dialog ended by BUDGET_EXHAUSTED
+
+
+class DialogBudget:
+    """
+    The budget of a dialog: the number of user turns, the running time, the tokens and the critique retries. A dialog
+    that exceeds its budget ends with the BUDGET_EXHAUSTED stop signal and keeps the conversation so far.
+    """
+
+    def __init__(self, max_turns: Optional[int] = None, max_time: Optional[float] = None,
+                 max_tokens: Optional[int] = None, max_critique_retries: Optional[int] = 2):
+        """
+        :param max_turns: The maximal number of user messages, None for no limit
+        :param max_time: The maximal running time of the dialog (in seconds), None for no limit
+        :param max_tokens: The maximal number of tokens of the dialog llm calls, None for no limit
+        :param max_critique_retries: The maximal number of user responses rejected by the critique, None for no limit
+        """
+        self.max_turns = max_turns
+        self.max_time = max_time
+        self.max_tokens = max_tokens
+        self.max_critique_retries = max_critique_retries
+
+    @classmethod
+    def from_config(cls, config: Optional[dict] = None, timeout: Optional[float] = None) -> 'DialogBudget':
+        """
+        :param config: The dialog budget config (max_turns, max_time, max_tokens and max_critique_retries)
+        :param timeout: The timeout of the dialog task, the default time budget ends the dialog before it
+        """
+        config = config or {}
+        max_time = config.get('max_time', None)
+        if max_time is None and timeout is not None:
+            max_time = 0.9 * timeout
+        return cls(max_turns=config.get('max_turns', None), max_time=max_time,
+                   max_tokens=config.get('max_tokens', None),
+                   max_critique_retries=config.get('max_critique_retries', 2))
+
+    def get_config(self, config: Optional[RunnableConfig] = None) -> RunnableConfig:
+        """
+        The graph config of a dialog run, with the start time and the tokens counter of the dialog
+        """
+        config = dict(config or {})
+        configurable = dict(config.get('configurable', None) or {}, dialog_start=time.monotonic())
+        if self.max_tokens is not None:
+            from simulator.utils.usage_callbacks import UsageCallbackHandler
+            # The nested llm calls of the nodes inherit the callbacks of the graph
+            configurable['dialog_usage'] = UsageCallbackHandler()
+            config['callbacks'] = list(config.get('callbacks', None) or []) + [configurable['dialog_usage']]
+        config['configurable'] = configurable
+        return config
+
+    def get_exhausted(self, state: DialogState, config: Optional[RunnableConfig], next_step: str) -> Optional[str]:
+        """
+        :param state: The dialog state
+        :param config: The graph config (see get_config)
+        :param next_step: The next node of the dialog
+        :return: The exhausted budget ('critique_retries', 'turns', 'time' or 'tokens'), None if the dialog may
+        continue
+        """
+        configurable = (config or {}).get('configurable', None) or {}
+        if next_step == 'user' and self.max_critique_retries is not None and \
+                state.get('num_critiques', 0) > self.max_critique_retries:
+            return 'critique_retries'
+        if next_step == 'chatbot' and self.max_turns is not None and state.get('num_turns', 0) >= self.max_turns:
+            return 'turns'
+        if self.max_time is not None and 'dialog_start' in configurable and \
+                time.monotonic() - configurable['dialog_start'] >= self.max_time:
+            return 'time'
+        if self.max_tokens is not None and 'dialog_usage' in configurable and \
+                configurable['dialog_usage'].total_tokens >= self.max_tokens:
+            return 'tokens'
+        return None
 
 
 class Dialog:
@@ -29,7 +113,7 @@ class Dialog:
     """
 
     def __init__(self, user: Runnable, chatbot: Runnable, critique: Runnable, intermediate_processing: Callable = None,
-                 memory=None):
+                 memory=None, budget: DialogBudget = None):
         """
         Initialize the event generator.]
         :param user (Runnable): The user model
@@ -38,17 +122,22 @@ class Dialog:
         chatbot at each step
         :param critique (Runnable): The critique mode, should determine if the final decision of the user is correct
         :param memory (optional): The memory to store the conversations artifacts
+        :param budget (optional): The budget of each dialog, the default budget only bounds the critique retries
         """
         self.user = user
         self.chatbot = chatbot
         self.critique = critique
         self.intermediate_processing = intermediate_processing  # TODO: Add default function
         self.memory = memory
+        self.budget = budget if budget is not None else DialogBudget()
         self.compile_graph()
 
     def get_end_condition(self):
-        def should_end(state: DialogState):
+        def should_end(state: DialogState, config: RunnableConfig):
             terminate = self.intermediate_processing(state)
+            # A finished dialog is never cut, the budget is checked before continuing the dialog
+            if terminate in ('chatbot', 'user') and self.budget.get_exhausted(state, config, terminate) is not None:
+                return 'budget_end'
             if terminate == 'END':
                 return END
             else:
@@ -61,6 +150,14 @@ class Dialog:
             messages = [state["user_messages"][0]] + set_user_message(state)
             # Call the simulated user
             response = self.user.invoke(messages)
+            return process_user_response(state, response)
+
+        async def asimulated_user_node(state):
+            messages = [state["user_messages"][0]] + set_user_message(state)
+            response = await self.user.ainvoke(messages)
+            return process_user_response(state, response)
+
+        def process_user_response(state, response):
             # This response is an AI message - we need to flip this to be a human message
             user_thoughts = state['user_thoughts']
             if self.memory is not None:
@@ -69,38 +166,56 @@ class Dialog:
                     user_thoughts.append(response['thought'])
                 self.memory.insert_dialog(state['thread_id'], 'Human', response['response'])
 
-            result_state = {'user_thoughts': user_thoughts, 'critique_feedback': '', 'stop_signal': ''}
+            result_state = {'user_thoughts': user_thoughts, 'critique_feedback': '', 'stop_signal': '',
+                            'num_turns': 1}
             if '###STOP' in response['response']:
                 result_state['stop_signal'] = response['response']
             else:
-                result_state.update({"chatbot_messages": [HumanMessage(content=response['response'])],
-                                     'user_messages': [AIMessage(content=response['response'])]})
+                new_messages = [HumanMessage(content=response['response'])]
+                result_state.update({"chatbot_messages": new_messages,
+                                     'user_messages': [AIMessage(content=response['response'])],
+                                     **render_transcript(new_messages)})
             return result_state
 
-        return simulated_user_node
+        return RunnableCallable(simulated_user_node, asimulated_user_node)
 
     def get_critique_node(self):
-        def critique_node(state):
-            # Call the simulated user
+        def get_critique_input(state):
             if 'Thought:' in state['user_thoughts'][-1]:
                 user_thought = state['user_thoughts'][-1].split('Thought:')[1]
             else:
                 user_thought = state['user_thoughts'][-1]
-            conversation = convert_messages_to_str(state['chatbot_messages'], True)
+            conversation = state['transcript_with_tools']
             if '###STOP FAILURE' in state['chatbot_messages'][-1].content:
                 judgement = f"The chatbot failed to adhere the policies\n Reason:{user_thought}"
             else:
                 judgement = f"The chatbot adhered to the policies\n Reason:{user_thought}"
-            response = self.critique.invoke({'reason': judgement, 'conversation': conversation})
-            return {"critique_feedback": response.content}
+            return {'reason': judgement, 'conversation': conversation}
 
-        return critique_node
+        def critique_node(state):
+            # Call the critique
+            response = self.critique.invoke(get_critique_input(state))
+            return {"critique_feedback": response.content, 'num_critiques': 1}
+
+        async def acritique_node(state):
+            response = await self.critique.ainvoke(get_critique_input(state))
+            return {"critique_feedback": response.content, 'num_critiques': 1}
+
+        return RunnableCallable(critique_node, acritique_node)
 
     def get_chatbot_node(self):
         def chat_bot_node(state):
             messages = state["chatbot_messages"]
             # Call the chatbot
             response = self.chatbot.invoke({'messages': messages, 'args': state['chatbot_args']})
+            return process_chatbot_response(state, response)
+
+        async def achat_bot_node(state):
+            response = await self.chatbot.ainvoke({'messages': state["chatbot_messages"],
+                                                   'args': state['chatbot_args']})
+            return process_chatbot_response(state, response)
+
+        def process_chatbot_response(state, response):
             last_human_message = max([i for i, v in enumerate(response['messages']) if v.type == 'human'])
             all_tool_calls = {}
             if self.memory is not None:
@@ -113,46 +228,127 @@ class Dialog:
                         all_tool_calls[message.tool_call_id]['output'] = message.content
                 for v in all_tool_calls.values():
                     self.memory.insert_tool(state['thread_id'], v['name'], json.dumps(v['args']), v['output'])
-                    time.sleep(0.001)
                 # inserting the chatbot messages into memory
                 self.memory.insert_dialog(state['thread_id'], 'AI', response['messages'][-1].content)
-            return {"chatbot_messages": response['messages'][last_human_message+1:],
-                    'user_messages': [HumanMessage(content=response['messages'][-1].content)]}
+            new_messages = response['messages'][last_human_message + 1:]
+            return {"chatbot_messages": new_messages,
+                    'user_messages': [HumanMessage(content=response['messages'][-1].content)],
+                    **render_transcript(new_messages)}
+
+        return RunnableCallable(chat_bot_node, achat_bot_node)
 
-        return chat_bot_node
+    def get_budget_node(self):
+        def budget_exhausted_node(state: DialogState, config: RunnableConfig):
+            exhausted = self.budget.get_exhausted(state, config, self.intermediate_processing(state))
+            return self.end_dialog(state, exhausted)
+
+        return budget_exhausted_node
+
+    def end_dialog(self, state: DialogState, exhausted: str) -> dict:
+        """
+        End a dialog that exceeded its budget
+        :param state: The dialog state
+        :param exhausted: The exhausted budget
+        :return: The state update
+        """
+        if self.memory is not None:
+            self.memory.insert_dialog(state['thread_id'], 'Human', BUDGET_EXHAUSTED)
+        return {'stop_signal': BUDGET_EXHAUSTED, 'budget_exhausted': exhausted}
+
+    def salvage(self, state: Optional[dict], exhausted: str, error: Exception) -> dict:
+        """
+        The partial result of a dialog interrupted by the recursion limit or its time budget
+        :param state: The last state of the dialog
+        :param exhausted: The exhausted budget
+        :param error: The interruption error, raised if the user did not respond yet (nothing to salvage)
+        :return: The dialog result, ended by BUDGET_EXHAUSTED
+        """
+        if state is None or not state.get('num_turns', 0) or not state.get('user_thoughts', None):
+            raise error
+        get_logger().warning(f"{ConsoleColor.YELLOW}The dialog {state['thread_id']} exceeded its {exhausted} budget "
+                             f"after {state['num_turns']} turns, keeping the partial dialog{ConsoleColor.RESET}")
+        return dict(state, **self.end_dialog(state, exhausted))
 
     def compile_graph(self):
         workflow = StateGraph(DialogState)
         workflow.add_node("user", self.get_user_node())
         workflow.add_node("chatbot", self.get_chatbot_node())
         workflow.add_node("end_critique", self.get_critique_node())
+        workflow.add_node("budget_end", self.get_budget_node())
         workflow.add_edge(START, "user")
         workflow.add_conditional_edges(
             "user",
             self.get_end_condition(),
-            ["chatbot", "end_critique"],
+            ["chatbot", "end_critique", "budget_end"],
         )
         workflow.add_conditional_edges(
             "end_critique",
             self.get_end_condition(),
-            ["user", END],
+            ["user", END, "budget_end"],
         )
         workflow.add_edge("chatbot", "user")
+        workflow.add_edge("budget_end", END)
         self.graph = workflow.compile()
 
     def invoke(self, **kwargs):
         """
-        Invoke the agent with the messages
+        Invoke the agent with the messages, a dialog that reaches the recursion limit returns its partial result
         :return:
         """
-        return self.graph.invoke(**kwargs)
+        kwargs = with_initial_transcript(kwargs)
+        kwargs['config'] = self.budget.get_config(kwargs.get('config', None))
+        state = None
+        try:
+            for state in self.graph.stream(stream_mode='values', **kwargs):
+                pass
+        except GraphRecursionError as e:
+            return self.salvage(state, 'recursion_limit', e)
+        return state
 
-    def ainvoke(self, **kwargs):
+    async def ainvoke(self, **kwargs):
         """
-        async Invoke the agent with the messages
+        async Invoke the agent with the messages, a dialog that reaches the recursion limit or its time budget returns
+        its partial result
         :return:
         """
-        return self.graph.ainvoke(**kwargs)
+        kwargs = with_initial_transcript(kwargs)
+        kwargs['config'] = self.budget.get_config(kwargs.get('config', None))
+        state = None
+
+        async def run_dialog():
+            nonlocal state
+            async for state in self.graph.astream(stream_mode='values', **kwargs):
+                pass
+
+        try:
+            # The time budget is also checked between the nodes, the deadline interrupts a slow node
+            await asyncio.wait_for(run_dialog(), timeout=self.budget.max_time)
+        except GraphRecursionError as e:
+            return self.salvage(state, 'recursion_limit', e)
+        except asyncio.TimeoutError as e:
+            if self.budget.max_time is None or \
+                    time.monotonic() - kwargs['config']['configurable']['dialog_start'] < self.budget.max_time:
+                raise  # Not the dialog deadline
+            return self.salvage(state, 'time', e)
+        return state
+
+
+def render_transcript(messages: list[BaseMessage]) -> dict:
+    """
+    Render the new chatbot messages, as the update of the state transcripts
+    """
+    return {'transcript': ''.join(convert_message_to_str(msg) for msg in messages),
+            'transcript_with_tools': ''.join(convert_message_to_str(msg, True) for msg in messages)}
+
+
+def with_initial_transcript(kwargs: dict) -> dict:
+    """
+    Add the transcripts of the initial chatbot messages to the graph input
+    """
+    graph_input = kwargs.get('input', None)
+    if isinstance(graph_input, dict) and 'transcript' not in graph_input:
+        kwargs = dict(kwargs, input=dict(graph_input, **render_transcript(graph_input.get('chatbot_messages', []))))
+    return kwargs
 
 
 def set_user_message(state: DialogState) -> list[BaseMessage]:
@@ -161,7 +357,7 @@ def set_user_message(state: DialogState) -> list[BaseMessage]:
     :param state: The current state
     :return: The AI message
     """
-    conversation = convert_messages_to_str(state['chatbot_messages'])
+    conversation = state['transcript']
     text = f"You are provided with the conversation between the user and the chatbot.\n# Conversation:\n{conversation}"
     messages_list = [HumanMessage(content=text)]
     critique_feedback = state.get('critique_feedback', '')
@@ -9,8 +9,11 @@ from langgraph.utils.runnable import RunnableCallable, RunnableConfig
 from langchain_core.runnables.base import Runnable
 from langgraph.graph.message import add_messages
 from simulator.utils.llm_utils import convert_to_anthropic_tools, convert_to_oci_schema
-import inspect
+from simulator.utils.rate_limiter import with_rate_limit
+import asyncio
 import copy
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.runnables.utils import Input, Output
 
 from langchain_core.messages import (
@@ -47,27 +50,87 @@ class MessagesState(TypedDict):
 
 
 class ToolNode(RunnableCallable):
+    """
+    Runs the tool calls of the last model message. The consecutive calls of read-only tools (declared with
+    metadata={'read_only': True}) run concurrently, the other calls run alone and in order, so the calls that modify
+    the environment data never overlap.
+    """
+
     def __init__(self, tools: Sequence[Union[BaseTool, Callable]]):
-        super().__init__(self._func)
+        super().__init__(self._func, self._afunc)
         self.tools_by_name = {tool.name: tool for tool in tools}
+        # The tool signatures are computed once, to select the environment arguments of each call
+        self.tool_args = {tool.name: set(inspect.signature(getattr(tool, 'func', None) or tool.coroutine).parameters)
+                          for tool in tools}
+        self.read_only = {tool.name for tool in tools if (tool.metadata or {}).get('read_only', False)}
+
+    def get_function_args(self, tool_call: ToolCall, state: MessagesState) -> dict:
+        """
+        The arguments of a tool call, completed with the matching environment arguments of the state.
+        The arguments of the tools that may write are deep copied, so the tool cannot alter the tool call of the
+        dialog state (e.g. by storing an argument list and appending to it later)
+        """
+        tool_args = self.tool_args[tool_call["name"]]
+        if tool_call["name"] in self.read_only:
+            function_args = dict(tool_call["args"])
+        else:
+            function_args = copy.deepcopy(tool_call["args"])
+        if state['args'] is not None:
+            function_args.update({k: v for k, v in state['args'].items()
+                                  if (k in tool_args) and (k not in function_args)})
+        return function_args
+
+    def get_call_groups(self, tool_calls: list[ToolCall]) -> list[list[ToolCall]]:
+        """
+        Split the tool calls into the groups that run concurrently: the consecutive read-only calls, and each of the
+        other calls alone
+        """
+        groups = []
+        for tool_call in tool_calls:
+            if tool_call["name"] in self.read_only and groups and groups[-1][0]["name"] in self.read_only:
+                groups[-1].append(tool_call)
+            else:
+                groups.append([tool_call])
+        return groups
+
+    def call_tool(self, tool_call: ToolCall, state: MessagesState) -> ToolMessage:
+        tool = self.tools_by_name[tool_call["name"]]
+        observation = tool.func(**self.get_function_args(tool_call, state))
+        return ToolMessage(content=observation, tool_call_id=tool_call["id"])
+
+    async def acall_tool(self, tool_call: ToolCall, state: MessagesState) -> ToolMessage:
+        tool = self.tools_by_name[tool_call["name"]]
+        function_args = self.get_function_args(tool_call, state)
+        if getattr(tool, 'coroutine', None) is not None:
+            observation = await tool.coroutine(**function_args)
+        else:
+            # The sync tools run on a worker thread, so they do not block the other dialogs
+            observation = await asyncio.to_thread(tool.func, **function_args)
+        return ToolMessage(content=observation, tool_call_id=tool_call["id"])
 
     def _func(self, state: MessagesState):
         result = []
-        for tool_call in state["messages"][-1].tool_calls:
-            tool = self.tools_by_name[tool_call["name"]]
-            all_tool_args = list(inspect.signature(tool.func).parameters)
-            function_args = copy.deepcopy(tool_call["args"])
-            if state['args'] is not None:
-                function_args.update({k: v for k, v in state['args'].items()
-                                      if (k in all_tool_args) and (k not in function_args)})
-            observation = tool.func(**function_args)
-            result.append(ToolMessage(content=observation, tool_call_id=tool_call["id"]))
+        for group in self.get_call_groups(state["messages"][-1].tool_calls):
+            if len(group) == 1:
+                result.append(self.call_tool(group[0], state))
+                continue
+            with ThreadPoolExecutor(max_workers=len(group)) as executor:
+                result.extend(executor.map(lambda tool_call: self.call_tool(tool_call, state), group))
+        return {"messages": result, 'args': state['args']}
+
+    async def _afunc(self, state: MessagesState):
+        result = []
+        for group in self.get_call_groups(state["messages"][-1].tool_calls):
+            result.extend(await asyncio.gather(*[self.acall_tool(tool_call, state) for tool_call in group]))
         return {"messages": result, 'args': state['args']}
 
     def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any):
         result = self._func(input)
         return result
 
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any):
+        return await self._afunc(input)
+
 
 # Define the function that determines whether to continue or not
 def should_continue(state: MessagesState):
@@ -105,6 +168,7 @@ class AgentTools(Runnable):
                 oci_schema = convert_to_oci_schema(tools_schema)
                 tools_schema = [llm._provider.convert_to_oci_tool(t) for t in oci_schema]
             self.llm = llm.bind(tools=tools_schema)
+        self.llm = with_rate_limit(llm, self.llm)
         self.tools = tools
         self.checkpointer = None
         self.store = store
@@ -122,7 +186,11 @@ class AgentTools(Runnable):
             # We return a list, because this will get added to the existing list
             return {"messages": [response]}
 
-        return call_model
+        async def acall_model(state: MessagesState):
+            response = await self.llm.ainvoke(state['messages'])
+            return {"messages": [response]}
+
+        return RunnableCallable(call_model, acall_model)
 
     def compile_agent(self):
         # Define a graph and compile it
@@ -157,3 +225,10 @@ class AgentTools(Runnable):
         :param config: The configuration for the agent
         """
         return self.graph.invoke(input=input, config=config)
+
+    async def ainvoke(self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Output:
+        """Invoke the agent with the messages, the llm calls are awaited and the sync tools run on worker threads
+        :param input: The input for the graph, should be a dictionary {'messages': messages, 'args': additional_args}
+        :param config: The configuration for the agent
+        """
+        return await self.graph.ainvoke(input=input, config=config)
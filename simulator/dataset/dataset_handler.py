@@ -7,6 +7,7 @@ import pickle
 from typing import List, Tuple
 from statistics import mean, stdev
 from simulator.healthcare_analytics import GenerateDatasetEvent, track_event
+from simulator.utils.budget import CostBudget
 
 
 class Dataset:
@@ -91,14 +92,22 @@ class Dataset:
         logger.info(f'{ConsoleColor.CYAN}Start building the dataset{ConsoleColor.RESET}')
         dataset_generation_cost = 0
         initial_n_iterations = iteration_num
+        # The budget is enforced in real time: no task is started above the cost limit, and the running tasks are
+        # cancelled above the hard cost limit
+        budget = CostBudget(soft_limit=self.config['cost_limit'],
+                            hard_limit=self.config.get('hard_cost_limit', self.config['cost_limit']),
+                            spent=dataset_cost)
         while n_samples > 0 and iteration_num < self.max_iterations:
-            if dataset_cost > self.config['cost_limit']:
+            if budget.soft_exceeded():
                 logger.warning(f"{ConsoleColor.RED}Cost is over the limit, stopping the generation. "
                                f"Increase the limit in the config file to generate more samples.{ConsoleColor.RESET}")
                 return
             logger.info(f'{ConsoleColor.WHITE}Iteration {iteration_num} started{ConsoleColor.RESET}')
             cur_iteration_sample_size = min(self.config['mini_batch_size'], n_samples)
-            events, minibatch_cost = self.generate_mini_batch(cur_iteration_sample_size)
+            with budget.activate():
+                events, _ = self.generate_mini_batch(cur_iteration_sample_size)
+            # The mini-batch cost is read from the budget, which also accounts for the failed and cancelled tasks
+            minibatch_cost = budget.spent - dataset_cost
             dataset_cost += minibatch_cost
             dataset_generation_cost += minibatch_cost
             for i, e in enumerate(events):
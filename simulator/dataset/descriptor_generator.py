@@ -1,7 +1,8 @@
 from typing import List
 from pydantic import BaseModel, Field
 from simulator.utils.llm_utils import set_llm_chain, set_callback
-from simulator.utils.parallelism import batch_invoke, async_batch_invoke
+from simulator.utils.hedging import with_hedging
+from simulator.utils.parallelism import batch_invoke, async_batch_invoke, async_batch_stream, RetryPolicy
 from typing import Tuple
 from simulator.utils.llm_utils import get_llm
 import networkx as nx
@@ -80,8 +81,10 @@ class DescriptionGenerator:
         self.prompt = environment.prompt
         self.task_description = environment.get_task_description()
         llm = get_llm(self.config['llm_description'])
-        self.llm_description = set_llm_chain(llm, structure=EventDescription,
+        self.llm_description = set_llm_chain(llm, structure=EventDescription, static_variables=['task_description'],
                                              **self.config['description_config']['prompt'])
+        self.llm_description = with_hedging(self.llm_description, self.config['description_config'].get('hedge'),
+                                            stage='descriptions')
         if self.config['refinement_config']['do_refinement']:
             llm = get_llm(self.config['llm_refinement'])
             self.feedback_chain = set_llm_chain(llm, **self.config['refinement_config']['prompt_feedback'])
@@ -115,7 +118,7 @@ class DescriptionGenerator:
         flow_extractor = set_llm_chain(llm, structure=FlowsList, **self.config['flow_config']['prompt'])
         result = batch_invoke(flow_extractor.invoke,
                               [{'user_prompt': self.prompt}], num_workers=1,
-                              callbacks=[set_callback(self.config['llm_policy']['type'])])[0]
+                              callbacks=[set_callback(self.config['llm_policy']['type'])], stage='flows')[0]
         self.total_cost += result['usage']
         flows = result['result']
         error_message = result['error']
@@ -138,7 +141,9 @@ class DescriptionGenerator:
             batch.append({'user_prompt': self.prompt, 'flow': flow})
         res = batch_invoke(policy_extractor.invoke, batch,
                            num_workers=self.config['policies_config']['num_workers'],
-                           callbacks=[set_callback(self.config['llm_policy']['type'])])
+                           callbacks=[set_callback(self.config['llm_policy']['type'])],
+                           retry_policy=RetryPolicy.from_config(self.config['policies_config'].get('retry')),
+                           stage='policies')
         extract_policies_cost = 0
         batch_error_message = None
         n_policies_per_flow = []
@@ -178,6 +183,7 @@ class DescriptionGenerator:
             return f"Flow: {policy['flow']}\npolicy: {policy['policy']}"
 
         edge_llm = set_llm_chain(llm, structure=Rank, **self.config['edge_config']['prompt'])
+        edge_llm = with_hedging(edge_llm, self.config['edge_config'].get('hedge'), stage='edges')
         callback = set_callback(self.config['llm_edge']['type'])
         samples_batch = []
         policies_list = []
@@ -192,9 +198,11 @@ class DescriptionGenerator:
                                       'ind2': j + i + 1})
         self.graph_info['nodes'] = policies_list
         num_workers = self.config['edge_config'].get('num_workers', 1)
+        max_workers = self.config['edge_config'].get('max_workers', num_workers)
         timeout = self.config['edge_config'].get('timeout', 10)
         res = async_batch_invoke(edge_llm.ainvoke, samples_batch, num_workers=num_workers,
-                                 callbacks=[callback], timeout=timeout)
+                                 callbacks=[callback], timeout=timeout, max_workers=max_workers, stage='edges',
+                                 retry_policy=RetryPolicy.from_config(self.config['edge_config'].get('retry')))
         all_edges = []
         graph_creation_cost = 0
         batch_error_message = None
@@ -274,21 +282,23 @@ class DescriptionGenerator:
             samples_batch.append({'task_description': self.task_description,
                                   'policies': policies_list_to_str(policies)})
         num_workers = self.config['description_config'].get('num_workers', 1)
+        max_workers = self.config['description_config'].get('max_workers', num_workers)
         timeout = self.config['description_config'].get('timeout', 10)
+        retry_policy = RetryPolicy.from_config(self.config['description_config'].get('retry'))
         callback = set_callback(self.config['llm_description']['type'])
-        res = async_batch_invoke(self.llm_description.ainvoke, samples_batch, num_workers=num_workers,
-                                 callbacks=[callback], timeout=timeout)
-        for result in res:
+        descriptions = []
+        # The descriptions are built as the samples complete, in the samples order so the event ids are reproducible
+        for result in async_batch_stream(self.llm_description.ainvoke, samples_batch, num_workers=num_workers,
+                                         callbacks=[callback], timeout=timeout, max_workers=max_workers,
+                                         stage='descriptions', retry_policy=retry_policy, ordered=True):
             if result['error'] is not None:
                 continue
             cost += result['usage']
-            all_policies[result['index']]['description'] = result['result'].event_description
-            all_policies[result['index']]['expected_behaviour'] = result['result'].expected_behaviour
-        all_policies = [policy for policy in all_policies if 'description' in policy]
-        descriptions = [Description(event_description=policy['description'],
-                                    expected_behaviour=policy['expected_behaviour'],
-                                    policies=policy['policies'],
-                                    challenge_level=policy['path_sum']) for policy in all_policies]
+            policy = all_policies[result['index']]
+            descriptions.append(Description(event_description=result['result'].event_description,
+                                            expected_behaviour=result['result'].expected_behaviour,
+                                            policies=policy['policies'],
+                                            challenge_level=policy['path_sum']))
         refinement_cost = 0
         if self.config['refinement_config']['do_refinement']:
             descriptions, refinement_cost = self.expected_behaviour_refinement(descriptions)
@@ -305,7 +315,9 @@ class DescriptionGenerator:
         """
         iteration_indices = list(range(len(descriptions)))
         num_workers = self.config['refinement_config'].get('num_workers', 5)
+        max_workers = self.config['refinement_config'].get('max_workers', num_workers)
         timeout = self.config['refinement_config'].get('timeout', 10)
+        retry_policy = RetryPolicy.from_config(self.config['refinement_config'].get('retry'))
         callback = set_callback(self.config['llm_refinement']['type'])
         cost = 0
 
@@ -317,7 +329,8 @@ class DescriptionGenerator:
                                     'behaviour': descriptions[ind].expected_behaviour,
                                     'prompt': self.prompt})
             res = async_batch_invoke(self.feedback_chain.ainvoke, batch_input, num_workers=num_workers,
-                                     callbacks=[callback], timeout=timeout)
+                                     callbacks=[callback], timeout=timeout, max_workers=max_workers,
+                                     stage='refinement_feedback', retry_policy=retry_policy)
             cur_refine_indices = []
             improved_batch = []
             # refine the behaviour
@@ -332,7 +345,8 @@ class DescriptionGenerator:
                     cost += result['usage']
 
             res = async_batch_invoke(self.refinement_chain.ainvoke, improved_batch, num_workers=num_workers,
-                                     callbacks=[callback], timeout=timeout)
+                                     callbacks=[callback], timeout=timeout, max_workers=max_workers,
+                                     stage='refinement', retry_policy=retry_policy)
             for j, result in enumerate(res):
                 if result['error'] is not None or 'None' in result['result'].content:
                     continue
@@ -356,8 +370,10 @@ class DescriptionGenerator:
     def __setstate__(self, state):
         self.__dict__.update(state)
         llm = get_llm(self.config['llm_description'])
-        self.llm_description = set_llm_chain(llm, structure=EventDescription,
+        self.llm_description = set_llm_chain(llm, structure=EventDescription, static_variables=['task_description'],
                                              **self.config['description_config']['prompt'])
+        self.llm_description = with_hedging(self.llm_description, self.config['description_config'].get('hedge'),
+                                            stage='descriptions')
         if self.config['refinement_config']['do_refinement']:
             llm = get_llm(self.config['llm_refinement'])
             self.feedback_chain = set_llm_chain(llm, **self.config['refinement_config']['prompt_feedback'])
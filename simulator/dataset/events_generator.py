@@ -1,19 +1,22 @@
 from simulator.agents_graphs.langgraph_tool import AgentTools
 from simulator.agents_graphs.event_graph import EventGraph
 import json
-from langchain import hub
+from simulator.utils.prompt_cache import pull_prompt
 from simulator.env import Env
 from typing_extensions import Annotated
 from langgraph.prebuilt import InjectedState
 from langchain_core.tools.structured import StructuredTool
 from simulator.dataset.definitions import *
 from simulator.utils.llm_utils import dict_to_str, set_llm_chain
+from simulator.utils.hedging import with_hedging
 from simulator.utils.llm_utils import get_llm, set_callback
 from simulator.dataset.descriptor_generator import Description
-from simulator.utils.parallelism import async_batch_invoke
+from simulator.utils.parallelism import async_batch_invoke, async_batch_stream, RetryPolicy
 from typing import Tuple
 from simulator.healthcare_analytics import ExceptionEvent, track_event
 
+PLANNER_PROMPT_HUB_NAME = "eladlev/planner_event_generator"
+
 
 class EventsGenerator:
     """
@@ -35,6 +38,8 @@ class EventsGenerator:
         self.init_agent()
         self.llm_symbolic = set_llm_chain(self.llm, **config['symbolic_enrichment_config']['prompt'],
                                           structure=info_symbolic)
+        self.llm_symbolic = with_hedging(self.llm_symbolic, config['symbolic_enrichment_config'].get('hedge'),
+                                         stage='symbolic')
         self.llm_constraints = set_llm_chain(self.llm, **config['symbolic_constraints_config']['prompt'])
 
     def init_executors(self) -> dict[AgentTools]:
@@ -55,7 +60,7 @@ class EventsGenerator:
                 infer_schema=True,
             )
 
-            system_messages = hub.pull(self.config['event_graph']['prompt_executors']['prompt_hub_name'])
+            system_messages = pull_prompt(self.config['event_graph']['prompt_executors']['prompt_hub_name'])
             system_messages = system_messages.partial(schema=self.env.data_schema[table_name],
                                                       example=json.dumps(rows_data[table_name]))
             agent_executor = AgentTools(llm=self.llm, tools=[think, table_insertion_tools[table_name]],
@@ -84,7 +89,7 @@ class EventsGenerator:
         return tool_function, add_row_input
 
     def get_planner_prompt(self):
-        prompt = hub.pull("eladlev/planner_event_generator")
+        prompt = pull_prompt(PLANNER_PROMPT_HUB_NAME)
         return prompt.partial(tables_info=dict_to_str(self.env.data_schema))
 
     def init_agent(self):
@@ -139,11 +144,18 @@ class EventsGenerator:
         Generate events based on the given symbolic events.
         """
         num_workers = self.config['event_graph']['num_workers']
+        max_workers = self.config['event_graph'].get('max_workers', num_workers)
         timeout = self.config['event_graph']['timeout']
-        res = async_batch_invoke(self.asymbolic_to_event, symbolic_events, num_workers=num_workers,
-                                 callbacks=self.callbacks, timeout=timeout)
-        all_events = [r['result'] for r in res if r['error'] is None]
-        total_cost = sum([r['usage'] for r in res if r['error'] is None])
+        all_events = []
+        total_cost = 0
+        for r in async_batch_stream(self.asymbolic_to_event, symbolic_events, num_workers=num_workers,
+                                    callbacks=self.callbacks, timeout=timeout, max_workers=max_workers,
+                                    stage='events',
+                                    retry_policy=RetryPolicy.from_config(self.config['event_graph'].get('retry'))):
+            if r['error'] is not None:
+                continue
+            all_events.append(r['result'])
+            total_cost += r['usage']
         return all_events, total_cost
 
     def descriptions_to_symbolic(self, descriptions: list[Description]) -> tuple[list[EventSymbolic], float]:
@@ -159,9 +171,13 @@ class EventsGenerator:
         for i, description in enumerate(descriptions):
             samples_batch.append({"tables_info": schema, 'scenario': description.event_description})
         num_workers = self.config['symbolic_enrichment_config'].get('num_workers', 1)
+        max_workers = self.config['symbolic_enrichment_config'].get('max_workers', num_workers)
         timeout = self.config['symbolic_enrichment_config'].get('timeout', 40)
         res = async_batch_invoke(self.llm_symbolic.ainvoke, samples_batch, num_workers=num_workers,
-                                 callbacks=self.callbacks, timeout=timeout)
+                                 callbacks=self.callbacks, timeout=timeout, max_workers=max_workers,
+                                 stage='symbolic',
+                                 retry_policy=RetryPolicy.from_config(
+                                     self.config['symbolic_enrichment_config'].get('retry')))
         events_info = []
         for result in res:
             if result['error'] is not None:
@@ -182,9 +198,13 @@ class EventsGenerator:
         for i, event in enumerate(events):
             samples_batch.append({"symbolic_info": str(event), 'system_prompt': self.env.prompt})
         num_workers = self.config['symbolic_constraints_config'].get('num_workers', 1)
+        max_workers = self.config['symbolic_constraints_config'].get('max_workers', num_workers)
         timeout = self.config['symbolic_constraints_config'].get('timeout', 40)
         res = async_batch_invoke(self.llm_constraints.ainvoke, samples_batch, num_workers=num_workers,
-                                 callbacks=self.callbacks, timeout=timeout)
+                                 callbacks=self.callbacks, timeout=timeout, max_workers=max_workers,
+                                 stage='constraints',
+                                 retry_policy=RetryPolicy.from_config(
+                                     self.config['symbolic_constraints_config'].get('retry')))
         for result in res:
             if result['error'] is not None:
                 continue
@@ -1,16 +1,27 @@
+import contextlib
+import copy
+import math
 import os.path
 
 from simulator.env import Env
-from simulator.agents_graphs.dialog_graph import Dialog
+from simulator.agents_graphs.dialog_graph import Dialog, DialogBudget
 from simulator.agents_graphs.langgraph_tool import AgentTools
 import re
 from langchain_core.messages import AIMessage
 from simulator.utils.llm_utils import get_llm, set_callback, get_prompt_template, set_llm_chain
+from simulator.utils.rate_limiter import with_rate_limit
+from simulator.utils.hedging import with_hedging
 from simulator.dataset.events_generator import Event
 import uuid
 from simulator.utils.sqlite_handler import SqliteSaver
-from simulator.utils.parallelism import async_batch_invoke
+from simulator.utils.parallelism import async_batch_stream, ProcessPool, RetryPolicy
+from simulator.utils.budget import CostBudget, get_active_budget
+from simulator.utils.metrics import METRICS
+from simulator.utils.prompt_cache import set_prompt_cache, get_prompt_cache_settings
+from simulator.utils.prompt_caching import with_prompt_caching
+from typing import Any, Iterator, Tuple
 from simulator.dialog.utils import intermediate_processing
+from simulator.dialog.scheduling import DialogCostModel
 from simulator.utils.logger_config import get_logger, ConsoleColor
 
 class DialogManager:
@@ -25,7 +36,10 @@ class DialogManager:
         :param environment (Env): The environment of the dialog.
         """
         self.config = config
-        self.llm_user = get_llm(config['llm_user'])
+        self.environment = environment
+        self.experiment_path = None
+        self.cost_model = DialogCostModel()  # Orders the dialogs, the longest dialogs are started first
+        self.llm_user = with_rate_limit(get_llm(config['llm_user']))
         self.llm_user = self.llm_user | self.get_user_parsing_function(
             parsing_mode=config['user_parsing_mode'])  # The user language model
         self.callbacks = [set_callback(t) for t in
@@ -41,7 +55,10 @@ class DialogManager:
             self.env_tools_schema = environment.tools_schema
         self.set_critique()
         self.chatbot = None
+        self.default_chatbot = None  # The default agent chatbot, the shard processes can only rebuild this chatbot
         self.chatbot_initial_messages = None
+        self.memory = None
+        self.process_pool = None  # The shard processes, shared by all the batches of the experiment
 
     def set_critique(self):
         # set the critique model
@@ -49,7 +66,9 @@ class DialogManager:
         self.llm_critique = get_llm(critique_config['llm'])
         critique_prompt = get_prompt_template(critique_config['prompt'])
         critique_prompt = critique_prompt.partial(prompt=self.environment_prompt)
-        self.llm_critique = critique_prompt | self.llm_critique
+        critique_prompt = with_prompt_caching(critique_prompt, self.llm_critique)
+        self.llm_critique = critique_prompt | with_rate_limit(self.llm_critique)
+        self.llm_critique = with_hedging(self.llm_critique, critique_config.get('hedge'), stage='critique')
 
     def get_user_parsing_function(self, parsing_mode='default'):
         def parse_user_message(ai_message: AIMessage) -> dict[str, str]:
@@ -76,6 +95,7 @@ class DialogManager:
         chatbot_prompt_params = chatbot_prompt_params if chatbot_prompt_params is not None else {}
         llm_chat = get_llm(self.config['llm_chat'])
         self.chatbot = AgentTools(llm=llm_chat, tools=self.env_tools, tools_schema=self.env_tools_schema)
+        self.default_chatbot = self.chatbot
         if self.chatbot_initial_messages is None:
             chatbot_prompt_args = {'from_str': {'template': self.environment_prompt}}
             chatbot_prompt = get_prompt_template(chatbot_prompt_args)
@@ -89,6 +109,9 @@ class DialogManager:
         Initialize the dialog graph.
         :param experiment_path: The path of the experiment.
         """
+        self.experiment_path = experiment_path
+        # The shard processes of a previous experiment write to its memory
+        self.close()
         self.memory = SqliteSaver(os.path.join(experiment_path, 'memory.db'))
         if self.chatbot is None:
             self.set_agent_tool_chatbot()  # Set the default agent chatbot
@@ -101,8 +124,11 @@ class DialogManager:
 
         self.dialog = Dialog(self.llm_user, self.chatbot, critique=self.llm_critique,
                              intermediate_processing=intermediate_processing,
-                             memory=self.memory)
+                             memory=self.memory,
+                             budget=DialogBudget.from_config(self.config.get('dialog_budget', None),
+                                                             timeout=self.config['timeout']))
         self.user_prompt = get_prompt_template(self.config['user_prompt'])
+        self.user_prompt = with_prompt_caching(self.user_prompt, get_llm(self.config['llm_user']))
 
     def run(self, user_prompt_params=None, chatbot_env_args=None):
         """
@@ -113,7 +139,7 @@ class DialogManager:
         if self.dialog is None:
             raise ValueError("The dialog is not initialized. Please run init_dialog first.")
         user_prompt_params = user_prompt_params if user_prompt_params is not None else {}
-        user_messages = self.user_prompt.format_messages(**user_prompt_params)
+        user_messages = self.user_prompt.invoke(user_prompt_params).to_messages()
         recursion_limit = self.config.get('recursion_limit', 25)
         return self.dialog.invoke(input={"user_messages": user_messages,
                                          "chatbot_messages": self.chatbot_initial_messages,
@@ -131,7 +157,7 @@ class DialogManager:
         if self.dialog is None:
             raise ValueError("The dialog is not initialized. Please run init_dialog first.")
         user_prompt_params = user_prompt_params if user_prompt_params is not None else {}
-        user_messages = self.user_prompt.format_messages(**user_prompt_params)
+        user_messages = self.user_prompt.invoke(user_prompt_params).to_messages()
         recursion_limit = self.config.get('recursion_limit', 25)
         return await self.dialog.ainvoke(input={"user_messages": user_messages,
                                                 "chatbot_messages": self.chatbot_initial_messages,
@@ -159,13 +185,149 @@ class DialogManager:
                                                    'expected_behaviour': event.description.expected_behaviour},
                                chatbot_env_args={'data': event.database})
 
+    def stream_events(self, events: list[Event]) -> Iterator[Tuple[dict, float]]:
+        """
+        Run the dialog between the user and the chatbot on the events, yielding each dialog as soon as it ends.
+        :param events: The events to run.
+        :return: An iterator over (result, cost), the result is None if the dialog failed.
+        """
+        num_processes = self.config.get('num_processes', 1)
+        if num_processes > 1 and len(events) > 1 and self.chatbot is not self.default_chatbot:
+            get_logger().warning(f"{ConsoleColor.RED}A custom chatbot cannot be rebuilt in the shard processes, "
+                                 f"running the dialogs in a single process{ConsoleColor.RESET}")
+            num_processes = 1
+        if num_processes > 1 and len(events) > 1:
+            yield from self.stream_events_multiprocess(events, num_processes)
+            return
+        if self.config.get('scheduling', 'lpt') == 'lpt':
+            events = self.cost_model.sort(events)
+        for r in async_batch_stream(self.arun_event, events, num_workers=self.config['num_workers'],
+                                    callbacks=self.callbacks, timeout=self.config['timeout'],
+                                    max_workers=self.config.get('max_workers', self.config['num_workers']),
+                                    stage='dialogs', retry_policy=RetryPolicy.from_config(self.config.get('retry'))):
+            if r['error'] is not None:
+                yield None, 0
+                continue
+            yield {'res': r['result'], 'event_id': events[r['index']].id}, r['usage']
+
+    def stream_events_multiprocess(self, events: list[Event], num_processes: int) -> Iterator[Tuple[dict, float]]:
+        """
+        Run the dialogs on several processes, each process runs a shard of the events on its own event loop.
+        The processes are started on the first call and reused by the next calls of the experiment. The concurrency,
+        the rate limits and the remaining cost budget are split evenly between the processes.
+        :param events: The events to run.
+        :param num_processes: The number of processes.
+        :return: An iterator over (result, cost), the result is None if the dialog failed.
+        """
+        if self.dialog is None:
+            raise ValueError("The dialog is not initialized. Please run init_dialog first.")
+        if self.process_pool is None or self.process_pool.closed:
+            self.process_pool = ProcessPool(num_processes, init_shard_worker,
+                                            init_args=(get_worker_config(self.config, num_processes),
+                                                       self.environment, self.experiment_path,
+                                                       self.chatbot_initial_messages, get_prompt_cache_settings()))
+        num_shards = min(num_processes, len(events))
+        if self.config.get('scheduling', 'lpt') == 'lpt':
+            shards = self.cost_model.partition(events, num_shards)
+        else:
+            shards = [events[i::num_shards] for i in range(num_shards)]
+        budget = get_active_budget()
+        shard_budget = None
+        if budget is not None:
+            spent = budget.spent
+            shard_budget = {'soft_limit': max(budget.soft_limit - spent, 0) / num_shards,
+                            'hard_limit': max(budget.hard_limit - spent, 0) / num_shards}
+        for kind, item in self.process_pool.stream(run_events_shard, shards, args=(self.cost_model, shard_budget)):
+            if kind == 'metrics':
+                METRICS.extend(item)
+                continue
+            res, cost = item
+            if budget is not None:
+                budget.add(cost)
+            yield res, cost
+
+    def close(self):
+        """
+        Stop the shard processes and commit the memory of the experiment
+        """
+        if self.process_pool is not None:
+            self.process_pool.close()
+            self.process_pool = None
+        if self.memory is not None:
+            self.memory.exit()
+
     def run_events(self, events: list[Event]):
         """
         Run the dialog between the user and the chatbot on the events.
         :param events: The events to run.
         """
-        res = async_batch_invoke(self.arun_event, events, num_workers=self.config['num_workers'],
-                                 callbacks=self.callbacks, timeout=self.config['timeout'])
-        final_result = [{'res': r['result'], 'event_id': events[r['index']].id} for r in res if r['error'] is None]
-        cost = sum([r['usage'] for r in res if r['error'] is None])
+        final_result = []
+        cost = 0
+        for res, res_cost in self.stream_events(events):
+            if res is not None:
+                final_result.append(res)
+                cost += res_cost
         return final_result, cost
+
+
+def get_worker_config(config: dict, num_processes: int) -> dict:
+    """
+    Get the dialog manager config of a shard process, the concurrency and the rate limits are split between the
+    processes
+    :param config: The dialog manager config
+    :param num_processes: The number of processes
+    :return: The config of a single process
+    """
+    worker_config = copy.deepcopy(config)
+    worker_config['num_processes'] = 1
+    for key in ['num_workers', 'max_workers']:
+        if key in worker_config:
+            worker_config[key] = max(1, math.ceil(worker_config[key] / num_processes))
+    for llm_config in [worker_config['llm_user'], worker_config['llm_chat'], worker_config['critique_config']['llm']]:
+        rate_limit = llm_config.get('rate_limit', None)
+        if not rate_limit:
+            continue
+        for key in ['requests_per_minute', 'tokens_per_minute']:
+            if rate_limit.get(key, None):
+                rate_limit[key] = rate_limit[key] / num_processes
+    return worker_config
+
+
+def init_shard_worker(config: dict, environment: Env, experiment_path: str, chatbot_initial_messages: list,
+                      prompt_cache: dict) -> DialogManager:
+    """
+    Create the dialog manager of a shard process (see DialogManager.stream_events_multiprocess)
+    :param config: The dialog manager config of the process.
+    :param environment: The environment of the dialog.
+    :param experiment_path: The path of the experiment.
+    :param chatbot_initial_messages: The initial messages of the chatbot.
+    :param prompt_cache: The settings of the local prompts cache.
+    :return: The dialog manager, used for all the shards of the process
+    """
+    set_prompt_cache(**prompt_cache)
+    dialog_manager = DialogManager(config, environment=environment)
+    dialog_manager.chatbot_initial_messages = chatbot_initial_messages
+    dialog_manager.init_dialog(experiment_path)
+    return dialog_manager
+
+
+def run_events_shard(dialog_manager: DialogManager, events: list[Event], cost_model: DialogCostModel,
+                     budget: dict = None) -> Iterator[Tuple[str, Any]]:
+    """
+    Run a shard of the events in a shard process (see DialogManager.stream_events_multiprocess)
+    :param dialog_manager: The dialog manager of the process.
+    :param events: The events of the shard.
+    :param cost_model: The dialogs cost model.
+    :param budget: The cost budget of the shard (soft_limit and hard_limit), None for no budget.
+    :return: An iterator over ('result', (result, cost)) items, the result is None if the dialog failed, and a final
+    ('metrics', call records) item with the calls of the shard.
+    """
+    dialog_manager.cost_model = cost_model
+    num_calls = len(METRICS.calls)
+    budget_context = CostBudget(**budget).activate() if budget is not None else contextlib.nullcontext()
+    with budget_context:
+        for res, cost in dialog_manager.stream_events(events):
+            yield 'result', (res, cost)
+    # The memory rows of the shard are committed before the shard is reported as done
+    dialog_manager.memory.flush()
+    yield 'metrics', METRICS.calls[num_calls:]
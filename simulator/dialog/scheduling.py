@@ -0,0 +1,109 @@
+import os
+import pickle
+import numpy as np
+from simulator.dataset.definitions import Event
+from simulator.healthcare_analytics import ExceptionEvent, track_event
+
+# The minimal number of past dialogs to fit the cost model on, below it the default weights are used
+MIN_FIT_SAMPLES = 10
+
+
+class DialogCostModel:
+    """
+    Estimates the length (in turns) of the dialog of an event, to start the longest dialogs first.
+    The estimate is a linear model over the event features (challenge level, number of policies and number of
+    relevant rows), fitted on the dialogs of previous experiments on the same dataset. The events that were already
+    simulated are estimated by their mean number of turns.
+    """
+    DEFAULT_WEIGHTS = np.array([2, 0.5, 0.5, 0.25])  # intercept, challenge level, policies, relevant rows
+
+    def __init__(self, turns_history: dict = None):
+        """
+        :param turns_history: The number of turns of past dialogs, {event_id: [num_turns, ...]}
+        """
+        self.turns_history = turns_history if turns_history is not None else {}
+        self.weights = self.DEFAULT_WEIGHTS
+        self.events_features = {}
+
+    @staticmethod
+    def get_features(event: Event) -> np.ndarray:
+        description = event.description
+        return np.array([1,
+                         getattr(description, 'challenge_level', 0) or 0,
+                         len(getattr(description, 'policies', None) or []),
+                         len(event.relevant_rows or [])], dtype=float)
+
+    def fit(self, events: list[Event]):
+        """
+        Fit the weights on the events with a history
+        :param events: The events of the dataset
+        """
+        known_events = [event for event in events if self.turns_history.get(event.id)]
+        if len(known_events) < MIN_FIT_SAMPLES:
+            return
+        features = np.stack([self.get_features(event) for event in known_events])
+        turns = np.array([np.mean(self.turns_history[event.id]) for event in known_events])
+        weights, *_ = np.linalg.lstsq(features, turns, rcond=None)
+        self.weights = weights
+
+    def predict(self, event: Event) -> float:
+        """
+        The expected number of turns of the dialog of the event
+        """
+        if self.turns_history.get(event.id):
+            return float(np.mean(self.turns_history[event.id]))
+        return float(self.get_features(event) @ self.weights)
+
+    def sort(self, events: list[Event]) -> list[Event]:
+        """
+        Order the events by decreasing expected length (longest processing time first)
+        """
+        return sorted(events, key=self.predict, reverse=True)
+
+    def partition(self, events: list[Event], num_shards: int) -> list[list[Event]]:
+        """
+        Split the events between shards with the longest processing time first rule: each event (from the longest)
+        is assigned to the least loaded shard, the events of each shard are ordered by decreasing expected length
+        """
+        shards = [[] for _ in range(num_shards)]
+        loads = [0.0] * num_shards
+        for event in self.sort(events):
+            shard = int(np.argmin(loads))
+            shards[shard].append(event)
+            loads[shard] += max(self.predict(event), 1)
+        return shards
+
+    @classmethod
+    def from_experiments(cls, experiments_dir: str, dataset_name: str, exclude: str = None,
+                         events: list[Event] = None) -> 'DialogCostModel':
+        """
+        Build the cost model from the results of the previous experiments on a dataset
+        :param experiments_dir: The experiments folder
+        :param dataset_name: The dataset name
+        :param exclude: An experiment folder to ignore (e.g. the current experiment)
+        :param events: The events of the dataset to fit the model on (default: no fitting)
+        :return: The cost model
+        """
+        turns_history = {}
+        if os.path.isdir(experiments_dir):
+            for experiment in sorted(os.listdir(experiments_dir)):
+                experiment_dir = os.path.join(experiments_dir, experiment)
+                res_path = os.path.join(experiment_dir, 'res_dump.pickle')
+                if not experiment.startswith(dataset_name + '__') or not os.path.isfile(res_path):
+                    continue
+                if exclude is not None and os.path.abspath(experiment_dir) == os.path.abspath(exclude):
+                    continue
+                try:
+                    all_res = pickle.load(open(res_path, 'rb'))[0]
+                except Exception as e:
+                    track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                               error_message=f"Failed to load the experiment {experiment}: {e}"))
+                    continue
+                for r in all_res:
+                    num_turns = len(r['res'].get('user_messages', []))
+                    if num_turns:
+                        turns_history.setdefault(r['event_id'], []).append(num_turns)
+        cost_model = cls(turns_history)
+        if events is not None:
+            cost_model.fit(events)
+        return cost_model
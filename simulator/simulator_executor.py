@@ -1,11 +1,13 @@
 from simulator.env import Env
 import os
 from simulator.dataset.descriptor_generator import DescriptionGenerator
-from simulator.dataset.events_generator import EventsGenerator
+from simulator.dataset.events_generator import EventsGenerator, PLANNER_PROMPT_HUB_NAME
 from simulator.dialog.dialog_manager import DialogManager
+from simulator.dialog.scheduling import DialogCostModel
+from simulator.agents_graphs.dialog_graph import BUDGET_EXHAUSTED
 from simulator.utils.logger_config import update_logger_file, setup_logger, ConsoleColor
 import pickle
-from simulator.utils.file_reading import get_latest_file
+from simulator.utils.file_reading import get_latest_file, save_pickle, append_pickle, load_pickle_journal
 from datetime import datetime
 from simulator.dataset.dataset_handler import Dataset
 import yaml
@@ -13,6 +15,13 @@ import pandas as pd
 import json
 import uuid
 from simulator.utils.analysis import get_dialog_policies
+from simulator.utils.parallelism import set_retry_budget, STAGE_CONCURRENCY
+from simulator.utils.metrics import METRICS
+from simulator.utils.hedging import HEDGING_POLICIES
+from simulator.utils.cascade import CASCADE_STATS
+from simulator.utils.structured_output import STRUCTURED_OUTPUT_STATS
+from simulator.utils.prompt_cache import set_prompt_cache, collect_prompt_names, prefetch_prompts
+from simulator.utils.budget import CostBudget
 from simulator.healthcare_analytics import (
     RunSimulationEvent,
     AnalyzeSimulationResultsEvent,
@@ -35,6 +44,12 @@ class SimulatorExecutor:
         :param output_path: The artifacts output path.
         """
         self.config = config
+        set_retry_budget(**config.get('retry_budget', {}))
+        # All the hub prompts are pulled in parallel (or loaded from the local cache) before building the chains
+        set_prompt_cache(config.get('prompt_cache_dir', None), offline=config.get('prompt_cache_offline', False))
+        prompt_names = collect_prompt_names(config)
+        prompt_names.setdefault(PLANNER_PROMPT_HUB_NAME, None)
+        prefetch_prompts(prompt_names)
         self.environment = Env(config['environment'])
         description_generator_path = self.set_output_folder(output_path)
         global logger
@@ -115,42 +130,79 @@ class SimulatorExecutor:
             return []  # or handle this case appropriately
 
         num_batch = num_records // mini_batch_size
+        # The turns of the previous experiments on the dataset are used to start the longest dialogs first
+        self.dialog_manager.cost_model = DialogCostModel.from_experiments(experiments_dir,
+                                                                          self.dataset_handler.dataset_name,
+                                                                          exclude=experiment_dir, events=records)
         all_res = []
         total_cost = 0
         start_iteration = 0
 
         logger.info(f"{ConsoleColor.CYAN}Start running the simulator{ConsoleColor.RESET}")
         intermediate_res = os.path.join(experiment_dir, 'res_dump.pickle')
+        # The dialogs that ended since the last batch checkpoint, appended as they end
+        res_journal = os.path.join(experiment_dir, 'res_journal.pickle')
         if os.path.isfile(intermediate_res):
-            all_res, start_iteration, total_cost = pickle.load(open(intermediate_res, 'rb'))
+            with open(intermediate_res, 'rb') as file:
+                all_res, start_iteration, total_cost = pickle.load(file)
+        done_events = {r['event_id'] for r in all_res}
+        for res, cost in load_pickle_journal(res_journal):
+            if res['event_id'] not in done_events:
+                all_res.append(res)
+                done_events.add(res['event_id'])
+                total_cost = max(total_cost, cost)
+        # The budget is enforced in real time: no dialog is started above the cost limit, and the running dialogs
+        # are cancelled above the hard cost limit
+        cost_limit = self.config['dialog_manager']['cost_limit']
+        budget = CostBudget(soft_limit=cost_limit,
+                            hard_limit=self.config['dialog_manager'].get('hard_cost_limit', cost_limit),
+                            spent=total_cost)
+
+        def run_batch(batch_records):
+            # Each dialog is saved as soon as it ends, the dialogs that already ended are skipped on resume
+            nonlocal total_cost
+            done_events = {r['event_id'] for r in all_res}
+            batch_records = [record for record in batch_records if record.id not in done_events]
+            with budget.activate():
+                for res, cost in self.dialog_manager.stream_events(batch_records):
+                    total_cost = budget.spent
+                    if res is not None:
+                        all_res.append(res)
+                        append_pickle((res, total_cost), res_journal)
+            total_cost = budget.spent
+
+        def save_checkpoint(iteration):
+            # The checkpoint includes the journal dialogs, so the journal is cleared after it
+            save_pickle((all_res, iteration, total_cost), intermediate_res)
+            if os.path.isfile(res_journal):
+                os.remove(res_journal)
+
         # Handle batches
         for i in range(start_iteration, num_batch, 1):
-            if total_cost > self.config['dialog_manager']['cost_limit']:
+            if budget.soft_exceeded():
                 logger.warning(
                     f"{ConsoleColor.RED}The cost limit for the experiment is reached. "
                     f"Stopping the simulation.{ConsoleColor.RESET}")
                 break
             logger.info(f"{ConsoleColor.WHITE}Running batch {i}...{ConsoleColor.RESET}")
-            res, cost = self.dialog_manager.run_events(records[i * mini_batch_size:
-                                                               (i + 1) * mini_batch_size])
-            all_res.extend(res)
-            total_cost += cost
-            pickle.dump((all_res, i + 1, total_cost), open(intermediate_res, 'wb'))
+            run_batch(records[i * mini_batch_size: (i + 1) * mini_batch_size])
+            save_checkpoint(i + 1)
 
         # Handle remaining records if any
         remaining_records = records[num_batch * mini_batch_size:]
         if remaining_records:
             logger.info(f"{ConsoleColor.WHITE}Running remaining records...{ConsoleColor.RESET}")
-            if total_cost <= self.config['dialog_manager']['cost_limit']:
-                res, cost = self.dialog_manager.run_events(remaining_records)
-                all_res.extend(res)
-                total_cost += cost
+            if not budget.soft_exceeded():
+                run_batch(remaining_records)
+                save_checkpoint(num_batch)
             else:
                 logger.warning(
                     f"{ConsoleColor.RED}The cost limit for the experiment is reached. "
                     f"Skipping remaining records.{ConsoleColor.RESET}")
 
         logger.info(f"{ConsoleColor.CYAN}Finish running the simulator{ConsoleColor.RESET}")
+        # Stop the shard processes, and commit the memory rows (written behind the dialogs) before the analysis
+        self.dialog_manager.close()
         track_event(RunSimulationEvent(cost=total_cost,
                                        n_dialogs=len(all_res),
                                        avg_n_user_messages_per_dialog=sum(
@@ -164,6 +216,13 @@ class SimulatorExecutor:
                                        llm_chat=self.dialog_manager.config['llm_chat']))
         logger.info(f"{ConsoleColor.CYAN}Analyzing the results{ConsoleColor.RESET}")
         self.analyze_results(all_res, experiment_dir)
+        # The latency, throughput and tokens of all the stages run by the process
+        METRICS.dump(experiment_dir,
+                     extra={'concurrency': dict(STAGE_CONCURRENCY),
+                            'hedging': {stage: policy.stats() for stage, policy in HEDGING_POLICIES.items()},
+                            'cascade': {name: stats.stats() for name, stats in CASCADE_STATS.items()},
+                            'structured_output': STRUCTURED_OUTPUT_STATS},
+                     extra_gauges={'simulator_concurrency': STAGE_CONCURRENCY})
 
     def analyze_results(self, results, experiment_dir):
         """
@@ -183,6 +242,9 @@ class SimulatorExecutor:
                     score = 0
                 elif 'SUCCESS' in stop_signal:
                     score = 1
+                elif stop_signal == BUDGET_EXHAUSTED and r.get('violated_policies', []):
+                    # A partial dialog (that exceeded its budget) fails on the violated policies found by the analysis
+                    score = 0
                 else:
                     score = -1
 
@@ -197,7 +259,8 @@ class SimulatorExecutor:
                     'tested_challenge_level': r.get('tested_challenge_level', None),
                     'policies': getattr(cur_event.description, 'policies', None),
                     'policies_in_dialog': r.get('tested_policies', None),
-                    'violated_policies': r.get('violated_policies', [])
+                    'violated_policies': r.get('violated_policies', []),
+                    'budget_exhausted': r['res'].get('budget_exhausted', None)
                 }
                 all_rows.append(cur_row)
                 valid_event_ind.append(r['event_id'] - 1)
@@ -1,10 +1,11 @@
-from simulator.utils.parallelism import async_batch_invoke
+from simulator.utils.parallelism import async_batch_invoke, RetryPolicy
 from simulator.utils.llm_utils import get_llm, set_llm_chain, set_callback
+from simulator.utils.hedging import with_hedging
 from pydantic import BaseModel, Field
 from typing import List
 from simulator.dataset.events_generator import Event
 from simulator.dataset.descriptor_generator import policies_list_to_str
-from simulator.utils.llm_utils import convert_messages_to_str
+from simulator.utils.llm_utils import convert_messages_to_str, convert_message_to_str
 from typing import Optional
 
 
@@ -20,6 +21,18 @@ def policy_to_str(policy):
     return f"Flow: {policy['flow']}\npolicy: {policy['policy']}"
 
 
+def get_conversation(res: dict) -> str:
+    """
+    The conversation of a dialog result (without its first chatbot message), from the rendered transcript of the
+    dialog when available
+    """
+    messages = res['chatbot_messages']
+    if 'transcript' not in res or not messages:
+        return convert_messages_to_str(messages[1:])
+    # The transcript is the concatenation of the rendered messages
+    return res['transcript'][len(convert_message_to_str(messages[0])):]
+
+
 def get_dialog_policies(config: dict, simulator_res: list[dict], events: list[Event]) -> list[dict]:
     """
     Get the dialog policies from the config
@@ -31,19 +44,23 @@ def get_dialog_policies(config: dict, simulator_res: list[dict], events: list[Ev
 
     llm = get_llm(config['llm'])
     llm = set_llm_chain(llm, **config['prompt'], structure=PoliciesAnalysis)
+    llm = with_hedging(llm, config.get('hedge'), stage='analysis')
     batch = []
     callback = set_callback(config['llm']['type'])
     for r in simulator_res:
         cur_event = events[r['event_id'] - 1]
         judgment_reason = r['res']['user_thoughts'][-1].split('Thought:\n')[-1]
         batch.append({'policies': policies_list_to_str(cur_event.description.policies),
-                      'conversation': convert_messages_to_str(r['res']['chatbot_messages'][1:]),
+                      'conversation': get_conversation(r['res']),
                       'judgment': f"{r['res']['stop_signal']}\n{judgment_reason}",
                       'feedback': r['res']['critique_feedback']})
 
     num_workers = config.get('num_workers', 1)
+    max_workers = config.get('max_workers', num_workers)
     timeout = config.get('timeout', 10)
-    res = async_batch_invoke(llm.ainvoke, batch, num_workers=num_workers, timeout=timeout, callbacks=[callback])
+    res = async_batch_invoke(llm.ainvoke, batch, num_workers=num_workers, timeout=timeout, callbacks=[callback],
+                             max_workers=max_workers, stage='analysis',
+                             retry_policy=RetryPolicy.from_config(config.get('retry')))
     for r in res:
         if r['error'] is not None:
             continue
@@ -0,0 +1,96 @@
+import contextlib
+import threading
+from typing import Optional
+from simulator.utils.logger_config import get_logger, ConsoleColor
+
+# The budget enforced by the batch executors (see CostBudget.activate)
+_active_budget = None
+
+
+class CostBudget:
+    """
+    Tracks the spend of a part of the pipeline in real time.
+    The cost of the in-flight tasks is read from their usage callbacks, which are updated as each llm call
+    completes. Once the soft limit is reached no new task is admitted, and once the hard limit is reached the
+    in-flight tasks are cancelled.
+    """
+
+    def __init__(self, soft_limit: float, hard_limit: Optional[float] = None, spent: float = 0):
+        """
+        :param soft_limit: The cost (in dollars) above which no new task is started
+        :param hard_limit: The cost (in dollars) above which the in-flight tasks are cancelled (default: soft_limit),
+        a hard limit below the soft limit is raised to the soft limit
+        :param spent: The cost already spent (e.g. when resuming from a checkpoint)
+        """
+        if hard_limit is not None and hard_limit < soft_limit:
+            get_logger().warning(f"{ConsoleColor.YELLOW}The hard cost limit {hard_limit} is below the cost limit "
+                                 f"{soft_limit}, the cost limit is used as the hard limit{ConsoleColor.RESET}")
+            hard_limit = soft_limit
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit if hard_limit is not None else soft_limit
+        self.committed = spent
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self._next_id = 0
+
+    @property
+    def spent(self) -> float:
+        """
+        The cost of the completed tasks and the cost so far of the in-flight tasks
+        """
+        with self.lock:
+            return self.committed + sum(get_callbacks_cost(cbs) for cbs in self.in_flight.values())
+
+    def soft_exceeded(self) -> bool:
+        return self.spent > self.soft_limit
+
+    def hard_exceeded(self) -> bool:
+        return self.spent > self.hard_limit
+
+    def start(self, callbacks: list) -> int:
+        """
+        Start tracking the usage callbacks of a task
+        :param callbacks: The (entered) usage callbacks of the task
+        :return: The tracking id, to pass to finish
+        """
+        with self.lock:
+            task_id = self._next_id
+            self._next_id += 1
+            self.in_flight[task_id] = callbacks
+            return task_id
+
+    def finish(self, task_id: int):
+        """
+        Stop tracking a task and commit its cost
+        """
+        with self.lock:
+            callbacks = self.in_flight.pop(task_id, [])
+            self.committed += get_callbacks_cost(callbacks)
+
+    def add(self, cost: float):
+        """
+        Commit the cost of a task that was not tracked (e.g. a task that ran in another process)
+        """
+        with self.lock:
+            self.committed += cost
+
+    @contextlib.contextmanager
+    def activate(self):
+        """
+        Enforce the budget on all the batches executed in the context
+        """
+        global _active_budget
+        previous_budget = _active_budget
+        _active_budget = self
+        try:
+            yield self
+        finally:
+            _active_budget = previous_budget
+
+
+def get_callbacks_cost(callbacks: list) -> float:
+    return sum(getattr(cb, 'total_cost', 0) for cb in callbacks)
+
+
+def get_active_budget() -> Optional[CostBudget]:
+    return _active_budget
@@ -0,0 +1,243 @@
+import asyncio
+import random
+import threading
+from typing import Any, Optional
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import Runnable, RunnableConfig
+from pydantic import BaseModel, ConfigDict, Field, create_model
+from simulator.healthcare_analytics import ExceptionEvent, track_event
+from simulator.utils.cassette import without_usage
+from simulator.utils.rate_limiter import with_rate_limit
+
+# The routing statistics of all the cascades, by cascade name
+CASCADE_STATS = {}
+_REGISTRY_LOCK = threading.Lock()
+
+# The field added to the structured output of the fast model, holding its self-reported confidence
+CONFIDENCE_FIELD = 'confidence'
+
+
+class CascadeStats:
+    """
+    The routing statistics of a cascade
+    """
+
+    def __init__(self):
+        self.num_calls = 0
+        self.num_fast = 0  # The calls answered by the fast model
+        self.num_agreement_checks = 0
+        self.num_agreements = 0
+        self.escalations = {}  # {reason: count}
+        self.lock = threading.Lock()
+
+    def record(self, escalation: Optional[str], agreement: Optional[bool] = None):
+        """
+        Record a call
+        :param escalation: The escalation reason ('validation', 'confidence', 'disagreement' or 'error'), None if the
+         fast model answer was used
+        :param agreement: The result of the agreement check, None if the call was not checked
+        """
+        with self.lock:
+            self.num_calls += 1
+            if escalation is None:
+                self.num_fast += 1
+            else:
+                self.escalations[escalation] = self.escalations.get(escalation, 0) + 1
+            if agreement is not None:
+                self.num_agreement_checks += 1
+                self.num_agreements += agreement
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'calls': self.num_calls, 'fast': self.num_fast, 'escalations': dict(self.escalations),
+                    'fast_rate': self.num_fast / self.num_calls if self.num_calls else 0,
+                    'agreement_checks': self.num_agreement_checks,
+                    'agreement_rate': self.num_agreements / self.num_agreement_checks
+                    if self.num_agreement_checks else 0}
+
+
+def get_cascade_stats(name: str) -> CascadeStats:
+    with _REGISTRY_LOCK:
+        if name not in CASCADE_STATS:
+            CASCADE_STATS[name] = CascadeStats()
+        return CASCADE_STATS[name]
+
+
+def add_confidence_field(schema: Any) -> Any:
+    """
+    Extend a pydantic schema with a self-reported confidence field (the other schemas are returned unchanged)
+    """
+    if not isinstance(schema, type) or not issubclass(schema, BaseModel) or CONFIDENCE_FIELD in schema.model_fields:
+        return schema
+    return create_model(schema.__name__, __base__=schema,
+                        __doc__=schema.__doc__,
+                        **{CONFIDENCE_FIELD: (float, Field(description="Your confidence in the answer, between 0 "
+                                                                       "(a guess) and 1 (certain)"))})
+
+
+def get_answer_values(answer: Any) -> Any:
+    """
+    The comparable values of an answer (without the self-reported confidence)
+    """
+    if isinstance(answer, BaseModel):
+        answer = answer.model_dump()
+    if isinstance(answer, dict):
+        return {key: value for key, value in answer.items() if key != CONFIDENCE_FIELD}
+    if isinstance(answer, BaseMessage):
+        answer = answer.content
+    if isinstance(answer, str):
+        return ' '.join(answer.split()).lower()
+    return answer
+
+
+class CascadeRunnable(Runnable):
+    """
+    Runs the fast runnable of a cascade, and escalates to the strong runnable when the fast answer fails validation,
+    its self-reported confidence is low, or a sampled agreement check with the strong answer fails
+    """
+
+    def __init__(self, fast: Runnable, strong: Runnable, stats: CascadeStats, schema: Any = None,
+                 min_confidence: float = 0, agreement_rate: float = 0):
+        """
+        :param fast: The fast runnable, a structured output runnable (with include_raw) when schema is given
+        :param strong: The strong runnable
+        :param stats: The routing statistics
+        :param schema: The structured output schema, None for a plain text output
+        :param min_confidence: The confidence under which the call is escalated
+        :param agreement_rate: The ratio of the calls also run by the strong runnable to check the agreement
+        """
+        self.fast = fast
+        self.strong = strong
+        self.stats = stats
+        self.schema = schema
+        self.min_confidence = min_confidence
+        self.agreement_rate = agreement_rate
+
+    def check_fast(self, output: Any) -> tuple[Any, Optional[str]]:
+        """
+        :return: The fast answer and the escalation reason (None if the answer is accepted)
+        """
+        if self.schema is None:
+            if not isinstance(output, BaseMessage) or (not output.content and not getattr(output, 'tool_calls', [])):
+                return output, 'validation'
+            return output, None
+        answer = output['parsed']
+        if output.get('parsing_error', None) is not None or answer is None:
+            return None, 'validation'
+        confidence = getattr(answer, CONFIDENCE_FIELD, None)
+        if isinstance(self.schema, type) and issubclass(self.schema, BaseModel):
+            # The answer is converted back to the requested schema
+            answer = self.schema(**get_answer_values(answer))
+        if confidence is not None and confidence < self.min_confidence:
+            return answer, 'confidence'
+        return answer, None
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        try:
+            answer, escalation = self.check_fast(self.fast.invoke(input, config, **kwargs))
+        except Exception as e:
+            track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                       error_message=f"The fast model of the cascade failed: {e}"))
+            answer, escalation = None, 'error'
+        if escalation is not None:
+            result = self.strong.invoke(input, config, **kwargs)
+            self.stats.record(escalation)
+            return result
+        if random.random() >= self.agreement_rate:
+            self.stats.record(None)
+            return answer
+        strong_answer = self.strong.invoke(input, config, **kwargs)
+        return self.resolve_agreement(answer, strong_answer)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        check_agreement = random.random() < self.agreement_rate
+        strong_task = None
+        if check_agreement:
+            # The strong answer of a checked call is requested concurrently with the fast answer
+            strong_task = asyncio.ensure_future(self.strong.ainvoke(input, config, **kwargs))
+        try:
+            try:
+                answer, escalation = self.check_fast(await self.fast.ainvoke(input, config, **kwargs))
+            except Exception as e:
+                track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                           error_message=f"The fast model of the cascade failed: {e}"))
+                answer, escalation = None, 'error'
+            if escalation is not None:
+                if strong_task is None:
+                    strong_task = asyncio.ensure_future(self.strong.ainvoke(input, config, **kwargs))
+                result = await strong_task
+                self.stats.record(escalation)
+                return result
+            if strong_task is None:
+                self.stats.record(None)
+                return answer
+            return self.resolve_agreement(answer, await strong_task)
+        finally:
+            if strong_task is not None and not strong_task.done():
+                strong_task.cancel()
+
+    def resolve_agreement(self, answer: Any, strong_answer: Any) -> Any:
+        agreement = get_answer_values(answer) == get_answer_values(strong_answer)
+        self.stats.record(None if agreement else 'disagreement', agreement=agreement)
+        return answer if agreement else strong_answer
+
+
+class CascadeChatModel(BaseChatModel):
+    """
+    A cascade of a fast and a strong chat model: the calls are answered by the fast model, and escalated to the
+    strong model when the fast answer is not valid, not confident enough, or disagrees with the strong model on a
+    sampled check. The structured outputs are validated against their schema, and the fast model also reports its
+    confidence.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    fast: BaseChatModel
+    strong: BaseChatModel
+    cascade_name: str = 'cascade'  # The name of the routing statistics
+    min_confidence: float = 0.7
+    agreement_rate: float = 0.05
+
+    @property
+    def _llm_type(self) -> str:
+        return 'cascade'
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {'cascade_name': self.cascade_name, 'min_confidence': self.min_confidence,
+                'agreement_rate': self.agreement_rate}
+
+    def get_stats(self) -> CascadeStats:
+        return get_cascade_stats(self.cascade_name)
+
+    def with_structured_output(self, schema: Any, *, include_raw: bool = False, **kwargs: Any) -> Runnable:
+        if include_raw:
+            raise NotImplementedError("The cascade does not return the raw message of the structured output")
+        fast = self.fast.with_structured_output(add_confidence_field(schema), include_raw=True, **kwargs)
+        strong = self.strong.with_structured_output(schema, **kwargs)
+        return CascadeRunnable(with_rate_limit(self.fast, fast), with_rate_limit(self.strong, strong),
+                               self.get_stats(), schema=schema, min_confidence=self.min_confidence,
+                               agreement_rate=self.agreement_rate)
+
+    def bind_tools(self, tools: Any, **kwargs: Any) -> Runnable:
+        return CascadeRunnable(with_rate_limit(self.fast, self.fast.bind_tools(tools, **kwargs)),
+                               with_rate_limit(self.strong, self.strong.bind_tools(tools, **kwargs)),
+                               self.get_stats(), agreement_rate=self.agreement_rate)
+
+    def _get_cascade(self, stop: Optional[list[str]], kwargs: dict) -> CascadeRunnable:
+        fast = self.fast.bind(stop=stop, **kwargs) if stop or kwargs else self.fast
+        strong = self.strong.bind(stop=stop, **kwargs) if stop or kwargs else self.strong
+        return CascadeRunnable(with_rate_limit(self.fast, fast), with_rate_limit(self.strong, strong),
+                               self.get_stats(), agreement_rate=self.agreement_rate)
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = self._get_cascade(stop, kwargs).invoke(messages)
+        return ChatResult(generations=[ChatGeneration(message=without_usage(message))])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        message = await self._get_cascade(stop, kwargs).ainvoke(messages)
+        return ChatResult(generations=[ChatGeneration(message=without_usage(message))])
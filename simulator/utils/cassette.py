@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Optional, Sequence, Union
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import ConfigDict
+
+# Process-wide cassettes, keyed by file path
+_CASSETTES = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def without_usage(message: BaseMessage) -> BaseMessage:
+    """
+    A copy of an inner model response without its usage, the usage callbacks already counted it
+    """
+    response_metadata = {key: value for key, value in message.response_metadata.items() if key != 'token_usage'}
+    return message.model_copy(update={'usage_metadata': None, 'response_metadata': response_metadata})
+
+
+class CassetteMissError(KeyError):
+    """
+    A request that is not in the cassette, in replay mode with the 'error' miss policy
+    """
+
+
+class Cassette:
+    """
+    A file of recorded llm interactions (SQLite, one zlib compressed row per request, indexed by the request hash)
+    """
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS Interactions (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response BLOB NOT NULL,
+                latency REAL NOT NULL,
+                time REAL NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+    def get(self, key: str) -> Optional[tuple[AIMessage, float]]:
+        """
+        :return: The recorded (response, latency), None if the request was not recorded
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT response, latency FROM Interactions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        message = messages_from_dict([json.loads(zlib.decompress(row[0]))])[0]
+        return message, row[1]
+
+    def put(self, key: str, model: str, message: BaseMessage, latency: float):
+        response = zlib.compress(json.dumps(message_to_dict(message)).encode('utf-8'))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO Interactions (key, model, response, latency, time) '
+                              'VALUES (?, ?, ?, ?, ?)', (key, model, response, latency, time.time()))
+            self.conn.commit()
+
+
+def get_cassette(path: str) -> Cassette:
+    """
+    Get the process-wide cassette of a file
+    """
+    path = os.path.abspath(path)
+    with _REGISTRY_LOCK:
+        if path not in _CASSETTES:
+            _CASSETTES[path] = Cassette(path)
+        return _CASSETTES[path]
+
+
+def get_request_key(model: str, messages: list[BaseMessage], stop: Optional[list[str]], kwargs: dict) -> str:
+    """
+    The hash of a request. Only the content of the messages is used (not their ids or metadata), so a replayed
+    conversation has the same requests as the recorded one.
+    """
+    normalized_messages = []
+    for message in messages:
+        normalized_messages.append({'type': message.type,
+                                    'content': message.content,
+                                    'tool_calls': [{'name': tc['name'], 'args': tc['args'], 'id': tc.get('id')}
+                                                   for tc in getattr(message, 'tool_calls', None) or []],
+                                    'tool_call_id': getattr(message, 'tool_call_id', None)})
+    request = {'model': model, 'messages': normalized_messages, 'stop': stop, 'kwargs': kwargs}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class CassetteChatModel(BaseChatModel):
+    """
+    A chat model recording the interactions of an inner model to a cassette, or replaying them without any
+    provider call.
+    In 'record' mode every request is sent to the inner model and its response is recorded. In 'replay' mode the
+    recorded responses are served (with a synthetic latency), and the missing requests are handled according to
+    miss_policy: 'error' (raise CassetteMissError), 'record' (send to the inner model and record) or 'empty'
+    (an empty response).
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    cassette: Cassette
+    model_name: str = ''
+    mode: str = 'replay'
+    inner: Optional[BaseChatModel] = None
+    latency: Union[str, float] = 0  # 'recorded' for the recorded latency, or a latency in seconds
+    latency_scale: float = 1
+    miss_policy: str = 'error'
+
+    @property
+    def _llm_type(self) -> str:
+        return 'replay'
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {'model_name': self.model_name, 'mode': self.mode}
+
+    def bind_tools(self, tools: Sequence[Any], *, tool_choice: Optional[Union[str, dict]] = None,
+                   **kwargs: Any) -> Runnable[LanguageModelInput, BaseMessage]:
+        # The tools are bound in the provider agnostic openai format, and bound to the inner model when recording
+        formatted_tools = [convert_to_openai_tool(tool) for tool in tools]
+        if tool_choice is not None:
+            kwargs['tool_choice'] = tool_choice
+        return self.bind(tools=formatted_tools, **kwargs)
+
+    def _get_delay(self, recorded_latency: float) -> float:
+        latency = recorded_latency if self.latency == 'recorded' else float(self.latency)
+        return latency * self.latency_scale
+
+    def _get_inner(self, kwargs: dict) -> Runnable:
+        if self.inner is None:
+            raise ValueError("Recording requires the inner llm of the replay model (config['llm'])")
+        kwargs = dict(kwargs)
+        tools = kwargs.pop('tools', None)
+        if tools is not None:
+            return self.inner.bind_tools(tools, **kwargs)
+        return self.inner.bind(**kwargs) if kwargs else self.inner
+
+    def _should_record(self, recorded: Optional[tuple]) -> bool:
+        if self.mode == 'record':
+            return True
+        if recorded is not None:
+            return False
+        if self.miss_policy == 'error':
+            raise CassetteMissError(f"The request is not in the cassette {self.cassette.path}")
+        return self.miss_policy == 'record'
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        key = get_request_key(self.model_name, messages, stop, kwargs)
+        recorded = self.cassette.get(key) if self.mode == 'replay' else None
+        if self._should_record(recorded):
+            start_time = time.monotonic()
+            message = self._get_inner(kwargs).invoke(messages, stop=stop)
+            self.cassette.put(key, self.model_name, message, time.monotonic() - start_time)
+            # The usage of the inner call is already counted by the usage callbacks
+            message = without_usage(message)
+        elif recorded is None:
+            message = AIMessage(content='')
+        else:
+            message, recorded_latency = recorded
+            time.sleep(self._get_delay(recorded_latency))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        key = get_request_key(self.model_name, messages, stop, kwargs)
+        recorded = self.cassette.get(key) if self.mode == 'replay' else None
+        if self._should_record(recorded):
+            start_time = time.monotonic()
+            message = await self._get_inner(kwargs).ainvoke(messages, stop=stop)
+            self.cassette.put(key, self.model_name, message, time.monotonic() - start_time)
+            # The usage of the inner call is already counted by the usage callbacks
+            message = without_usage(message)
+        elif recorded is None:
+            message = AIMessage(content='')
+        else:
+            message, recorded_latency = recorded
+            await asyncio.sleep(self._get_delay(recorded_latency))
+        return ChatResult(generations=[ChatGeneration(message=message)])
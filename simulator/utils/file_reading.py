@@ -3,6 +3,7 @@ from pathlib import Path
 import os
 import importlib.util
 import inspect
+import pickle
 
 
 def get_latest_file(directory_path, extension='pickle') -> str:
@@ -25,6 +26,46 @@ def get_latest_file(directory_path, extension='pickle') -> str:
     return latest_file.name
 
 
+def save_pickle(obj, path: str):
+    """
+    Save an object atomically: a kill during the write leaves the previous file intact
+    :param obj: The object to save
+    :param path: The pickle file path
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(obj, file)
+    os.replace(tmp_path, path)
+
+
+def append_pickle(obj, path: str):
+    """
+    Append an object to a pickle journal (see load_pickle_journal)
+    :param obj: The object to append
+    :param path: The journal file path
+    """
+    with open(path, 'ab') as file:
+        pickle.dump(obj, file)
+
+
+def load_pickle_journal(path: str) -> list:
+    """
+    Load the objects of a pickle journal, a last object truncated by a kill during its write is ignored
+    :param path: The journal file path
+    :return: The objects, empty if the journal does not exist
+    """
+    objects = []
+    if not os.path.isfile(path):
+        return objects
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                objects.append(pickle.load(file))
+            except (EOFError, pickle.UnpicklingError):
+                break
+    return objects
+
+
 def validator(table=None):
     def decorator(func):
         func.is_collected = True  # Add a custom attribute to the function
@@ -0,0 +1,268 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+import time
+from collections import deque
+from typing import Any, Optional
+import numpy as np
+from langchain_community.callbacks.openai_info import OpenAICallbackHandler
+from langchain_core.callbacks import CallbackManager
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import ensure_config, merge_configs
+from simulator.utils.usage_callbacks import add_usage
+
+# The hedging policies of all the stages, by stage name
+HEDGING_POLICIES = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='hedge')
+        return _executor
+
+
+class HedgingPolicy:
+    """
+    Decides when a duplicate (hedge) request is sent for a slow call.
+    A hedge is sent once a call exceeds a percentile of the recent latencies, and the ratio of hedged calls is capped.
+    """
+
+    def __init__(self, percentile: float = 95, max_rate: float = 0.1, min_samples: int = 20, window: int = 200):
+        """
+        :param percentile: The latency percentile after which a call is hedged
+        :param max_rate: The maximal ratio of hedged calls
+        :param min_samples: The minimal number of latency samples before hedging
+        :param window: The number of recent latencies the percentile is computed on
+        """
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.num_calls = 0
+        self.num_hedges = 0
+        self.num_hedge_wins = 0
+        self.loser_input_tokens = 0
+        self.loser_output_tokens = 0
+        self.loser_cost = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]) -> Optional['HedgingPolicy']:
+        """
+        Build a hedging policy from a stage config block (None if hedging is not configured)
+        """
+        if not config:
+            return None
+        return cls(**config)
+
+    def start_call(self):
+        with self.lock:
+            self.num_calls += 1
+
+    def record(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        The time (in seconds) after which a call is hedged, None if there are not enough samples yet
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return float(np.percentile(self.latencies, self.percentile))
+
+    def try_hedge(self) -> bool:
+        """
+        Reserve a hedge if the hedge rate allows it
+        """
+        with self.lock:
+            if self.num_hedges + 1 > self.max_rate * self.num_calls:
+                return False
+            self.num_hedges += 1
+            return True
+
+    def record_win(self):
+        with self.lock:
+            self.num_hedge_wins += 1
+
+    def record_loser(self, input_tokens: int, output_tokens: int, cost: float):
+        """
+        Record the usage of a losing request (billed by the provider although its response is discarded)
+        """
+        with self.lock:
+            self.loser_input_tokens += input_tokens
+            self.loser_output_tokens += output_tokens
+            self.loser_cost += cost
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'calls': self.num_calls, 'hedges': self.num_hedges, 'hedge_wins': self.num_hedge_wins,
+                    'loser_input_tokens': self.loser_input_tokens, 'loser_output_tokens': self.loser_output_tokens,
+                    'loser_cost': self.loser_cost}
+
+
+def _with_attempt_usage(config: Optional[RunnableConfig]) -> tuple[RunnableConfig, OpenAICallbackHandler]:
+    """
+    Add a usage callback handler counting the tokens and cost of a single request to the config
+    """
+    usage = OpenAICallbackHandler()
+    return merge_configs(config, {'callbacks': [usage]}), usage
+
+
+class HedgedRunnable(Runnable):
+    """
+    A runnable sending a duplicate request when the call is slower than usual, the first response wins.
+    The hedge runs in the same (callbacks) context as the original call, so its cost is accounted by the usage
+    callbacks of the call. In sync mode the slower request is abandoned, its usage and latency are recorded when it
+    completes. In async mode it is cancelled before its usage is reported, but the provider still bills it, so its
+    usage is estimated as the usage of the winner (same prompt) and added to the usage callbacks of the call.
+    The elapsed time of a cancelled request is recorded as its latency (a lower bound).
+    """
+
+    def __init__(self, runnable: Runnable, policy: HedgingPolicy):
+        """
+        :param runnable: The runnable to hedge, should be idempotent (e.g. a single llm call)
+        :param policy: The hedging policy
+        """
+        self.runnable = runnable
+        self.policy = policy
+
+    @property
+    def InputType(self) -> Any:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Any:
+        return self.runnable.OutputType
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        self.policy.start_call()
+        executor = _get_executor()
+
+        def submit():
+            start_time = time.monotonic()
+            context = contextvars.copy_context()
+            attempt_config, usage = _with_attempt_usage(config)
+            future = executor.submit(context.run, self.runnable.invoke, input, attempt_config, **kwargs)
+            return future, start_time, usage
+
+        primary, start_time, primary_usage = submit()
+        delay = self.policy.hedge_delay()
+        try:
+            result = primary.result(timeout=delay)
+            self.policy.record(time.monotonic() - start_time)
+            return result
+        except concurrent.futures.TimeoutError:
+            if not self.policy.try_hedge():
+                result = primary.result()
+                self.policy.record(time.monotonic() - start_time)
+                return result
+        hedge, hedge_start_time, hedge_usage = submit()
+        starts = {primary: start_time, hedge: hedge_start_time}
+        usages = {primary: primary_usage, hedge: hedge_usage}
+        pending = set(starts)
+        error = None
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for loser in pending:
+                    if not loser.cancel():  # Only effective if not started yet
+                        loser.add_done_callback(self._get_loser_callback(starts[loser], usages[loser]))
+                self.policy.record(time.monotonic() - starts[future])
+                if future is hedge:
+                    self.policy.record_win()
+                return future.result()
+        raise error
+
+    def _get_loser_callback(self, start_time: float, usage: OpenAICallbackHandler):
+        """
+        The callback recording the latency and usage of an abandoned request once it completes
+        """
+
+        def record_loser(future: concurrent.futures.Future):
+            self.policy.record(time.monotonic() - start_time)
+            self.policy.record_loser(usage.prompt_tokens, usage.completion_tokens, usage.total_cost)
+
+        return record_loser
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        self.policy.start_call()
+
+        def submit():
+            attempt_config, usage = _with_attempt_usage(config)
+            task = asyncio.ensure_future(self.runnable.ainvoke(input, attempt_config, **kwargs))
+            return task, time.monotonic(), usage
+
+        primary, start_time, primary_usage = submit()
+        starts = {primary: start_time}
+        try:
+            delay = self.policy.hedge_delay()
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self.policy.try_hedge():
+                result = await primary
+                self.policy.record(time.monotonic() - start_time)
+                return result
+            hedge, hedge_start_time, hedge_usage = submit()
+            starts[hedge] = hedge_start_time
+            usages = {primary: primary_usage, hedge: hedge_usage}
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    end_time = time.monotonic()
+                    self.policy.record(end_time - starts[task])
+                    if task is hedge:
+                        self.policy.record_win()
+                    for loser in pending:
+                        self._record_cancelled(config, end_time - starts[loser], usages[task])
+                    return task.result()
+            raise error
+        finally:
+            # The slower request (or both, if the call was cancelled) is not needed anymore
+            for task in starts:
+                task.cancel()
+            await asyncio.gather(*starts, return_exceptions=True)
+
+    def _record_cancelled(self, config: Optional[RunnableConfig], elapsed: float, winner_usage: OpenAICallbackHandler):
+        """
+        Record a cancelled request, its usage is estimated as the usage of the winner
+        :param config: The config of the call, the estimated usage is added to its usage callbacks
+        :param elapsed: The elapsed time of the cancelled request
+        :param winner_usage: The usage of the winning request
+        """
+        self.policy.record(elapsed)
+        input_tokens, output_tokens = winner_usage.prompt_tokens, winner_usage.completion_tokens
+        cost = winner_usage.total_cost
+        self.policy.record_loser(input_tokens, output_tokens, cost)
+        handlers = CallbackManager.configure(inheritable_callbacks=ensure_config(config).get('callbacks')).handlers
+        add_usage(handlers, input_tokens, output_tokens, cost)
+
+
+def with_hedging(runnable: Runnable, config: Optional[dict], stage: str = None) -> Runnable:
+    """
+    Wrap a runnable with request hedging if configured
+    :param runnable: The runnable (a single llm call chain)
+    :param config: The hedging config (percentile, max_rate, min_samples, window), None to disable hedging
+    :param stage: The stage name, the policies are registered in HEDGING_POLICIES by stage
+    :return: The hedged runnable, or the runnable itself if hedging is not configured
+    """
+    policy = HedgingPolicy.from_config(config)
+    if policy is None:
+        return runnable
+    if stage is not None:
+        HEDGING_POLICIES[stage] = policy
+    return HedgedRunnable(runnable, policy)
@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import warnings
+from typing import Any, Optional, Union
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+from langchain_core.outputs import ChatGeneration
+from langchain_core.runnables import Runnable, RunnableConfig
+from simulator.healthcare_analytics import ExceptionEvent, track_event
+
+# Process-wide caches, keyed by database path
+_RESPONSE_CACHES = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+class ResponseCache(BaseCache):
+    """
+    A persistent (SQLite) cache of the llm responses.
+    The entries are keyed by a hash of the llm string (model, temperature and the other call parameters, including
+    the bound tools and structured output schema) and the rendered messages. The entries expire after ttl seconds,
+    and the least recently used entries are evicted once the database exceeds max_size_mb.
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None, max_size_mb: Optional[float] = None,
+                 eviction_interval: int = 100):
+        """
+        :param path: The path of the SQLite database
+        :param ttl: The time to live of the entries (in seconds), None for no expiration
+        :param max_size_mb: The maximal size of the cached responses (in MB), None for no limit
+        :param eviction_interval: The number of insertions between two evictions
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_size_mb = max_size_mb
+        self.eviction_interval = eviction_interval
+        self.num_updates = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS Responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON Responses (accessed)')
+        self.conn.commit()
+
+    @staticmethod
+    def get_key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f'{llm_string}\n{prompt}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self.get_key(prompt, llm_string)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT value, created FROM Responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] + self.ttl < now:
+                self.conn.execute('DELETE FROM Responses WHERE key = ?', (key,))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.num_misses += 1
+                return None
+            self.num_hits += 1
+            self.conn.execute('UPDATE Responses SET accessed = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # langchain load is in beta
+                generations = loads(row[0])
+        except Exception as e:
+            track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                       error_message=f"Failed to load a cached response: {e}"))
+            return None
+        for generation in generations:
+            # A cached response is free, the usage callbacks should not count its tokens
+            if isinstance(generation, ChatGeneration):
+                generation.message.usage_metadata = None
+                generation.message.response_metadata.pop('token_usage', None)
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self.get_key(prompt, llm_string)
+        value = dumps(list(return_val))
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO Responses (key, value, size, created, accessed) '
+                              'VALUES (?, ?, ?, ?, ?)', (key, value, len(value), now, now))
+            self.conn.commit()
+            self.num_updates += 1
+            if self.num_updates % self.eviction_interval == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        """
+        Delete the expired entries, and the least recently used entries above the size limit (lock held)
+        """
+        if self.ttl is not None:
+            self.conn.execute('DELETE FROM Responses WHERE created < ?', (now - self.ttl,))
+        if self.max_size_mb is not None:
+            max_size = self.max_size_mb * 1024 * 1024
+            total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM Responses').fetchone()[0]
+            if total_size > max_size:
+                # Keep the most recently used entries that fit in the limit
+                self.conn.execute('''
+                    DELETE FROM Responses WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY accessed DESC) AS cumulative_size
+                            FROM Responses
+                        ) WHERE cumulative_size > ?
+                    )
+                ''', (max_size,))
+        self.conn.commit()
+
+    def clear(self, **kwargs: Any) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM Responses')
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.num_hits, 'misses': self.num_misses}
+
+
+def get_response_cache(config: dict) -> Optional[ResponseCache]:
+    """
+    Get the process-wide response cache of an llm config block
+    :param config: The llm config, the cache is configured by config['cache'] (path, ttl, max_size_mb)
+    :return: The shared response cache, None if the config has no cache
+    """
+    cache_config = config.get('cache', None)
+    if not cache_config:
+        return None
+    cache_config = dict(cache_config)
+    path = os.path.abspath(cache_config.pop('path', os.path.join('cache', 'llm_cache.db')))
+    with _REGISTRY_LOCK:
+        if path not in _RESPONSE_CACHES:
+            _RESPONSE_CACHES[path] = ResponseCache(path, **cache_config)
+        return _RESPONSE_CACHES[path]
+
+
+def _set_done(future: asyncio.Future):
+    if not future.done():  # The waiter may have been cancelled
+        future.set_result(None)
+
+
+class InFlightCall:
+    """
+    A call in flight, its sync and async waiters are woken up when it ends
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.futures = []  # The (loop, future) of the async waiters
+
+    def add_waiter(self) -> asyncio.Future:
+        """
+        :return: A future of the running loop, done when the call ends
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.futures.append((loop, future))
+        return future
+
+    def set(self):
+        self.event.set()
+        for loop, future in self.futures:
+            try:
+                loop.call_soon_threadsafe(_set_done, future)
+            except RuntimeError:
+                pass  # The loop of the waiter is closed
+
+
+class SingleFlightRunnable(Runnable):
+    """
+    De-duplicates identical concurrent calls of a cached runnable: while a call is in flight, the identical calls
+    wait for it to end and then run, so they are served by the cache (or retry the call if it failed).
+    """
+
+    def __init__(self, runnable: Runnable):
+        """
+        :param runnable: The runnable, its llm should have a response cache
+        """
+        self.runnable = runnable
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    @property
+    def InputType(self) -> Any:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Any:
+        return self.runnable.OutputType
+
+    @staticmethod
+    def get_key(input: Any) -> str:
+        return hashlib.sha256(json.dumps(input, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _enter(self, key: str, wait_async: bool = False) -> Optional[Union[threading.Event, asyncio.Future]]:
+        """
+        Register the call as in flight
+        :param key: The call key
+        :param wait_async: If True, the call waits for the in-flight call with a future of the running loop
+        :return: None if the call is the owner of the key, otherwise the event (or future) of the in-flight call to
+        wait for
+        """
+        with self.lock:
+            if key in self.in_flight:
+                return self.in_flight[key].add_waiter() if wait_async else self.in_flight[key].event
+            self.in_flight[key] = InFlightCall()
+            return None
+
+    def _exit(self, key: str):
+        with self.lock:
+            self.in_flight.pop(key).set()
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        key = self.get_key(input)
+        while (event := self._enter(key)) is not None:
+            event.wait()
+        try:
+            return self.runnable.invoke(input, config, **kwargs)
+        finally:
+            self._exit(key)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        key = self.get_key(input)
+        while (future := self._enter(key, wait_async=True)) is not None:
+            await future
+        try:
+            return await self.runnable.ainvoke(input, config, **kwargs)
+        finally:
+            self._exit(key)
@@ -0,0 +1,87 @@
+import atexit
+import json
+import os
+import threading
+from typing import Any, Callable
+import httpx
+from simulator.healthcare_analytics import ExceptionEvent, track_event
+from simulator.utils.runtime import get_runtime, is_runtime_started
+
+# The default connection pool of the http clients, can be set per llm with the 'http_pool' config
+DEFAULT_HTTP_POOL = {'max_connections': 100, 'max_keepalive_connections': 100, 'keepalive_expiry': 60}
+
+# Process-wide llms, keyed by their normalized config
+_LLMS = {}
+_HTTP_CLIENTS = []
+# Reentrant, the factories of the composite llms (replay, cascade) get their inner llms from the registry
+_registry_lock = threading.RLock()
+_registry_pid = os.getpid()
+
+
+def get_llm_key(config: dict, timeout: float) -> str:
+    """
+    The registry key of an llm config, the equivalent configs have the same key
+    """
+    config = dict(config, type=config['type'].lower())
+    return json.dumps({'config': config, 'timeout': timeout}, sort_keys=True, default=str)
+
+
+def get_http_clients(config: dict, timeout: float) -> dict:
+    """
+    Create the (sync and async) http clients of an llm, with a connection pool sized by config['http_pool']
+    :param config: The llm config
+    :param timeout: The requests timeout (in seconds)
+    :return: The clients, as the http_client and http_async_client arguments of the openai models
+    """
+    pool = dict(DEFAULT_HTTP_POOL, **config.get('http_pool', {}))
+    limits = httpx.Limits(**pool)
+    http_client = httpx.Client(limits=limits, timeout=timeout)
+    http_async_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+    _HTTP_CLIENTS.extend([http_client, http_async_client])
+    return {'http_client': http_client, 'http_async_client': http_async_client}
+
+
+def get_or_create_llm(config: dict, timeout: float, create_llm: Callable[[dict, float], Any]) -> Any:
+    """
+    Get the process-wide llm of a config, creating it on first use
+    :param config: The llm config
+    :param timeout: The requests timeout (in seconds)
+    :param create_llm: The llm factory, called as create_llm(config, timeout)
+    :return: The shared llm
+    """
+    global _registry_pid
+    key = get_llm_key(config, timeout)
+    with _registry_lock:
+        if _registry_pid != os.getpid():
+            # A forked process does not share the connections of its parent
+            _LLMS.clear()
+            _HTTP_CLIENTS.clear()
+            _registry_pid = os.getpid()
+        if key not in _LLMS:
+            _LLMS[key] = create_llm(config, timeout)
+        return _LLMS[key]
+
+
+def shutdown_llm_clients():
+    """
+    Close the http clients of the registered llms
+    """
+    with _registry_lock:
+        if _registry_pid != os.getpid():
+            return
+        for client in _HTTP_CLIENTS:
+            try:
+                if isinstance(client, httpx.AsyncClient):
+                    # The async clients are bound to the runtime loop
+                    if is_runtime_started():
+                        get_runtime().run(client.aclose(), timeout=10)
+                else:
+                    client.close()
+            except Exception as e:
+                track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                           error_message=f"Failed to close an http client: {e}"))
+        _HTTP_CLIENTS.clear()
+        _LLMS.clear()
+
+
+atexit.register(shutdown_llm_clients)
@@ -1,27 +1,57 @@
-from langchain import hub
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.runnables.base import Runnable
 import importlib
 import os
 import sys
-from langchain_community.callbacks import get_openai_callback
-from langchain_community.callbacks.manager import get_bedrock_anthropic_callback
-from langchain_openai import ChatOpenAI
-from langchain_community.llms import HuggingFacePipeline
-from langchain_openai.chat_models import AzureChatOpenAI
+import threading
+from typing import TYPE_CHECKING, Any, Callable
 from langchain_core.prompts import ChatPromptTemplate
 import yaml
 from simulator.healthcare_analytics import ExceptionEvent, track_event
+from simulator.utils.logger_config import get_logger, ConsoleColor
+from simulator.utils.rate_limiter import get_rate_limiter, with_rate_limit
+from simulator.utils.llm_cache import get_response_cache, ResponseCache, SingleFlightRunnable
+from simulator.utils.prompt_cache import pull_prompt
+from simulator.utils.llm_clients import get_or_create_llm, get_http_clients
+from simulator.utils.prompt_caching import set_prompt_caching, with_prompt_caching
+from simulator.utils.structured_output import with_structured_output_repair
 from langchain_core.messages import HumanMessage, AIMessage
-import pandas as pd
 
-LLM_ENV = yaml.safe_load(open('config/llm_env.yml', 'r'))
+if TYPE_CHECKING:
+    import pandas as pd
+
+# The providers credentials file, loaded on first use (see get_llm_env)
+LLM_ENV_PATH = os.environ.get('LLM_ENV_PATH', os.path.join('config', 'llm_env.yml'))
+_llm_env = None
+_llm_env_lock = threading.Lock()
+
+
+def get_llm_env() -> dict:
+    """
+    Get the providers credentials, loaded from LLM_ENV_PATH on first use
+    """
+    global _llm_env
+    with _llm_env_lock:
+        if _llm_env is None:
+            with open(LLM_ENV_PATH, 'r') as file:
+                _llm_env = yaml.safe_load(file)
+        return _llm_env
+
+
+def set_llm_env_path(path: str):
+    """
+    Set the providers credentials file, it is loaded on the next use
+    """
+    global LLM_ENV_PATH, _llm_env
+    with _llm_env_lock:
+        LLM_ENV_PATH = path
+        _llm_env = None
 
 
 def get_prompt_template(args: dict) -> ChatPromptTemplate:
     if "prompt_hub_name" in args:
         hub_key = args.get("prompt_hub_key", None)
-        return hub.pull(args["prompt_hub_name"], api_key=hub_key)
+        return pull_prompt(args["prompt_hub_name"], api_key=hub_key)
     elif "prompt" in args:
         return args["prompt"]
     elif 'from_str' in args:
@@ -47,30 +77,36 @@ def convert_messages_to_str(messages: list, with_tools=False) -> str:
     """
     Convert a list of (langchain) messages to a string
     """
+    return ''.join(convert_message_to_str(msg, with_tools) for msg in messages)
+
+
+def convert_message_to_str(msg, with_tools=False) -> str:
+    """
+    Convert a single (langchain) message to its lines in the conversation string
+    """
+    if msg.type == 'system':
+        return ''
     formatted_string = ''
-    for msg in messages:
-        if msg.type == 'system':
-            continue
-        if hasattr(msg, 'tool_calls'):
-            if with_tools:
-                for tool_call in msg.tool_calls:
-                    formatted_string += f"chatbot calling function: {tool_call['name']}, with args: {str(tool_call['args'])}\n"
-            if msg.content == '':
-                continue
-        if msg.type == 'tool':
-            if with_tools:
-                formatted_string += f"chatbot tool_response: {msg.content}\n"
-            continue
-
-        if isinstance(msg.content, list):
-            if (not msg.content) or ('text' not in msg.content[0].keys()):
-                continue
-            msg_content = msg.content[0]['text']
-        else:
-            msg_content = msg.content
-        msg_content = msg_content.rstrip('\n')
+    if hasattr(msg, 'tool_calls'):
+        if with_tools:
+            for tool_call in msg.tool_calls:
+                formatted_string += f"chatbot calling function: {tool_call['name']}, with args: {str(tool_call['args'])}\n"
+        if msg.content == '':
+            return formatted_string
+    if msg.type == 'tool':
+        if with_tools:
+            formatted_string += f"chatbot tool_response: {msg.content}\n"
+        return formatted_string
+
+    if isinstance(msg.content, list):
+        if (not msg.content) or ('text' not in msg.content[0].keys()):
+            return formatted_string
+        msg_content = msg.content[0]['text']
+    else:
+        msg_content = msg.content
+    msg_content = msg_content.rstrip('\n')
 
-        formatted_string += f"{'user' if isinstance(msg, HumanMessage) else 'chatbot'}: {msg_content}\n"
+    formatted_string += f"{'user' if isinstance(msg, HumanMessage) else 'chatbot'}: {msg_content}\n"
     return formatted_string
 
 
@@ -84,7 +120,7 @@ def dict_to_str(d: dict, mode='items') -> str:
     return final_str
 
 
-def data_to_str(data: dict[pd.DataFrame]):
+def data_to_str(data: 'dict[pd.DataFrame]'):
     return '\n'.join([f"## Table: {name}\n ### Table information:\n{df.to_json(orient='records', lines=True)}" for
                       name, df in data.items()])
 
@@ -92,12 +128,21 @@ def data_to_str(data: dict[pd.DataFrame]):
 def set_llm_chain(llm: BaseChatModel, **kwargs) -> Runnable:
     """
     Initialize a chain
+    The prompt variables listed in kwargs['static_variables'] have the same value in all the calls, they are part of
+    the static prompt prefix when the prompt caching of the llm is enabled
     """
     system_prompt_template = get_prompt_template(kwargs)
+    system_prompt_template = with_prompt_caching(system_prompt_template, llm, kwargs.get('static_variables', ()))
     if "structure" in kwargs:
-        return system_prompt_template | llm.with_structured_output(kwargs["structure"])
+        # The outputs that fail to parse are repaired locally, then by a re-prompt (unless kwargs['reprompt'] is False)
+        structured_llm = with_structured_output_repair(llm, kwargs["structure"], reprompt=kwargs.get('reprompt', True))
+        chain = system_prompt_template | with_rate_limit(llm, structured_llm)
     else:
-        return system_prompt_template | llm
+        chain = system_prompt_template | with_rate_limit(llm)
+    if isinstance(getattr(llm, 'cache', None), ResponseCache):
+        # The identical concurrent calls wait for the first one, and are then served by the cache
+        chain = SingleFlightRunnable(chain)
+    return chain
 
 
 def load_tools(tools_path: str):
@@ -195,10 +240,18 @@ def get_dummy_callback():
 
 
 def set_callback(llm_type):
-    if llm_type.lower() == 'openai' or llm_type.lower() == 'azure':
-        callback = get_openai_callback
+    if llm_type.lower() in ('openai', 'azure', 'replay', 'cascade'):
+        # The replayed responses keep their recorded usage, so a replay reports the cost of the recorded run. The
+        # calls of a cascade are counted by the callback of its inner models
+        from simulator.utils.usage_callbacks import get_openai_cache_callback
+        callback = get_openai_cache_callback
     elif llm_type.lower() == 'anthropic_bedrock':
+        from langchain_community.callbacks.manager import get_bedrock_anthropic_callback
         callback = get_bedrock_anthropic_callback
+    elif llm_type.lower() in ('anthropic', 'anthropic_vertex'):
+        # Only the tokens (including the prompt cache usage) are counted
+        from simulator.utils.usage_callbacks import get_usage_callback
+        callback = get_usage_callback
     else:
         callback = get_dummy_callback
     return callback
@@ -229,7 +282,37 @@ def load_yaml_content(yaml_content: str) -> dict:
 
 def get_llm(config: dict, timeout=60):
     """
-    Returns the LLM model
+    Returns the LLM model, the equivalent configs share the same model (and its connection pool)
+    :param config: dictionary with the configuration
+    :return: The llm model
+    """
+    return get_or_create_llm(config, timeout, create_llm)
+
+
+def create_llm(config: dict, timeout=60):
+    """
+    Create a new LLM model, with its rate limiter and response cache
+    :param config: dictionary with the configuration
+    :return: The llm model
+    """
+    llm = init_llm(config, timeout=timeout)
+    rate_limiter = get_rate_limiter(config)
+    if rate_limiter is not None and isinstance(llm, BaseChatModel):
+        # The requests budget is enforced by the model, shared with all the other models of the same provider/name
+        llm.rate_limiter = rate_limiter
+    cache = get_response_cache(config)
+    if cache is not None and isinstance(llm, BaseChatModel):
+        # The responses are cached on disk, keyed by the model parameters and the rendered messages
+        llm.cache = cache
+    if isinstance(llm, BaseChatModel):
+        # The chains send the static part of their prompts first, marked for the provider prompt cache
+        set_prompt_caching(llm, config)
+    return llm
+
+
+def init_llm(config: dict, timeout=60):
+    """
+    Initialize a new LLM model
     :param config: dictionary with the configuration
     :return: The llm model
     """
@@ -241,67 +324,165 @@ def get_llm(config: dict, timeout=60):
         model_kwargs = config['model_kwargs']
     else:
         model_kwargs = {}
-
-    if config['type'].lower() == 'openai':
-        if LLM_ENV['openai']['OPENAI_ORGANIZATION'] == '':
-            return ChatOpenAI(temperature=temperature, model_name=config['name'],
-                              openai_api_key=config.get('openai_api_key', LLM_ENV['openai']['OPENAI_API_KEY']),
-                              openai_api_base=config.get('openai_api_base', 'https://api.openai.com/v1'),
-                              model_kwargs=model_kwargs, timeout=timeout)
-        else:
-            return ChatOpenAI(temperature=temperature, model_name=config['name'],
-                              openai_api_key=config.get('openai_api_key', LLM_ENV['openai']['OPENAI_API_KEY']),
-                              openai_api_base=config.get('openai_api_base', 'https://api.openai.com/v1'),
-                              openai_organization=config.get('openai_organization',
-                                                             LLM_ENV['openai']['OPENAI_ORGANIZATION']),
-                              model_kwargs=model_kwargs, timeout=timeout)
-    elif config['type'].lower() == 'azure':
-        return AzureChatOpenAI(temperature=temperature, azure_deployment=config['name'],
-                               openai_api_key=config.get('openai_api_key', LLM_ENV['azure']['AZURE_OPENAI_API_KEY']),
-                               azure_endpoint=config.get('azure_endpoint', LLM_ENV['azure']['AZURE_OPENAI_ENDPOINT']),
-                               openai_api_version=config.get('openai_api_version',
-                                                             LLM_ENV['azure']['OPENAI_API_VERSION']),
-                               timeout=timeout)
-
-    elif config['type'].lower() == 'google':
-        from langchain_google_genai import ChatGoogleGenerativeAI
-        return ChatGoogleGenerativeAI(temperature=temperature, model=config['name'],
-                                      google_api_key=LLM_ENV['google']['GOOGLE_API_KEY'],
-                                      model_kwargs=model_kwargs, timeout=timeout)
-    elif config['type'].lower() == 'oracle':
-        from langchain_community.chat_models.oci_generative_ai import ChatOCIGenAI
-        if not "max_tokens" in model_kwargs:
-            model_kwargs['max_tokens'] = 4000
-        return ChatOCIGenAI(
+    init_provider = LLM_PROVIDERS.get(config['type'].lower(), None)
+    if init_provider is None:
+        raise NotImplementedError("LLM not implemented")
+    return init_provider(config, temperature, model_kwargs, timeout)
+
+
+# The providers are imported when their first model is created, each provider function is called as
+# init_provider(config, temperature, model_kwargs, timeout)
+def init_openai(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from langchain_openai import ChatOpenAI
+    llm_env = get_llm_env()
+    if llm_env['openai']['OPENAI_ORGANIZATION'] == '':
+        return ChatOpenAI(temperature=temperature, model_name=config['name'],
+                          openai_api_key=config.get('openai_api_key', llm_env['openai']['OPENAI_API_KEY']),
+                          openai_api_base=config.get('openai_api_base', 'https://api.openai.com/v1'),
+                          model_kwargs=model_kwargs, timeout=timeout, **get_http_clients(config, timeout))
+    else:
+        return ChatOpenAI(temperature=temperature, model_name=config['name'],
+                          openai_api_key=config.get('openai_api_key', llm_env['openai']['OPENAI_API_KEY']),
+                          openai_api_base=config.get('openai_api_base', 'https://api.openai.com/v1'),
+                          openai_organization=config.get('openai_organization',
+                                                         llm_env['openai']['OPENAI_ORGANIZATION']),
+                          model_kwargs=model_kwargs, timeout=timeout, **get_http_clients(config, timeout))
+
+
+def init_azure(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from langchain_openai.chat_models import AzureChatOpenAI
+    llm_env = get_llm_env()
+    return AzureChatOpenAI(temperature=temperature, azure_deployment=config['name'],
+                           openai_api_key=config.get('openai_api_key', llm_env['azure']['AZURE_OPENAI_API_KEY']),
+                           azure_endpoint=config.get('azure_endpoint', llm_env['azure']['AZURE_OPENAI_ENDPOINT']),
+                           openai_api_version=config.get('openai_api_version',
+                                                         llm_env['azure']['OPENAI_API_VERSION']),
+                           timeout=timeout, **get_http_clients(config, timeout))
+
+
+def init_google(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(temperature=temperature, model=config['name'],
+                                  google_api_key=get_llm_env()['google']['GOOGLE_API_KEY'],
+                                  model_kwargs=model_kwargs, timeout=timeout)
+
+
+def init_oracle(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from langchain_community.chat_models.oci_generative_ai import ChatOCIGenAI
+    llm_env = get_llm_env()
+    if not "max_tokens" in model_kwargs:
+        model_kwargs['max_tokens'] = 4000
+    return ChatOCIGenAI(
+        model_id=config['name'],
+        service_endpoint=llm_env['oracle']['SERVICE_ENDPOINT'],
+        compartment_id=llm_env['oracle']['COMPARTMENT_ID'],
+        model_kwargs=model_kwargs,
+    )
+
+
+def init_anthropic_vertex(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from langchain_google_vertexai.model_garden import ChatAnthropicVertex
+    llm_env = get_llm_env()
+    return ChatAnthropicVertex(temperature=temperature, model=config['name'],
+                               project=llm_env['anthropic_vertex']['PROJECT_ID'],
+                               location=llm_env['anthropic_vertex']['REGION'],
+                               model_kwargs=model_kwargs, timeout=timeout)
+
+
+def init_anthropic(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from langchain_anthropic import ChatAnthropic
+    return ChatAnthropic(temperature=temperature, model=config['name'],
+                         anthropic_api_key=get_llm_env()['anthropic']['ANTHROPIC_KEY'],
+                         model_kwargs=model_kwargs, timeout=timeout)
+
+
+def init_huggingface_pipeline(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from langchain_community.llms import HuggingFacePipeline
+    device = config.get('gpu_device', -1)
+    device_map = config.get('device_map', None)
+    if 'prefix_cache' in config:
+        # The past key values of the shared prompt prefixes are reused across turns and dialogs
+        from simulator.utils.prefix_cache import PrefixCachedHuggingFacePipeline
+        if 'batching' in config:
+            # The prefix cache encodes the prompts one at a time, it takes precedence over the batching
+            get_logger().warning(f"{ConsoleColor.YELLOW}Both prefix_cache and batching are set for the model "
+                                 f"{config['name']}, the prefix cache is used and batching is ignored"
+                                 f"{ConsoleColor.RESET}")
+        prefix_cache = config['prefix_cache']
+        return PrefixCachedHuggingFacePipeline.from_model_id(
             model_id=config['name'],
-            service_endpoint=LLM_ENV['oracle']['SERVICE_ENDPOINT'],
-            compartment_id=LLM_ENV['oracle']['COMPARTMENT_ID'],
-            model_kwargs=model_kwargs,
+            task="text-generation",
+            pipeline_kwargs={"max_new_tokens": config['max_new_tokens']},
+            device=device,
+            device_map=device_map,
+            max_memory_mb=prefix_cache.get('max_memory_mb', 2048),
+            min_prefix_tokens=prefix_cache.get('min_prefix_tokens', 32)
         )
-
-    elif config['type'].lower() == 'anthropic_vertex':
-        from langchain_google_vertexai.model_garden import ChatAnthropicVertex
-        return ChatAnthropicVertex(temperature=temperature, model=config['name'],
-                                   project=LLM_ENV['anthropic_vertex']['PROJECT_ID'],
-                                   location=LLM_ENV['anthropic_vertex']['REGION'],
-                                   model_kwargs=model_kwargs, timeout=timeout)
-
-    elif config['type'].lower() == 'anthropic':
-        from langchain_anthropic import ChatAnthropic
-        return ChatAnthropic(temperature=temperature, model=config['name'],
-                             anthropic_api_key=LLM_ENV['anthropic']['ANTHROPIC_KEY'],
-                             model_kwargs=model_kwargs, timeout=timeout)
-
-    elif config['type'].lower() == 'huggingfacepipeline':
-        device = config.get('gpu_device', -1)
-        device_map = config.get('device_map', None)
-
-        return HuggingFacePipeline.from_model_id(
+    if 'batching' in config:
+        # The concurrent calls are merged into batches of up to max_batch_size prompts
+        from simulator.utils.local_batching import BatchedHuggingFacePipeline
+        batching = config['batching']
+        max_batch_size = batching.get('max_batch_size', 8)
+        return BatchedHuggingFacePipeline.from_model_id(
             model_id=config['name'],
             task="text-generation",
             pipeline_kwargs={"max_new_tokens": config['max_new_tokens']},
             device=device,
-            device_map=device_map
+            device_map=device_map,
+            batch_size=max_batch_size,
+            max_batch_size=max_batch_size,
+            max_wait=batching.get('max_wait', 0.02)
         )
-    else:
-        raise NotImplementedError("LLM not implemented")
+
+    return HuggingFacePipeline.from_model_id(
+        model_id=config['name'],
+        task="text-generation",
+        pipeline_kwargs={"max_new_tokens": config['max_new_tokens']},
+        device=device,
+        device_map=device_map
+    )
+
+
+def init_replay(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from simulator.utils.cassette import CassetteChatModel, get_cassette
+    cassette_config = config.get('cassette', {})
+    # The inner model is only called when recording (or on a replay miss with the 'record' policy)
+    inner = get_llm(config['llm'], timeout=timeout) if 'llm' in config else None
+    return CassetteChatModel(cassette=get_cassette(cassette_config.get('path', os.path.join('cache', 'cassette.db'))),
+                             model_name=config.get('name', config.get('llm', {}).get('name', '')),
+                             mode=cassette_config.get('mode', 'replay'),
+                             inner=inner,
+                             latency=cassette_config.get('latency', 0),
+                             latency_scale=cassette_config.get('latency_scale', 1),
+                             miss_policy=cassette_config.get('miss_policy', 'error'))
+
+
+def init_cascade(config: dict, temperature: float, model_kwargs: dict, timeout: float):
+    from simulator.utils.cascade import CascadeChatModel
+    return CascadeChatModel(fast=get_llm(config['fast'], timeout=timeout),
+                            strong=get_llm(config['strong'], timeout=timeout),
+                            cascade_name=config.get('name', f"{config['fast']['name']}->{config['strong']['name']}"),
+                            min_confidence=config.get('min_confidence', 0.7),
+                            agreement_rate=config.get('agreement_rate', 0.05))
+
+
+LLM_PROVIDERS = {
+    'openai': init_openai,
+    'azure': init_azure,
+    'google': init_google,
+    'oracle': init_oracle,
+    'anthropic_vertex': init_anthropic_vertex,
+    'anthropic': init_anthropic,
+    'huggingfacepipeline': init_huggingface_pipeline,
+    'replay': init_replay,
+    'cascade': init_cascade,
+}
+
+
+def register_llm_provider(llm_type: str, init_provider: Callable[[dict, float, dict, float], Any]):
+    """
+    Register a new llm provider, usable with config['type'] = llm_type
+    :param llm_type: The provider type
+    :param init_provider: The model factory, called as init_provider(config, temperature, model_kwargs, timeout)
+    """
+    LLM_PROVIDERS[llm_type.lower()] = init_provider
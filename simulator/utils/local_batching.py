@@ -0,0 +1,132 @@
+import asyncio
+import concurrent.futures
+import json
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Optional
+from langchain_community.llms import HuggingFacePipeline
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.outputs import Generation, LLMResult
+from pydantic import PrivateAttr
+from simulator.healthcare_analytics import ExceptionEvent, track_event
+
+
+class BatchingEngine:
+    """
+    Collects the concurrent generation requests of a local model and runs them as batches.
+    A batch is closed when it reaches max_batch_size or max_wait seconds after its first request. The requests of a
+    batch with different generation arguments are run as separate batches.
+    """
+
+    def __init__(self, generate_batch: Callable[[list[str], dict], list[str]], max_batch_size: int = 8,
+                 max_wait: float = 0.02):
+        """
+        :param generate_batch: The batch generation function, called as generate_batch(prompts, kwargs)
+        :param max_batch_size: The maximal number of prompts in a batch
+        :param max_wait: The maximal time (in seconds) a request waits for the batch to fill
+        """
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        self.num_batches = 0
+        self.num_requests = 0
+
+    def submit(self, prompt: str, kwargs: Optional[dict] = None) -> concurrent.futures.Future:
+        """
+        Submit a generation request
+        :param prompt: The prompt
+        :param kwargs: The generation arguments
+        :return: A future of the generated text
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((prompt, kwargs or {}, future))
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+        return future
+
+    def _next_batch(self) -> list[tuple]:
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            groups = {}
+            for prompt, kwargs, future in self._next_batch():
+                key = json.dumps(kwargs, sort_keys=True, default=str)
+                groups.setdefault(key, (kwargs, []))[1].append((prompt, future))
+            for kwargs, requests in groups.values():
+                self._run_batch(kwargs, requests)
+
+    def _run_batch(self, kwargs: dict, requests: list[tuple]):
+        requests = [(prompt, future) for prompt, future in requests if future.set_running_or_notify_cancel()]
+        if not requests:
+            return
+        self.num_batches += 1
+        self.num_requests += len(requests)
+        try:
+            texts = self.generate_batch([prompt for prompt, _ in requests], kwargs)
+        except Exception as e:
+            track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                       error_message=f"Local model batch generation failed: {e}"))
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        for (_, future), text in zip(requests, texts):
+            future.set_result(text)
+
+    def stats(self) -> dict:
+        return {'batches': self.num_batches, 'requests': self.num_requests,
+                'mean_batch_size': self.num_requests / self.num_batches if self.num_batches else 0}
+
+
+class BatchedHuggingFacePipeline(HuggingFacePipeline):
+    """
+    A HuggingFace pipeline whose concurrent calls (from the worker threads or the async tasks) are merged into padded
+    batches by a BatchingEngine
+    """
+    max_batch_size: int = 8
+    max_wait: float = 0.02  # in seconds
+
+    _engine: Optional[BatchingEngine] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        tokenizer = getattr(self.pipeline, 'tokenizer', None)
+        if tokenizer is not None and self.pipeline.task == 'text-generation':
+            # The decoder-only models are padded on the left, so the generation continues the prompts
+            tokenizer.padding_side = 'left'
+        self._engine = BatchingEngine(self._generate_batch, max_batch_size=self.max_batch_size,
+                                      max_wait=self.max_wait)
+
+    def _generate_batch(self, prompts: list[str], kwargs: dict) -> list[str]:
+        result = HuggingFacePipeline._generate(self, prompts, **kwargs)
+        return [generations[0].text for generations in result.generations]
+
+    def _generate(self, prompts: List[str], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> LLMResult:
+        futures = [self._engine.submit(prompt, kwargs) for prompt in prompts]
+        return LLMResult(generations=[[Generation(text=future.result())] for future in futures])
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> LLMResult:
+        futures = [asyncio.wrap_future(self._engine.submit(prompt, kwargs)) for prompt in prompts]
+        texts = await asyncio.gather(*futures)
+        return LLMResult(generations=[[Generation(text=text)] for text in texts])
+
+    def stats(self) -> dict:
+        return self._engine.stats()
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, asdict
+from typing import Optional
+import numpy as np
+
+# The latency buckets (in seconds) of the exported histograms
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+
+@dataclass
+class CallRecord:
+    """
+    The record of a single sample of a batch (including its retries)
+    """
+    stage: str
+    index: int
+    start_time: float  # Unix time at which the sample was admitted
+    end_time: float  # Unix time at which the sample ended
+    queue_wait: float  # The time (in seconds) the sample waited for a worker
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0  # The input tokens served from the provider prompt cache
+    cost: float = 0
+    retries: int = 0
+    timeout: bool = False
+    error_type: Optional[str] = None
+
+    @property
+    def latency(self) -> float:
+        return self.end_time - self.start_time
+
+
+def get_callbacks_tokens(callbacks: list) -> tuple[int, int, int]:
+    """
+    The (input, output, cached input) tokens counted by usage callbacks (0 for the callbacks that do not count tokens)
+    """
+    return (sum(getattr(cb, 'prompt_tokens', 0) for cb in callbacks),
+            sum(getattr(cb, 'completion_tokens', 0) for cb in callbacks),
+            sum(getattr(cb, 'cached_tokens', 0) for cb in callbacks))
+
+
+class MetricsCollector:
+    """
+    Collects the call records of all the batches of the process, and aggregates them by stage
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def record(self, call: CallRecord):
+        with self.lock:
+            self.calls.append(call)
+
+    def extend(self, calls: list[CallRecord]):
+        with self.lock:
+            self.calls.extend(calls)
+
+    def get_stages(self) -> dict[str, list[CallRecord]]:
+        stages = {}
+        with self.lock:
+            for call in self.calls:
+                stages.setdefault(call.stage, []).append(call)
+        return stages
+
+    def summary(self) -> dict:
+        """
+        Aggregate the records by stage
+        :return: {stage: {latency percentiles, throughput, tokens/sec, errors...}}
+        """
+        summary = {}
+        for stage, calls in self.get_stages().items():
+            latencies = np.array([call.latency for call in calls])
+            queue_waits = np.array([call.queue_wait for call in calls])
+            duration = max(call.end_time for call in calls) - min(call.start_time for call in calls)
+            input_tokens = sum(call.input_tokens for call in calls)
+            output_tokens = sum(call.output_tokens for call in calls)
+            cached_tokens = sum(call.cached_tokens for call in calls)
+            errors = {}
+            for call in calls:
+                if call.error_type is not None:
+                    errors[call.error_type] = errors.get(call.error_type, 0) + 1
+            summary[stage] = {
+                'calls': len(calls),
+                'errors': errors,
+                'retries': sum(call.retries for call in calls),
+                'timeouts': sum(call.timeout for call in calls),
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p90': float(np.percentile(latencies, 90)),
+                'latency_p99': float(np.percentile(latencies, 99)),
+                'latency_max': float(latencies.max()),
+                'queue_wait_p50': float(np.percentile(queue_waits, 50)),
+                'queue_wait_p99': float(np.percentile(queue_waits, 99)),
+                'duration': duration,
+                'throughput': len(calls) / duration if duration > 0 else 0,  # calls per second
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'cached_tokens': cached_tokens,
+                'cache_hit_rate': cached_tokens / input_tokens if input_tokens > 0 else 0,
+                'tokens_per_sec': (input_tokens + output_tokens) / duration if duration > 0 else 0,
+                'cost': sum(call.cost for call in calls),
+            }
+        return summary
+
+    def to_prometheus(self, extra_gauges: dict = None) -> str:
+        """
+        Export the metrics in the Prometheus text format
+        :param extra_gauges: Additional gauges {name: {stage: value}}
+        :return: The metrics text
+        """
+        lines = ['# HELP simulator_call_latency_seconds The latency of the samples (including retries)',
+                 '# TYPE simulator_call_latency_seconds histogram']
+        stages = self.get_stages()
+        for stage, calls in stages.items():
+            latencies = np.array([call.latency for call in calls])
+            for bucket in LATENCY_BUCKETS:
+                lines.append(f'simulator_call_latency_seconds_bucket{{stage="{stage}",le="{bucket}"}} '
+                             f'{int((latencies <= bucket).sum())}')
+            lines.append(f'simulator_call_latency_seconds_bucket{{stage="{stage}",le="+Inf"}} {len(calls)}')
+            lines.append(f'simulator_call_latency_seconds_sum{{stage="{stage}"}} {latencies.sum()}')
+            lines.append(f'simulator_call_latency_seconds_count{{stage="{stage}"}} {len(calls)}')
+        lines += ['# HELP simulator_queue_wait_seconds_total The time the samples waited for a worker',
+                  '# TYPE simulator_queue_wait_seconds_total counter']
+        for stage, calls in stages.items():
+            lines.append(f'simulator_queue_wait_seconds_total{{stage="{stage}"}} '
+                         f'{sum(call.queue_wait for call in calls)}')
+        lines += ['# HELP simulator_calls_total The number of samples by outcome',
+                  '# TYPE simulator_calls_total counter']
+        for stage, calls in stages.items():
+            outcomes = {}
+            for call in calls:
+                outcome = call.error_type if call.error_type is not None else 'success'
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            for outcome, count in outcomes.items():
+                lines.append(f'simulator_calls_total{{stage="{stage}",outcome="{outcome}"}} {count}')
+        lines += ['# HELP simulator_retries_total The number of retries',
+                  '# TYPE simulator_retries_total counter']
+        for stage, calls in stages.items():
+            lines.append(f'simulator_retries_total{{stage="{stage}"}} {sum(call.retries for call in calls)}')
+        lines += ['# HELP simulator_tokens_total The number of tokens',
+                  '# TYPE simulator_tokens_total counter']
+        for stage, calls in stages.items():
+            lines.append(f'simulator_tokens_total{{stage="{stage}",direction="input"}} '
+                         f'{sum(call.input_tokens for call in calls)}')
+            lines.append(f'simulator_tokens_total{{stage="{stage}",direction="output"}} '
+                         f'{sum(call.output_tokens for call in calls)}')
+            lines.append(f'simulator_tokens_total{{stage="{stage}",direction="cached_input"}} '
+                         f'{sum(call.cached_tokens for call in calls)}')
+        lines += ['# HELP simulator_cost_dollars_total The cost of the samples',
+                  '# TYPE simulator_cost_dollars_total counter']
+        for stage, calls in stages.items():
+            lines.append(f'simulator_cost_dollars_total{{stage="{stage}"}} {sum(call.cost for call in calls)}')
+        for name, values in (extra_gauges or {}).items():
+            lines.append(f'# TYPE {name} gauge')
+            for stage, value in values.items():
+                lines.append(f'{name}{{stage="{stage}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, output_dir: str, extra: dict = None, extra_gauges: dict = None):
+        """
+        Write the metrics to the output folder: metrics.json (the summary by stage), metrics.prom (Prometheus text
+        format) and calls.jsonl (the call records)
+        :param output_dir: The output folder
+        :param extra: Additional information added to metrics.json
+        :param extra_gauges: Additional gauges {name: {stage: value}}
+        """
+        metrics = {'stages': self.summary()}
+        metrics.update(extra or {})
+        with open(os.path.join(output_dir, 'metrics.json'), 'w') as file:
+            json.dump(metrics, file, indent=2)
+        with open(os.path.join(output_dir, 'metrics.prom'), 'w') as file:
+            file.write(self.to_prometheus(extra_gauges))
+        with self.lock:
+            calls = list(self.calls)
+        with open(os.path.join(output_dir, 'calls.jsonl'), 'w') as file:
+            for call in calls:
+                file.write(json.dumps(asdict(call)) + '\n')
+
+
+# The process-wide metrics, recorded by the batch executors
+METRICS = MetricsCollector()
@@ -1,31 +1,45 @@
 from simulator.utils.logger_config import get_logger, ConsoleColor
-from typing import Any
+from typing import Any, AsyncIterator, Iterator
 from langchain_core.callbacks import BaseCallbackHandler
 import contextlib
 from tqdm import trange, tqdm
 import concurrent.futures
 import asyncio
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass
 from simulator.healthcare_analytics import ExceptionEvent, track_event
+from simulator.utils.runtime import get_runtime
+from simulator.utils.budget import CostBudget, get_active_budget
+from simulator.utils.metrics import METRICS, CallRecord, get_callbacks_tokens
 
 
-def batch_invoke(llm_function, inputs: list[Any], num_workers: int, callbacks: list[BaseCallbackHandler]) -> list[Any]:
+def batch_invoke(llm_function, inputs: list[Any], num_workers: int, callbacks: list[BaseCallbackHandler],
+                 retry_policy: 'RetryPolicy' = None, stage: str = 'batch') -> list[Any]:
     """
     Invoke a langchain runnable function in parallel
     :param llm_function: The agent invoking function
     :param inputs: The list of all inputs
     :param num_workers: The number of workers
     :param callbacks: Langchain callbacks list
+    :param retry_policy: The retry policy of failed samples (default: RetryPolicy())
+    :param stage: The name of the stage, used for the metrics
     :return: A list of results
     """
     logger = get_logger()
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
 
     def sample_generator():
         for i, sample in enumerate(inputs):
             yield i, sample
 
-    def process_sample_with_progress(sample):
+    def process_sample(sample):
         i, sample = sample
         error = None
+        error_type = None
         with contextlib.ExitStack() as stack:
             CB = [stack.enter_context(callback()) for callback in callbacks]
             try:
@@ -34,12 +48,40 @@ def batch_invoke(llm_function, inputs: list[Any], num_workers: int, callbacks: l
                 logger.error('Error in chain invoke: {}'.format(e))
                 result = None
                 error = 'Error while running: ' + str(e)
+                error_type = classify_exception(e)
                 track_event(ExceptionEvent(exception_type=type(e).__name__,
                                    error_message=error))
             for cb in CB:
                 accumulate_usage = cb.total_cost
+            input_tokens, output_tokens, cached_tokens = get_callbacks_tokens(CB)
+        return {'index': i, 'result': result, 'usage': accumulate_usage, 'error': error, 'error_type': error_type,
+                'input_tokens': input_tokens, 'output_tokens': output_tokens, 'cached_tokens': cached_tokens}
+
+    def process_sample_with_progress(sample):
+        retries = 0
+        usage = 0
+        input_tokens = output_tokens = cached_tokens = 0
+        start_time = time.time()
+        while True:
+            RETRY_BUDGET.add_call()
+            res = process_sample(sample)
+            usage += res['usage']
+            input_tokens += res['input_tokens']
+            output_tokens += res['output_tokens']
+            cached_tokens += res['cached_tokens']
+            if not retry_policy.should_retry(res['error_type'], retries) or not RETRY_BUDGET.consume():
+                break
+            retries += 1
+            time.sleep(retry_policy.get_delay(retries))
+        res.update({'usage': usage, 'retries': retries})
+        METRICS.record(CallRecord(stage=stage, index=res['index'], start_time=start_time, end_time=time.time(),
+                                  queue_wait=start_time - batch_start_time, input_tokens=input_tokens,
+                                  output_tokens=output_tokens, cached_tokens=cached_tokens, cost=usage,
+                                  retries=retries, error_type=res['error_type']))
         pbar.update(1)  # Update the progress bar
-        return {'index': i, 'result': result, 'usage': accumulate_usage, 'error': error}
+        return res
+
+    batch_start_time = time.time()
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
         with tqdm(total=len(inputs), desc="Processing samples") as pbar:
@@ -49,18 +91,202 @@ def batch_invoke(llm_function, inputs: list[Any], num_workers: int, callbacks: l
     return all_results
 
 
-async def batch_ainvoke(llm_async_function, inputs: list[Any], num_workers: int,
-                        callbacks: list[BaseCallbackHandler], timeout: int = 5) -> list[Any]:
+def classify_exception(e: BaseException) -> str:
     """
-    Invoke a langchain runnable function in parallel
+    Classify an exception raised by a chain invocation
+    :param e: The exception
+    :return: One of 'rate_limit', 'timeout', 'server_error', 'parse_error' or 'other'
+    """
+    name = type(e).__name__
+    status_code = getattr(e, 'status_code', None)
+    if status_code is None and getattr(e, 'response', None) is not None:
+        status_code = getattr(e.response, 'status_code', None)
+    if status_code == 429 or 'RateLimit' in name or 'ResourceExhausted' in name:
+        return 'rate_limit'
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)) or 'Timeout' in name:
+        return 'timeout'
+    if isinstance(status_code, int) and status_code >= 500:
+        return 'server_error'
+    if name in ('InternalServerError', 'ServiceUnavailable', 'APIConnectionError', 'OverloadedError'):
+        return 'server_error'
+    if name in ('OutputParserException', 'ValidationError', 'JSONDecodeError'):
+        return 'parse_error'
+    return 'other'
+
+
+@dataclass
+class RetryPolicy:
+    """
+    The retry policy of the failed samples of a stage: exponential backoff with full jitter
+    """
+    max_attempts: int = 3  # Including the first attempt
+    base_delay: float = 1  # in seconds
+    max_delay: float = 30  # in seconds
+    # Only the transient provider errors are retried by default, retrying the timeouts (a long attempt) and the parse
+    # errors (usually deterministic, and billed again) is enabled in the stage 'retry' config
+    retry_on: tuple = ('rate_limit', 'server_error')
+
+    @classmethod
+    def from_config(cls, config: dict = None) -> 'RetryPolicy':
+        """
+        Create the policy from a stage 'retry' config (None for the default policy)
+        """
+        config = dict(config) if config else {}
+        if 'retry_on' in config:
+            config['retry_on'] = tuple(config['retry_on'])
+        return cls(**config)
+
+    def should_retry(self, error_type: str, retries: int) -> bool:
+        """
+        :param error_type: The error classification of the last attempt (None on success)
+        :param retries: The number of retries done so far
+        """
+        return error_type is not None and error_type in self.retry_on and retries + 1 < self.max_attempts
+
+    def get_delay(self, retry: int) -> float:
+        """
+        The backoff before the retry (1 for the first retry)
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+
+class RetryBudget:
+    """
+    A process-wide budget of retries, allowing min_retries + ratio * (number of calls) retries.
+    This prevents retry storms when a provider is down.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.num_calls = 0
+        self.num_retries = 0
+        self.lock = threading.Lock()
+
+    def add_call(self):
+        with self.lock:
+            self.num_calls += 1
+
+    def consume(self) -> bool:
+        """
+        Consume one retry from the budget
+        :return: False if the budget is exhausted
+        """
+        with self.lock:
+            if self.num_retries >= self.min_retries + self.ratio * self.num_calls:
+                return False
+            self.num_retries += 1
+            return True
+
+
+RETRY_BUDGET = RetryBudget()
+
+
+def set_retry_budget(ratio: float = 0.2, min_retries: int = 10):
+    """
+    Reset the process-wide retry budget
+    """
+    global RETRY_BUDGET
+    RETRY_BUDGET = RetryBudget(ratio=ratio, min_retries=min_retries)
+
+
+# The interval (in seconds) at which the cost budget is checked for the hard limit
+BUDGET_POLL_INTERVAL = 0.5
+
+# The limit each stage settled on in its last batch, used as the starting point of the next batch
+STAGE_CONCURRENCY = {}
+
+
+class AIMDController:
+    """
+    Additive-increase/multiplicative-decrease controller of the number of in-flight tasks.
+    The limit grows by ~1 every full window of healthy completions, and is cut by decrease_factor on
+    rate-limit, timeout or server errors (at most once per window).
+    """
+
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = None, decrease_factor: float = 0.5,
+                 latency_tolerance: float = 2):
+        """
+        :param initial: The initial number of in-flight tasks
+        :param min_limit: The minimal number of in-flight tasks
+        :param max_limit: The maximal number of in-flight tasks (default: initial)
+        :param decrease_factor: The multiplicative factor applied on congestion
+        :param latency_tolerance: Stop growing when the latency exceeds this multiple of the fastest latency seen
+        """
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(initial, max_limit if max_limit is not None else initial)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.min_latency = None
+        self.num_decreases = 0
+        self._epoch = 0  # Incremented on every decrease, tasks started before it do not trigger another decrease
+        self._condition = None
+
+    @property
+    def current_limit(self) -> int:
+        return int(self.limit)
+
+    async def acquire(self) -> int:
+        """
+        Wait until a slot is available
+        :return: The epoch at which the task was admitted
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.current_limit)
+            self.in_flight += 1
+            return self._epoch
+
+    async def release(self, epoch: int, latency: float, error_type: str = None):
+        """
+        Release a slot and update the limit according to the task outcome
+        :param epoch: The epoch returned by acquire
+        :param latency: The task latency (in seconds)
+        :param error_type: The error classification (see classify_exception), None on success
+        """
+        async with self._condition:
+            self.in_flight -= 1
+            if error_type in ('rate_limit', 'timeout', 'server_error'):
+                if epoch == self._epoch:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._epoch += 1
+                    self.num_decreases += 1
+            elif error_type is None:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if latency <= self.min_latency * self.latency_tolerance:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+async def batch_astream(llm_async_function, inputs: list[Any], num_workers: int,
+                        callbacks: list[BaseCallbackHandler], timeout: int = 5, max_workers: int = None,
+                        stage: str = 'batch', ordered: bool = False,
+                        retry_policy: RetryPolicy = None, budget: CostBudget = None) -> AsyncIterator[dict]:
+    """
+    Invoke a langchain runnable function in parallel and yield the results as they complete, adapting the
+    concurrency (AIMD) between num_workers and max_workers according to the provider health
     :param llm_async_function: The agent invoking function
     :param inputs: The list of all inputs
-    :param num_workers: The number of workers
+    :param num_workers: The (initial) number of workers
     :param callbacks: Langchain callbacks list
     :param timeout: The timeout for each task (in seconds)
-    :return: A list of results
+    :param max_workers: The maximal number of workers the concurrency can grow to (default: num_workers)
+    :param stage: The name of the stage, used for logging and to carry the settled concurrency between batches
+    :param ordered: If True, yield the results in the inputs order (each result is yielded as soon as all the
+    previous ones are done)
+    :param retry_policy: The retry policy of failed samples (default: RetryPolicy()), the timeout applies per attempt
+    :param budget: The cost budget to enforce (default: the active budget, see CostBudget.activate). Once the soft
+    limit is reached the remaining samples are not started, once the hard limit is reached the in-flight samples
+    are cancelled. In both cases the sample record has the error type 'budget'.
+    :return: An async iterator over the result records {'index', 'result', 'usage', 'error', 'retries', ...}
     """
     logger = get_logger()
+    retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+    budget = budget if budget is not None else get_active_budget()
     def sample_generator():
         for i, sample in enumerate(inputs):
             yield i, sample
@@ -68,46 +294,309 @@ async def batch_ainvoke(llm_async_function, inputs: list[Any], num_workers: int,
     async def process_sample_with_progress(sample):
         i, sample = sample
         error = None
+        error_type = None
         with contextlib.ExitStack() as stack:
             CB = [stack.enter_context(callback()) for callback in callbacks]
+            if budget is not None:
+                # The budget follows the cost of the sample as each of its llm calls completes
+                stack.callback(budget.finish, budget.start(CB))
             try:
                 result = await llm_async_function(sample)
             except Exception as e:
                 logger.error('Error in chain invoke: {}'.format(e))
                 result = None
                 error = 'Error while running: ' + str(e)
+                error_type = classify_exception(e)
                 track_event(ExceptionEvent(exception_type=type(e).__name__,
                                    error_message=error))
             for cb in CB:
                 accumulate_usage = cb.total_cost
-        return {'index': i, 'result': result, 'usage': accumulate_usage, 'error': error}
+            input_tokens, output_tokens, cached_tokens = get_callbacks_tokens(CB)
+        return {'index': i, 'result': result, 'usage': accumulate_usage, 'error': error, 'error_type': error_type,
+                'input_tokens': input_tokens, 'output_tokens': output_tokens, 'cached_tokens': cached_tokens}
+
+    initial_workers = STAGE_CONCURRENCY.get(stage, num_workers)
+    controller = AIMDController(initial=initial_workers, min_limit=1,
+                                max_limit=max_workers if max_workers is not None else num_workers)
 
-    semaphore = asyncio.Semaphore(num_workers)  # Limit to 2 workers
+    async def process_sample_with_timeout(func_input):
+        try:
+            return await asyncio.wait_for(process_sample_with_progress(func_input), timeout=timeout)
+        except asyncio.TimeoutError as e:
+            print(f"Task reached timeout and was terminated.")
+            error_message = 'Timeout'
+            track_event(ExceptionEvent(exception_type=type(e).__name__,
+                               error_message=error_message))
+            return {'index': func_input[0], 'result': None, 'usage': 0,
+                    'error': error_message, 'error_type': 'timeout', 'input_tokens': 0, 'output_tokens': 0,
+                    'cached_tokens': 0}
+
+    def budget_exhausted_record(func_input, error_message):
+        return {'index': func_input[0], 'result': None, 'usage': 0, 'error': error_message, 'error_type': 'budget',
+                'retries': 0, 'concurrency': controller.current_limit}
+
+    def record_metrics(res, call_stats):
+        now = time.time()
+        METRICS.record(CallRecord(stage=stage, index=res['index'],
+                                  start_time=call_stats.get('start_time', now), end_time=now,
+                                  queue_wait=call_stats['queue_wait'], input_tokens=call_stats['input_tokens'],
+                                  output_tokens=call_stats['output_tokens'],
+                                  cached_tokens=call_stats['cached_tokens'], cost=res['usage'],
+                                  retries=res['retries'], timeout=call_stats['timeout'],
+                                  error_type=res['error_type']))
+
+    # Task runner that acquires a slot from the concurrency controller, and retries failed attempts
+    async def run_task(func_input, call_stats):
+        retries = 0
+        usage = 0
+        while True:
+            wait_start_time = time.monotonic()
+            epoch = await controller.acquire()
+            call_stats['queue_wait'] += time.monotonic() - wait_start_time
+            call_stats.setdefault('start_time', time.time())
+            if budget is not None and budget.soft_exceeded():
+                await controller.release(epoch, 0, 'budget')
+                return budget_exhausted_record(func_input, 'Budget exhausted, the task was not started')
+            start_time = time.monotonic()
+            RETRY_BUDGET.add_call()
+            res = await process_sample_with_timeout(func_input)
+            await controller.release(epoch, time.monotonic() - start_time, res['error_type'])
+            usage += res['usage']
+            call_stats['input_tokens'] += res['input_tokens']
+            call_stats['output_tokens'] += res['output_tokens']
+            call_stats['cached_tokens'] += res['cached_tokens']
+            call_stats['timeout'] |= res['error_type'] == 'timeout'
+            if not retry_policy.should_retry(res['error_type'], retries) or not RETRY_BUDGET.consume():
+                break
+            if budget is not None and budget.soft_exceeded():
+                break
+            retries += 1
+            # The slot is released during the backoff
+            await asyncio.sleep(retry_policy.get_delay(retries))
+        res.update({'usage': usage, 'retries': retries, 'concurrency': controller.current_limit})
+        return res
+
+    hard_stop = asyncio.Event()
 
-    # Task runner that acquires the semaphore
     async def task_runner(func_input):
-        async with semaphore:
-            try:
-                return await asyncio.wait_for(process_sample_with_progress(func_input), timeout=timeout)
-            except asyncio.TimeoutError as e:
-                print(f"Task reached timeout and was terminated.")
-                error_message = 'Timeout'
-                track_event(ExceptionEvent(exception_type=type(e).__name__,
-                                   error_message=error_message))
-                return {'index': func_input[0], 'result': None, 'usage': 0,
-                        'error': 'error_message'}  # Return None or any appropriate value for a failed task
+        call_stats = {'queue_wait': 0, 'input_tokens': 0, 'output_tokens': 0, 'cached_tokens': 0,
+                      'timeout': False}
+        try:
+            res = await run_task(func_input, call_stats)
+        except asyncio.CancelledError:
+            if not hard_stop.is_set():
+                raise
+            res = budget_exhausted_record(func_input, 'Budget exhausted, the task was cancelled')
+        record_metrics(res, call_stats)
+        return res
+
+    async def budget_watchdog():
+        while not budget.hard_exceeded():
+            await asyncio.sleep(BUDGET_POLL_INTERVAL)
+        logger.warning(f"{ConsoleColor.RED}[{stage}] The hard cost limit ({budget.hard_limit}$) is reached, "
+                       f"cancelling the running tasks{ConsoleColor.RESET}")
+        hard_stop.set()
+        for task in tasks:
+            task.cancel()
 
     # Create tasks
-    tasks = [task_runner(func_input) for func_input in sample_generator()]
+    tasks = [asyncio.ensure_future(task_runner(func_input)) for func_input in sample_generator()]
+    watchdog = asyncio.ensure_future(budget_watchdog()) if budget is not None else None
+    pending_results = {}  # Completed results waiting for their turn (ordered mode)
+    next_index = 0
+    try:
+        # Use tqdm to track the progress of tasks
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            result = await task
+            if not ordered:
+                yield result
+                continue
+            pending_results[result['index']] = result
+            while next_index in pending_results:
+                yield pending_results.pop(next_index)
+                next_index += 1
+    finally:
+        # The consumer may stop early, the remaining tasks are not needed anymore
+        for task in tasks:
+            task.cancel()
+        if watchdog is not None:
+            watchdog.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    STAGE_CONCURRENCY[stage] = controller.current_limit
+    logger.info(f"{ConsoleColor.GREY}[{stage}] concurrency settled at {controller.current_limit} "
+                f"(range {controller.min_limit}-{controller.max_limit}, "
+                f"{controller.num_decreases} backoffs){ConsoleColor.RESET}")
+
 
-    # Use tqdm to track the progress of tasks
-    results = []
-    for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
-        result = await task
-        results.append(result)
-    return results
+async def batch_ainvoke(llm_async_function, inputs: list[Any], num_workers: int,
+                        callbacks: list[BaseCallbackHandler], timeout: int = 5, max_workers: int = None,
+                        stage: str = 'batch', retry_policy: RetryPolicy = None) -> list[Any]:
+    """
+    Invoke a langchain runnable function in parallel
+    :param llm_async_function: The agent invoking function
+    :param inputs: The list of all inputs
+    :param num_workers: The (initial) number of workers
+    :param callbacks: Langchain callbacks list
+    :param timeout: The timeout for each task (in seconds)
+    :param max_workers: The maximal number of workers the concurrency can grow to (default: num_workers)
+    :param stage: The name of the stage
+    :param retry_policy: The retry policy of failed samples (default: RetryPolicy())
+    :return: A list of results
+    """
+    return [result async for result in batch_astream(llm_async_function, inputs, num_workers, callbacks, timeout,
+                                                     max_workers=max_workers, stage=stage,
+                                                     retry_policy=retry_policy)]
 
 
 def async_batch_invoke(llm_async_function, inputs: list[Any], num_workers: int,
-                       callbacks: list[BaseCallbackHandler], timeout: int = 5) -> list[Any]:
-    return asyncio.run(batch_ainvoke(llm_async_function, inputs, num_workers, callbacks, timeout))
+                       callbacks: list[BaseCallbackHandler], timeout: int = 5, max_workers: int = None,
+                       stage: str = 'batch', retry_policy: RetryPolicy = None) -> list[Any]:
+    return get_runtime().run(batch_ainvoke(llm_async_function, inputs, num_workers, callbacks, timeout,
+                                           max_workers=max_workers, stage=stage, retry_policy=retry_policy))
+
+
+def async_batch_stream(llm_async_function, inputs: list[Any], num_workers: int,
+                       callbacks: list[BaseCallbackHandler], timeout: int = 5, max_workers: int = None,
+                       stage: str = 'batch', ordered: bool = False,
+                       retry_policy: RetryPolicy = None) -> Iterator[dict]:
+    """
+    A synchronous generator over batch_astream, the results are yielded as soon as they complete.
+    The batch runs on the simulator runtime loop, so it keeps progressing while the consumer handles a result.
+    """
+    return get_runtime().stream(batch_astream(llm_async_function, inputs, num_workers, callbacks, timeout,
+                                              max_workers=max_workers, stage=stage, ordered=ordered,
+                                              retry_policy=retry_policy))
+
+
+def _pool_worker(index: int, init_function, init_args: tuple, tasks_queue, results_queue):
+    """
+    The entry point of a pool process: creates the worker state once, then runs the tasks it receives until it gets
+    None, and sends the generated items to the parent process
+    """
+    state = None
+    init_error = None
+    try:
+        state = init_function(*init_args)
+    except Exception as e:
+        init_error = f"Error while initializing the pool process: {type(e).__name__}: {e}"
+        track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                   error_message=init_error))
+    while True:
+        task = tasks_queue.get()
+        if task is None:
+            break
+        if init_error is not None:
+            results_queue.put((index, 'error', init_error))
+            continue
+        task_function, shard, args = task
+        try:
+            for item in task_function(state, shard, *args):
+                results_queue.put((index, 'item', item))
+            results_queue.put((index, 'done', None))
+        except Exception as e:
+            error_message = f"Error in shard process: {type(e).__name__}: {e}"
+            track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                       error_message=error_message))
+            results_queue.put((index, 'error', error_message))
+    # The spawned processes do not run the atexit handlers, the state is closed explicitly
+    if hasattr(state, 'close'):
+        state.close()
+
+
+class ProcessPool:
+    """
+    A pool of persistent processes. Each process owns its interpreter (and so its GIL), event loop and llm clients,
+    and creates its worker state (e.g. a dialog manager) once, for all the tasks of the run.
+    The processes are spawned (not forked), so the functions must be defined at a module level and their arguments
+    must be picklable.
+    """
+
+    def __init__(self, num_processes: int, init_function, init_args: tuple = ()):
+        """
+        :param num_processes: The number of processes
+        :param init_function: The worker state factory, called as init_function(*init_args) in each process
+        :param init_args: The arguments of the worker state factory
+        """
+        self.num_processes = num_processes
+        self.init_function = init_function
+        self.init_args = init_args
+        self.context = multiprocessing.get_context('spawn')
+        self.results_queue = self.context.Queue()
+        self.tasks_queues = [None] * num_processes
+        self.processes = [None] * num_processes
+        self.closed = False
+        for i in range(num_processes):
+            self._start(i)
+
+    def _start(self, index: int):
+        self.tasks_queues[index] = self.context.Queue()
+        self.processes[index] = self.context.Process(target=_pool_worker,
+                                                     args=(index, self.init_function, self.init_args,
+                                                           self.tasks_queues[index], self.results_queue),
+                                                     daemon=True)
+        self.processes[index].start()
+
+    def stream(self, task_function, shards: list[list[Any]], args: tuple = (),
+               poll_interval: float = 1) -> Iterator[Any]:
+        """
+        Run a task function on each shard in a pool process, yielding the items as soon as they are generated
+        :param task_function: A generator function, called as task_function(worker state, shard, *args)
+        :param shards: The shards of the inputs, at most one per process (the empty shards are skipped)
+        :param args: Additional arguments of the task function (the same for all the shards)
+        :param poll_interval: The interval (in seconds) to check for dead processes while waiting for results
+        :return: An iterator over the items generated by all the shards
+        """
+        if self.closed:
+            raise ValueError("The process pool is closed")
+        if len(shards) > self.num_processes:
+            raise ValueError(f"{len(shards)} shards for a pool of {self.num_processes} processes")
+        logger = get_logger()
+        running = set()
+        for i, shard in enumerate(shards):
+            if not shard:
+                continue
+            if not self.processes[i].is_alive():
+                # The process was killed during a previous task (e.g. out of memory)
+                self._start(i)
+            self.tasks_queues[i].put((task_function, shard, args))
+            running.add(i)
+        try:
+            while running:
+                try:
+                    index, kind, item = self.results_queue.get(timeout=poll_interval)
+                except queue.Empty:
+                    dead = {i for i in running if not self.processes[i].is_alive()}
+                    if dead and self.results_queue.empty():
+                        logger.warning(f"{ConsoleColor.RED}{len(dead)} shard processes exited without completing "
+                                       f"their shard{ConsoleColor.RESET}")
+                        running -= dead
+                    continue
+                if kind == 'item':
+                    yield item
+                    continue
+                running.discard(index)
+                if kind == 'error':
+                    logger.warning(f"{ConsoleColor.RED}{item}{ConsoleColor.RESET}")
+        finally:
+            if running:
+                # The consumer stopped early, the processes still running their shard cannot be reused
+                self.close(timeout=0)
+
+    def close(self, timeout: float = 30):
+        """
+        Stop the processes, they close their worker state first
+        :param timeout: The time (in seconds) the processes have to stop before they are terminated
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for i, process in enumerate(self.processes):
+            if process.is_alive():
+                self.tasks_queues[i].put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.results_queue.close()
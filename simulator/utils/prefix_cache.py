@@ -0,0 +1,179 @@
+import copy
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional
+from langchain_community.llms import HuggingFacePipeline
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.outputs import Generation, LLMResult
+from pydantic import PrivateAttr
+
+# The block size of the token ids comparison
+_COMPARE_BLOCK = 256
+
+
+def get_common_prefix_length(a: list[int], b: list[int]) -> int:
+    """
+    The length of the common prefix of two token ids lists
+    """
+    n = min(len(a), len(b))
+    i = 0
+    # Compare whole blocks first (a slice comparison is much faster than a per-token loop)
+    while i + _COMPARE_BLOCK <= n and a[i:i + _COMPARE_BLOCK] == b[i:i + _COMPARE_BLOCK]:
+        i += _COMPARE_BLOCK
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def get_cache_tensors(past_key_values: Any) -> list:
+    """
+    The key and value tensors of a transformers DynamicCache
+    """
+    if hasattr(past_key_values, 'layers'):
+        # The recent transformers releases, one cache object per layer (its tensors are None until the layer is filled)
+        tensors = [tensor for layer in past_key_values.layers for tensor in (layer.keys, layer.values)]
+    elif hasattr(past_key_values, 'key_cache'):
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    else:
+        # The legacy format, a (key, value) tuple per layer
+        tensors = [tensor for layer in past_key_values for tensor in layer]
+    return [tensor for tensor in tensors if tensor is not None and hasattr(tensor, 'numel')]
+
+
+def get_past_key_values_size(past_key_values: Any) -> int:
+    """
+    The memory size (in bytes) of a transformers DynamicCache
+    """
+    return sum(tensor.numel() * tensor.element_size() for tensor in get_cache_tensors(past_key_values))
+
+
+class PrefixKVCache:
+    """
+    An LRU cache of the past key values of the prompts of a local model.
+    A prompt reuses the cached entry with which it shares the longest prefix (a previous turn of the same dialog, or
+    the static system prompt of another dialog), so only its new tokens are encoded.
+    """
+
+    def __init__(self, max_memory_mb: float = 2048, min_prefix_tokens: int = 32):
+        """
+        :param max_memory_mb: The maximal memory of the cached past key values (in MB)
+        :param min_prefix_tokens: The minimal length of a reused prefix (shorter prefixes are encoded again)
+        """
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.min_prefix_tokens = min_prefix_tokens
+        self.entries = OrderedDict()  # {token ids tuple: (past key values, size)}
+        self.memory = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_reused_tokens = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, input_ids: list[int]) -> tuple[int, Optional[Any]]:
+        """
+        Find the cached past key values of the longest prefix of the input
+        :param input_ids: The token ids of the prompt
+        :return: (prefix length, a copy of the past key values cropped to the prefix), (0, None) if no prefix is cached
+        """
+        with self.lock:
+            best_key, best_length = None, 0
+            for key in self.entries:
+                length = get_common_prefix_length(key, input_ids)
+                if length > best_length:
+                    best_key, best_length = key, length
+            # At least one token of the input is left to encode, the generation starts from its logits
+            best_length = min(best_length, len(input_ids) - 1)
+            if best_key is None or best_length < self.min_prefix_tokens:
+                self.num_misses += 1
+                return 0, None
+            self.entries.move_to_end(best_key)
+            self.num_hits += 1
+            self.num_reused_tokens += best_length
+            past_key_values = copy.deepcopy(self.entries[best_key][0])
+        past_key_values.crop(best_length)
+        return best_length, past_key_values
+
+    def store(self, input_ids: list[int], past_key_values: Any):
+        """
+        Cache the past key values of a prompt (they are owned by the cache)
+        :param input_ids: The token ids of the prompt
+        :param past_key_values: The past key values, cropped to the prompt
+        """
+        if len(input_ids) < self.min_prefix_tokens:
+            return
+        key = tuple(input_ids)
+        size = get_past_key_values_size(past_key_values)
+        if size > self.max_memory:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.memory -= self.entries.pop(key)[1]
+            self.entries[key] = (past_key_values, size)
+            self.memory += size
+            while self.memory > self.max_memory:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.memory -= evicted_size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.num_hits, 'misses': self.num_misses, 'reused_tokens': self.num_reused_tokens,
+                    'entries': len(self.entries), 'memory_mb': self.memory / 1024 / 1024}
+
+
+class PrefixCachedHuggingFacePipeline(HuggingFacePipeline):
+    """
+    A HuggingFace text generation pipeline reusing the past key values of the shared prompt prefixes (see
+    PrefixKVCache). The prompts are generated one at a time, from the cached prefix.
+    """
+    max_memory_mb: float = 2048
+    min_prefix_tokens: int = 32
+
+    _prefix_cache: Optional[PrefixKVCache] = PrivateAttr(default=None)
+    _generate_lock: Optional[Any] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        if self.pipeline.task != 'text-generation':
+            raise ValueError(f"The prefix cache requires a text-generation pipeline, got {self.pipeline.task}")
+        self._prefix_cache = PrefixKVCache(max_memory_mb=self.max_memory_mb,
+                                           min_prefix_tokens=self.min_prefix_tokens)
+        self._generate_lock = threading.Lock()
+
+    def _generate_one(self, prompt: str, pipeline_kwargs: dict) -> str:
+        from transformers import DynamicCache
+        import torch
+        tokenizer = self.pipeline.tokenizer
+        model = self.pipeline.model
+        generate_kwargs = dict(pipeline_kwargs)
+        return_full_text = generate_kwargs.pop('return_full_text', True)
+        input_ids = tokenizer(prompt, return_tensors='pt')['input_ids']
+        prompt_ids = input_ids[0].tolist()
+        prefix_length, past_key_values = self._prefix_cache.lookup(prompt_ids)
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        input_ids = input_ids.to(model.device)
+        with torch.no_grad():
+            output_ids = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                        past_key_values=past_key_values, pad_token_id=tokenizer.pad_token_id,
+                                        **generate_kwargs)
+        # The cache now holds the prompt and the generated tokens, only the prompt is kept
+        past_key_values.crop(len(prompt_ids))
+        self._prefix_cache.store(prompt_ids, past_key_values)
+        text = tokenizer.decode(output_ids[0][len(prompt_ids):], skip_special_tokens=True)
+        return prompt + text if return_full_text else text
+
+    def _generate(self, prompts: List[str], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> LLMResult:
+        pipeline_kwargs = kwargs.get('pipeline_kwargs', self.pipeline_kwargs or {})
+        skip_prompt = kwargs.get('skip_prompt', False)
+        text_generations = []
+        for prompt in prompts:
+            # The model and the cache entries are not shared between concurrent generations
+            with self._generate_lock:
+                text = self._generate_one(prompt, pipeline_kwargs)
+            if skip_prompt:
+                text = text[len(prompt):]
+            text_generations.append(text)
+        return LLMResult(generations=[[Generation(text=text)] for text in text_generations])
+
+    def stats(self) -> dict:
+        return self._prefix_cache.stats()
@@ -0,0 +1,154 @@
+import concurrent.futures
+import os
+import threading
+import time
+import warnings
+from typing import Any, Optional
+from langchain_core.load import dumps, loads
+from simulator.healthcare_analytics import ExceptionEvent, track_event
+from simulator.utils.logger_config import get_logger, ConsoleColor
+
+# The local prompts cache settings, see set_prompt_cache
+_cache_dir = os.path.join('cache', 'prompts')
+_offline = False
+_ttl = 24 * 60 * 60  # in seconds, only for the prompts that are not pinned to a commit
+
+# The prompts pulled by the process, by prompt hub name
+_PROMPTS = {}
+_PROMPT_LOCKS = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def set_prompt_cache(cache_dir: Optional[str] = None, offline: bool = False, ttl: Optional[float] = None):
+    """
+    Configure the local prompts cache
+    :param cache_dir: The cache folder (default: cache/prompts)
+    :param offline: If True, the prompts are only loaded from the cache (no hub request)
+    :param ttl: The time (in seconds) after which a prompt that is not pinned to a commit is pulled again
+    """
+    global _cache_dir, _offline, _ttl
+    if cache_dir is not None:
+        _cache_dir = cache_dir
+    if ttl is not None:
+        _ttl = ttl
+    _offline = offline
+
+
+def get_prompt_cache_settings() -> dict:
+    """
+    The settings of the local prompts cache (the set_prompt_cache arguments)
+    """
+    return {'cache_dir': _cache_dir, 'offline': _offline, 'ttl': _ttl}
+
+
+def get_cache_path(prompt_hub_name: str) -> str:
+    """
+    The cache file of a prompt: <cache_dir>/<owner>/<repo>/<commit>.json (latest.json if not pinned to a commit)
+    """
+    name, _, commit = prompt_hub_name.partition(':')
+    return os.path.join(_cache_dir, *name.split('/'), f"{commit or 'latest'}.json")
+
+
+def _load_cached(path: str) -> Any:
+    with open(path, 'r') as file:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # langchain load is in beta
+            return loads(file.read())
+
+
+def _save_cached(path: str, prompt: Any):
+    try:
+        content = dumps(prompt)
+    except Exception as e:
+        # Not serializable, the prompt is only cached in memory
+        track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                   error_message=f"Failed to cache the prompt: {e}"))
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write(content)
+    os.replace(tmp_path, path)
+
+
+def _get_lock(prompt_hub_name: str) -> threading.Lock:
+    with _REGISTRY_LOCK:
+        return _PROMPT_LOCKS.setdefault(prompt_hub_name, threading.Lock())
+
+
+def pull_prompt(prompt_hub_name: str, api_key: Optional[str] = None) -> Any:
+    """
+    Pull a prompt from the langchain hub through the local cache.
+    The prompts pinned to a commit (owner/repo:commit) never change and are always loaded from the cache once
+    pulled. The other prompts are pulled again after the cache ttl, and the cached version is used if the hub is
+    unreachable. In offline mode the hub is never requested.
+    :param prompt_hub_name: The prompt hub name
+    :param api_key: The hub api key
+    :return: The prompt
+    """
+    with _get_lock(prompt_hub_name):
+        if prompt_hub_name not in _PROMPTS:
+            _PROMPTS[prompt_hub_name] = _pull_prompt(prompt_hub_name, api_key)
+        prompt = _PROMPTS[prompt_hub_name]
+    # The prompts are shared, the callers get their own copy
+    return prompt.model_copy(deep=True) if hasattr(prompt, 'model_copy') else prompt
+
+
+def _pull_prompt(prompt_hub_name: str, api_key: Optional[str] = None) -> Any:
+    path = get_cache_path(prompt_hub_name)
+    is_pinned = ':' in prompt_hub_name
+    if os.path.isfile(path):
+        is_fresh = is_pinned or time.time() - os.path.getmtime(path) < _ttl
+        if is_fresh or _offline:
+            return _load_cached(path)
+    elif _offline:
+        raise ValueError(f"The prompt {prompt_hub_name} is not in the prompts cache ({path}), it must be pulled "
+                         f"once before running offline")
+    try:
+        from langchain import hub
+        prompt = hub.pull(prompt_hub_name, api_key=api_key)
+    except Exception as e:
+        if not os.path.isfile(path):
+            raise
+        logger = get_logger()
+        logger.warning(f"{ConsoleColor.RED}Failed to pull the prompt {prompt_hub_name}, using the cached "
+                       f"version: {e}{ConsoleColor.RESET}")
+        return _load_cached(path)
+    _save_cached(path, prompt)
+    return prompt
+
+
+def collect_prompt_names(config: Any) -> dict[str, Optional[str]]:
+    """
+    Collect the prompt hub names of a config
+    :param config: The config (or any nested part of it)
+    :return: {prompt_hub_name: prompt_hub_key}
+    """
+    prompt_names = {}
+    if isinstance(config, dict):
+        if isinstance(config.get('prompt_hub_name', None), str):
+            prompt_names[config['prompt_hub_name']] = config.get('prompt_hub_key', None)
+        for value in config.values():
+            prompt_names.update(collect_prompt_names(value))
+    elif isinstance(config, list):
+        for value in config:
+            prompt_names.update(collect_prompt_names(value))
+    return prompt_names
+
+
+def prefetch_prompts(prompt_names: dict[str, Optional[str]], num_workers: int = 8):
+    """
+    Pull the prompts in parallel, so they are loaded from memory when the chains are built
+    :param prompt_names: {prompt_hub_name: prompt_hub_key}
+    :param num_workers: The number of parallel requests
+    """
+    logger = get_logger()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(pull_prompt, name, api_key): name for name, api_key in prompt_names.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                # The error is raised again when the prompt is used
+                logger.warning(f"{ConsoleColor.RED}Failed to prefetch the prompt {futures[future]}: "
+                               f"{e}{ConsoleColor.RESET}")
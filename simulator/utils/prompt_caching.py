@@ -0,0 +1,180 @@
+from typing import Any, Optional, Sequence
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.prompts.chat import BaseMessagePromptTemplate, SystemMessagePromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig
+
+# The llm types whose provider caches the prompt prefixes marked with cache_control, the other providers (openai,
+# azure) cache the long prompt prefixes automatically
+CACHE_CONTROL_TYPES = ('anthropic', 'anthropic_vertex')
+CACHE_CONTROL = {'type': 'ephemeral'}
+
+# Replaces the dynamic variables when rendering the static prefix of a message
+_SENTINEL = '\x00'
+
+
+def set_prompt_caching(llm: Any, config: dict):
+    """
+    Enable the provider prompt caching of an llm (by config['prompt_caching']), the chains built by set_llm_chain then
+    send the static part of their prompts first, marked for caching when the provider requires it
+    :param llm: The llm model
+    :param config: The llm config
+    """
+    if not config.get('prompt_caching', False) or not hasattr(llm, 'metadata'):
+        return
+    mode = 'cache_control' if config['type'].lower() in CACHE_CONTROL_TYPES else 'prefix'
+    llm.metadata = dict(llm.metadata or {}, prompt_caching=mode)
+
+
+def get_prompt_caching(llm: Any) -> Optional[str]:
+    """
+    :return: The prompt caching mode of an llm ('cache_control' or 'prefix'), None if disabled
+    """
+    return (getattr(llm, 'metadata', None) or {}).get('prompt_caching', None)
+
+
+def get_partial_values(prompt: ChatPromptTemplate) -> dict:
+    return {key: value() if callable(value) else value for key, value in prompt.partial_variables.items()}
+
+
+def is_string_message(message: Any) -> bool:
+    """
+    Whether a message template is rendered from a single f-string template
+    """
+    return isinstance(message, BaseMessagePromptTemplate) and \
+        isinstance(getattr(message, 'prompt', None), PromptTemplate) and message.prompt.template_format == 'f-string'
+
+
+def is_static_message(message: Any, static_variables: set) -> bool:
+    return is_string_message(message) and set(message.input_variables) <= static_variables
+
+
+def order_static_first(prompt: ChatPromptTemplate, static_variables: Sequence[str] = ()) -> ChatPromptTemplate:
+    """
+    Move the static system messages (the messages with only partial or static variables) before the other system
+    messages at the start of the prompt. The conversation messages are never reordered.
+    :param prompt: The prompt template
+    :param static_variables: The input variables with the same value in all the calls
+    :return: The reordered prompt template
+    """
+    static_variables = set(static_variables) | set(prompt.partial_variables)
+    num_system = 0
+    while num_system < len(prompt.messages) and \
+            isinstance(prompt.messages[num_system], (SystemMessagePromptTemplate, SystemMessage)):
+        num_system += 1
+    system_messages = prompt.messages[:num_system]
+    static_messages = [m for m in system_messages
+                       if isinstance(m, SystemMessage) or is_static_message(m, static_variables)]
+    if not static_messages or len(static_messages) == num_system:
+        return prompt
+    dynamic_messages = [m for m in system_messages if not any(m is s for s in static_messages)]
+    messages = static_messages + dynamic_messages + list(prompt.messages[num_system:])
+    return prompt.model_copy(update={'messages': messages})
+
+
+def get_static_prefixes(prompt: ChatPromptTemplate, values: dict,
+                        static_variables: Sequence[str] = ()) -> list[tuple[str, bool]]:
+    """
+    Render the static prefix of the leading messages of a prompt
+    :param prompt: The prompt template
+    :param values: The input values of the call
+    :param static_variables: The input variables with the same value in all the calls
+    :return: [(static prefix, whether the whole message is static)] of the messages until the first dynamic part
+    """
+    values = dict(get_partial_values(prompt), **values)
+    static_variables = set(static_variables) | set(prompt.partial_variables)
+    prefixes = []
+    for message in prompt.messages:
+        if isinstance(message, BaseMessage) and isinstance(message.content, str):
+            prefixes.append((message.content, True))
+            continue
+        if not is_string_message(message):
+            break
+        format_values = {variable: values[variable] if variable in static_variables else _SENTINEL
+                         for variable in message.input_variables}
+        text = message.prompt.format(**format_values)
+        is_static = _SENTINEL not in text
+        prefixes.append((text.split(_SENTINEL)[0], is_static))
+        if not is_static:
+            break
+    return prefixes
+
+
+def mark_static_prefix(messages: list[BaseMessage], prefixes: list[tuple[str, bool]]) -> list[BaseMessage]:
+    """
+    Mark the end of the static prefix of the rendered messages with cache_control (the message holding the end of
+    the prefix is split into a static and a dynamic content block)
+    :param messages: The rendered messages
+    :param prefixes: The static prefixes of the messages (see get_static_prefixes)
+    :return: The marked messages
+    """
+    boundary = None
+    for i, (prefix, is_static) in enumerate(prefixes):
+        if i >= len(messages) or not isinstance(messages[i].content, str) or \
+                not messages[i].content.startswith(prefix):
+            break
+        if prefix:
+            boundary = (i, len(prefix))
+        if not is_static:
+            break
+    if boundary is None:
+        return messages
+    i, prefix_length = boundary
+    content = messages[i].content
+    blocks = [{'type': 'text', 'text': content[:prefix_length], 'cache_control': CACHE_CONTROL}]
+    if content[prefix_length:]:
+        blocks.append({'type': 'text', 'text': content[prefix_length:]})
+    messages = list(messages)
+    messages[i] = messages[i].model_copy(update={'content': blocks})
+    return messages
+
+
+class StaticPrefixPrompt(Runnable):
+    """
+    A chat prompt template sending its static part first, and marking its end for the providers that cache the
+    prompt prefixes with cache_control
+    """
+
+    def __init__(self, prompt: ChatPromptTemplate, static_variables: Sequence[str] = (), cache_control: bool = False):
+        """
+        :param prompt: The prompt template
+        :param static_variables: The input variables with the same value in all the calls (e.g. the task description)
+        :param cache_control: If True, the end of the static prefix is marked with cache_control
+        """
+        self.static_variables = list(static_variables)
+        self.prompt = order_static_first(prompt, self.static_variables)
+        self.cache_control = cache_control
+
+    @property
+    def InputType(self) -> Any:
+        return self.prompt.InputType
+
+    @property
+    def OutputType(self) -> Any:
+        return self.prompt.OutputType
+
+    def invoke(self, input: dict, config: Optional[RunnableConfig] = None, **kwargs: Any) -> ChatPromptValue:
+        prompt_value = self.prompt.invoke(input, config)
+        if not self.cache_control:
+            return prompt_value
+        prefixes = get_static_prefixes(self.prompt, input, self.static_variables)
+        return ChatPromptValue(messages=mark_static_prefix(prompt_value.to_messages(), prefixes))
+
+    async def ainvoke(self, input: dict, config: Optional[RunnableConfig] = None, **kwargs: Any) -> ChatPromptValue:
+        # Rendering the prompt is cheap, it does not need a worker thread
+        return self.invoke(input, config, **kwargs)
+
+
+def with_prompt_caching(prompt: ChatPromptTemplate, llm: Any, static_variables: Sequence[str] = ()) -> Runnable:
+    """
+    Wrap the prompt of a chain according to the prompt caching mode of its llm
+    :param prompt: The prompt template
+    :param llm: The llm of the chain
+    :param static_variables: The input variables with the same value in all the calls
+    :return: The prompt, unchanged if the prompt caching of the llm is disabled
+    """
+    mode = get_prompt_caching(llm)
+    if mode is None or not isinstance(prompt, ChatPromptTemplate):
+        return prompt
+    return StaticPrefixPrompt(prompt, static_variables, cache_control=mode == 'cache_control')
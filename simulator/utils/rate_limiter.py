@@ -0,0 +1,203 @@
+import asyncio
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Optional
+from langchain_core.messages import BaseMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from simulator.utils.logger_config import get_logger, ConsoleColor
+
+# Process-wide limiters, keyed by (provider, model)
+_RATE_LIMITERS = {}
+_REGISTRY_LOCK = threading.Lock()
+
+# The estimated tokens of the current request, charged by the chat model rate limiter hook (see rate_limit_step)
+_request_tokens: ContextVar[Optional[int]] = ContextVar('rate_limit_request_tokens', default=None)
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket that refills continuously at `per_minute` units per minute.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60  # per second
+        self.available = self.capacity
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_consume(self, amount: float) -> float:
+        """
+        Try to consume amount units from the bucket
+        :param amount: The amount to consume
+        :return: 0 if the amount was consumed, otherwise the number of seconds to wait before retrying
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.last_update) * self.rate)
+            self.last_update = now
+            # A single request larger than the bucket is admitted once the bucket is full
+            if self.available >= amount or self.available >= self.capacity:
+                self.available -= amount
+                return 0
+            return (min(amount, self.capacity) - self.available) / self.rate
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """
+    A rate limiter enforcing requests-per-minute and tokens-per-minute budgets.
+    Both budgets are enforced by the chat model itself, through the langchain `rate_limiter` hook, which is only
+    called on a response cache miss. The tokens budget is charged with an estimate of the request tokens, set by the
+    rate limit step wrapping the llm runnable (see rate_limit_step).
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 output_tokens_estimate: int = 256, check_every_n_seconds: float = 0.1):
+        """
+        :param requests_per_minute: The maximal number of requests per minute (None for unlimited)
+        :param tokens_per_minute: The maximal number of tokens per minute (None for unlimited)
+        :param output_tokens_estimate: The number of output tokens added to the pre-flight estimate of each request
+        :param check_every_n_seconds: The maximal sleep time between two attempts
+        """
+        self.limits = {'requests_per_minute': requests_per_minute, 'tokens_per_minute': tokens_per_minute,
+                       'output_tokens_estimate': output_tokens_estimate}
+        self.requests_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.output_tokens_estimate = output_tokens_estimate
+        self.check_every_n_seconds = check_every_n_seconds
+
+    def _wait_time(self, bucket: Optional[TokenBucket], amount: float) -> float:
+        if bucket is None:
+            return 0
+        return bucket.try_consume(amount)
+
+    def _acquire(self, bucket: Optional[TokenBucket], amount: float, blocking: bool) -> bool:
+        while True:
+            wait_time = self._wait_time(bucket, amount)
+            if wait_time == 0:
+                return True
+            if not blocking:
+                return False
+            time.sleep(min(wait_time, self.check_every_n_seconds))
+
+    async def _aacquire(self, bucket: Optional[TokenBucket], amount: float, blocking: bool) -> bool:
+        while True:
+            wait_time = self._wait_time(bucket, amount)
+            if wait_time == 0:
+                return True
+            if not blocking:
+                return False
+            await asyncio.sleep(min(wait_time, self.check_every_n_seconds))
+
+    @staticmethod
+    def _pop_request_tokens() -> Optional[int]:
+        # The estimate is charged once, the nested llm calls of the request are not charged again
+        num_tokens = _request_tokens.get()
+        if num_tokens is not None:
+            _request_tokens.set(None)
+        return num_tokens
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        if not self._acquire(self.requests_bucket, 1, blocking):
+            return False
+        num_tokens = self._pop_request_tokens()
+        return num_tokens is None or self.acquire_tokens(num_tokens, blocking)
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        if not await self._aacquire(self.requests_bucket, 1, blocking):
+            return False
+        num_tokens = self._pop_request_tokens()
+        return num_tokens is None or await self.aacquire_tokens(num_tokens, blocking)
+
+    def acquire_tokens(self, num_tokens: int, blocking: bool = True) -> bool:
+        return self._acquire(self.tokens_bucket, num_tokens + self.output_tokens_estimate, blocking)
+
+    async def aacquire_tokens(self, num_tokens: int, blocking: bool = True) -> bool:
+        return await self._aacquire(self.tokens_bucket, num_tokens + self.output_tokens_estimate, blocking)
+
+
+def get_rate_limiter(config: dict) -> Optional[TokenBucketRateLimiter]:
+    """
+    Get the process-wide rate limiter of the provider and model of an llm config block.
+    A single quota applies per provider and model: the first rate_limit block of a model sets it, and the different
+    limits set for the same model in the other stages are ignored (with a warning).
+    :param config: The llm config, the limits are taken from config['rate_limit']
+    :return: The shared rate limiter, None if the config has no rate limit
+    """
+    rate_limit = config.get('rate_limit', None)
+    if not rate_limit:
+        return None
+    key = (config['type'].lower(), config.get('name', ''))
+    limits = {'requests_per_minute': rate_limit.get('requests_per_minute', None),
+              'tokens_per_minute': rate_limit.get('tokens_per_minute', None),
+              'output_tokens_estimate': rate_limit.get('output_tokens_estimate', 256)}
+    with _REGISTRY_LOCK:
+        if key not in _RATE_LIMITERS:
+            _RATE_LIMITERS[key] = TokenBucketRateLimiter(**limits)
+        elif _RATE_LIMITERS[key].limits != limits:
+            get_logger().warning(f"{ConsoleColor.YELLOW}The rate limit {limits} of {key[0]}/{key[1]} differs from "
+                                 f"the rate limit {_RATE_LIMITERS[key].limits} already set for this model, a single "
+                                 f"quota applies per model, the first one is kept{ConsoleColor.RESET}")
+        return _RATE_LIMITERS[key]
+
+
+def estimate_tokens(llm_input: Any) -> int:
+    """
+    A cheap estimate of the number of tokens of an llm input (~4 characters per token)
+    :param llm_input: A prompt value, a list of messages or a string
+    :return: The estimated number of tokens
+    """
+    if isinstance(llm_input, PromptValue):
+        llm_input = llm_input.to_messages()
+    if isinstance(llm_input, str):
+        return len(llm_input) // 4 + 1
+    num_tokens = 0
+    for message in llm_input:
+        content = message.content if isinstance(message, BaseMessage) else message
+        num_tokens += len(str(content)) // 4 + 4
+        for tool_call in getattr(message, 'tool_calls', []) or []:
+            num_tokens += len(str(tool_call.get('args', ''))) // 4 + 4
+    return num_tokens
+
+
+def rate_limit_step(runnable: Any) -> RunnableLambda:
+    """
+    Wrap an llm runnable so its request is charged with the estimated tokens of its input.
+    The estimate is only set here, it is charged by the chat model rate limiter after the response cache lookup, so the
+    cache hits are not throttled.
+    :param runnable: The runnable built on top of the rate limited chat model
+    :return: The wrapping runnable
+    """
+
+    def charge_tokens(llm_input, config: RunnableConfig):
+        token = _request_tokens.set(estimate_tokens(llm_input))
+        try:
+            return runnable.invoke(llm_input, config)
+        finally:
+            _request_tokens.reset(token)
+
+    async def acharge_tokens(llm_input, config: RunnableConfig):
+        token = _request_tokens.set(estimate_tokens(llm_input))
+        try:
+            return await runnable.ainvoke(llm_input, config)
+        finally:
+            _request_tokens.reset(token)
+
+    return RunnableLambda(charge_tokens, afunc=acharge_tokens, name='rate_limit')
+
+
+def with_rate_limit(llm: Any, runnable: Any = None) -> Any:
+    """
+    Charge the estimated tokens of the requests of an llm runnable if the chat model has a tokens budget
+    :param llm: The chat model
+    :param runnable: The runnable built on top of the chat model (default: the chat model itself)
+    :return: The rate limited runnable
+    """
+    runnable = runnable if runnable is not None else llm
+    rate_limiter = getattr(llm, 'rate_limiter', None)
+    if not isinstance(rate_limiter, TokenBucketRateLimiter) or rate_limiter.tokens_bucket is None:
+        return runnable
+    return rate_limit_step(runnable)
@@ -0,0 +1,123 @@
+import asyncio
+import atexit
+import os
+import threading
+from typing import Any, AsyncIterator, Coroutine, Iterator, Optional
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+class SimulatorRuntime:
+    """
+    A long-lived asyncio event loop running in a dedicated thread, with a synchronous facade.
+    All the batches of the simulator run on the same loop, so the clients bound to it (HTTP connection pools,
+    TLS sessions) are reused across all the stages instead of being torn down with a loop per batch.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run_loop, name='simulator-runtime', daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _check_thread(self):
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("The simulator runtime can't be called from its own event loop, await the coroutine "
+                               "instead")
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """
+        Run a coroutine on the runtime loop and wait for its result
+        :param coro: The coroutine
+        :param timeout: The maximal waiting time (in seconds)
+        :return: The coroutine result
+        """
+        self._check_thread()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            # Interrupted (e.g. KeyboardInterrupt), do not leave the coroutine running in the background
+            future.cancel()
+            raise
+
+    def stream(self, agen: AsyncIterator) -> Iterator:
+        """
+        Iterate over an async generator running on the runtime loop
+        :param agen: The async generator
+        :return: A synchronous iterator over the generated items
+        """
+        self._check_thread()
+
+        async def anext_item():
+            return await agen.__anext__()
+
+        async def aclose():
+            await agen.aclose()
+
+        try:
+            while True:
+                try:
+                    yield self.run(anext_item())
+                except StopAsyncIteration:
+                    break
+        finally:
+            self.run(aclose())
+
+    def shutdown(self):
+        """
+        Cancel the remaining tasks and stop the loop
+        """
+        if self.loop.is_closed() or not self.thread.is_alive():
+            return
+
+        async def cancel_tasks():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.loop.shutdown_asyncgens()
+
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), self.loop).result(timeout=10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=10)
+        self.loop.close()
+
+
+def get_runtime() -> SimulatorRuntime:
+    """
+    Get the process-wide simulator runtime, starting it on first use
+    """
+    global _runtime
+    with _runtime_lock:
+        # A forked process does not inherit the runtime thread
+        if _runtime is None or _runtime.pid != os.getpid():
+            _runtime = SimulatorRuntime()
+        return _runtime
+
+
+def is_runtime_started() -> bool:
+    """
+    Whether the process-wide simulator runtime is running
+    """
+    with _runtime_lock:
+        return _runtime is not None and _runtime.pid == os.getpid()
+
+
+def shutdown_runtime():
+    """
+    Shutdown the process-wide simulator runtime (if started)
+    """
+    global _runtime
+    with _runtime_lock:
+        if _runtime is not None and _runtime.pid == os.getpid():
+            _runtime.shutdown()
+        _runtime = None
+
+
+atexit.register(shutdown_runtime)
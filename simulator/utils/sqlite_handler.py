@@ -1,63 +1,95 @@
+import atexit
+import json
+import queue
 import sqlite3
 import threading
-from typing import Optional
+from typing import Any, Optional
 import time
 from simulator.healthcare_analytics import ExceptionEvent, track_event
+from simulator.utils.logger_config import get_logger, ConsoleColor
+
+# The tables of the memory: {table name: (columns definition, inserted columns)}. The rows are ordered by their seq
+# (an alias of the sqlite rowid), which is assigned in insertion order.
+TABLES = {
+    'Dialog': ('''
+                    thread_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    time INTEGER NOT NULL,
+                    seq INTEGER PRIMARY KEY
+               ''', ('thread_id', 'role', 'message', 'time')),
+    'Thoughts': ('''
+                    thread_id TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    time INTEGER NOT NULL,
+                    seq INTEGER PRIMARY KEY
+                 ''', ('thread_id', 'message', 'time')),
+    'Tools': ('''
+                    thread_id TEXT NOT NULL,
+                    tool_name TEXT NOT NULL,
+                    input TEXT,
+                    output TEXT,
+                    time INTEGER NOT NULL,
+                    seq INTEGER PRIMARY KEY
+              ''', ('thread_id', 'tool_name', 'input', 'output', 'time')),
+}
+
+
+def to_text(value: Any) -> Optional[str]:
+    """
+    The text of a memory value, the non-string values (e.g. a list of message content blocks) are serialized to json
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, default=str)
+
 
 class SqliteSaver:
     """A checkpoint saver that stores checkpoints in a SQLite database.
     This class is a inspired by:
     https://github.com/langchain-ai/langgraph/blob/a73f9affab7d7fb1cca477f055a4d503563332d8/libs/checkpoint-sqlite/langgraph/checkpoint/sqlite/__init__.py
+    The inserts are write-behind: they are queued, and a writer thread inserts them in batches with a group commit,
+    so the dialogs never wait for the disk.
     """
 
-
-    def __init__(self, db_path: str):
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+    def __init__(self, db_path: str, commit_interval: float = 0.05, max_batch_size: int = 1000):
+        """
+        :param db_path: The path of the database
+        :param commit_interval: The time (in seconds) the writer collects the queued rows before a commit
+        :param max_batch_size: The maximal number of rows in a commit
+        """
+        self.db_path = db_path
+        self.commit_interval = commit_interval
+        self.max_batch_size = max_batch_size
+        self.conn = self.connect()
         self.lock = threading.Lock()
         self.cursor = self.conn.cursor()
         self.init_tables()
-
+        self.rows = queue.Queue()
+        self.writer = threading.Thread(target=self._write_rows, daemon=True)
+        self.writer.start()
+        # The queued rows are written when the process exits
+        atexit.register(self.exit)
+
+    def connect(self) -> sqlite3.Connection:
+        # The shard processes of an experiment write to the same database, a busy database is retried until timeout
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        # With WAL, synchronous=NORMAL never corrupts the database on a crash, only the last commits may be lost on
+        # a power failure
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
 
     def init_tables(self):
         """
         Creates three tables: Dialog, Thoughts, and Tools in the specified SQLite database.
-
-        Parameters:
-        db_path (str): Path to the SQLite3 database file.
         """
         try:
-            # Dialog table with a 'time' column to store Unix timestamps
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS Dialog (
-                    thread_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    message TEXT NOT NULL,
-                    time INTEGER NOT NULL,
-                    PRIMARY KEY (thread_id, message, time)
-                )
-            ''')
-
-            # Thoughts table with a 'time' column for Unix timestamp
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS Thoughts (
-                    thread_id TEXT NOT NULL,
-                    message TEXT NOT NULL,
-                    time INTEGER NOT NULL,
-                    PRIMARY KEY (thread_id, message, time)
-                )
-            ''')
-
-            # Tools table with a 'time' column for Unix timestamp
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS Tools (
-                    thread_id TEXT NOT NULL,
-                    tool_name TEXT NOT NULL,
-                    input TEXT,
-                    output TEXT,
-                    time INTEGER NOT NULL,
-                    PRIMARY KEY (thread_id, tool_name, time)
-                )
-            ''')
+            for table, (columns, inserted_columns) in TABLES.items():
+                self.cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+                table_columns = [row[1] for row in self.cursor.execute(f'PRAGMA table_info({table})')]
+                if 'seq' not in table_columns:
+                    self.migrate_table(table, columns, inserted_columns)
 
             # Commit the transaction
             self.conn.commit()
@@ -68,61 +100,122 @@ class SqliteSaver:
             track_event(ExceptionEvent(exception_type=type(e).__name__,
                                    error_message=str(e)))
 
+    def migrate_table(self, table: str, columns: str, inserted_columns: tuple):
+        """
+        Migrate a table of a previous memory version (keyed by a millisecond time) to the seq ordering key
+        """
+        columns_list = ', '.join(inserted_columns)
+        self.cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+        self.cursor.execute(f'CREATE TABLE {table} ({columns})')
+        self.cursor.execute(f'INSERT INTO {table} ({columns_list}) '
+                            f'SELECT {columns_list} FROM {table}_old ORDER BY time, rowid')
+        self.cursor.execute(f'DROP TABLE {table}_old')
+
+    def _write_rows(self):
+        """
+        The writer thread: inserts the queued rows in batches (one executemany per table), with a commit per batch
+        """
+        conn = self.connect()
+        while True:
+            batch = [self.rows.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch_size and batch[-1] is not None and \
+                    not isinstance(batch[-1], threading.Event):
+                try:
+                    batch.append(self.rows.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            rows = {}
+            for item in batch:
+                if item is not None and not isinstance(item, threading.Event):
+                    rows.setdefault(item[0], []).append(item[1])
+            try:
+                self._insert_rows(conn, rows)
+            except sqlite3.Error:
+                # A failing row does not drop the whole batch, the rows are inserted one by one and only the failing
+                # rows are lost
+                conn.rollback()
+                try:
+                    self._insert_rows(conn, rows, row_by_row=True)
+                except sqlite3.Error as e:
+                    conn.rollback()
+                    error_message = f"Failed to commit the memory rows: {e}"
+                    get_logger().error(f"{ConsoleColor.RED}{error_message}{ConsoleColor.RESET}")
+                    track_event(ExceptionEvent(exception_type=type(e).__name__, error_message=error_message))
+            # The flush and the exit requests are answered after the previous rows are committed
+            if isinstance(batch[-1], threading.Event):
+                batch[-1].set()
+            elif batch[-1] is None:
+                conn.close()
+                return
+
+    @staticmethod
+    def _insert_rows(conn: sqlite3.Connection, rows: dict, row_by_row: bool = False):
+        """
+        Insert the rows of a batch and commit them
+        :param conn: The writer connection
+        :param rows: The rows by table
+        :param row_by_row: If True, the rows are inserted one by one and the failing rows are skipped and reported
+        """
+        # The rows of a table keep their queue order, so the seq of the rows of a dialog is monotonic
+        for table, table_rows in rows.items():
+            columns = TABLES[table][1]
+            query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            if not row_by_row:
+                conn.executemany(query, table_rows)
+                continue
+            for row in table_rows:
+                try:
+                    conn.execute(query, row)
+                except sqlite3.Error as e:
+                    error_message = f"Failed to insert a row into the memory table {table}: {e}"
+                    get_logger().error(f"{ConsoleColor.RED}{error_message}{ConsoleColor.RESET}")
+                    track_event(ExceptionEvent(exception_type=type(e).__name__, error_message=error_message))
+        conn.commit()
+
+    def flush(self, timeout: Optional[float] = None):
+        """
+        Wait until all the queued rows are committed
+        :param timeout: The maximal waiting time (in seconds), None to wait until the rows are committed
+        """
+        if not self.writer.is_alive():
+            return
+        done = threading.Event()
+        self.rows.put(done)
+        done.wait(timeout)
+
     def exit(self):
-        # Commit any changes and close the connection when exiting the context
-        if self.conn:
-            self.conn.commit()
-            self.cursor.close()
-            self.conn.close()
+        # Write the queued rows and close the connections
+        with self.lock:
+            if self.writer.is_alive():
+                self.rows.put(None)
+                self.writer.join()
+            if self.conn:
+                self.conn.commit()
+                self.cursor.close()
+                self.conn.close()
+                self.conn = None
+        atexit.unregister(self.exit)
 
     def insert_dialog(self, thread_id: str, role: str, message: str):
-        try:
-            with self.lock:
-                current_time = int(time.time() * 1000) # in milliseconds
-                self.cursor.execute(
-                    "INSERT INTO Dialog (thread_id, role, message, time) VALUES (?, ?, ?, ?)",
-                    (thread_id, role, message, current_time)
-                )
-                self.conn.commit()
-        except sqlite3.Error as e:
-            print(f"An error occurred while inserting into Dialog: {e}")
-            track_event(ExceptionEvent(exception_type=type(e).__name__,
-                                   error_message=str(e)))
-            
+        current_time = int(time.time() * 1000)  # in milliseconds
+        self.rows.put(('Dialog', (thread_id, role, to_text(message) or '', current_time)))
+
     def insert_thought(self, thread_id: str, message: str):
-        try:
-            with self.lock:
-                current_time = int(time.time() * 1000) # in milliseconds
-                self.cursor.execute(
-                    "INSERT INTO Thoughts (thread_id, message, time) VALUES (?, ?, ?)",
-                    (thread_id, message, current_time)
-                )
-                self.conn.commit()
-        except sqlite3.Error as e:
-            print(f"An error occurred while inserting into Thoughts: {e}")
-            track_event(ExceptionEvent(exception_type=type(e).__name__,
-                                   error_message=str(e)))
+        current_time = int(time.time() * 1000)  # in milliseconds
+        self.rows.put(('Thoughts', (thread_id, to_text(message) or '', current_time)))
 
     def insert_tool(self, thread_id: str, tool_name: str, input: Optional[str], output: Optional[str]):
-        try:
-            with self.lock:
-                current_time = int(time.time() * 1000) # in milliseconds
-                self.cursor.execute(
-                    "INSERT INTO Tools (thread_id, tool_name, input, output, time) VALUES (?, ?, ?, ?, ?)",
-                    (thread_id, tool_name, input, output, current_time)
-                )
-                self.conn.commit()
-        except sqlite3.Error as e:
-            print(f"An error occurred while inserting into Tools: {e}")
-            track_event(ExceptionEvent(exception_type=type(e).__name__,
-                                   error_message=str(e)))
-            
-
+        current_time = int(time.time() * 1000)  # in milliseconds
+        self.rows.put(('Tools', (thread_id, tool_name, to_text(input), to_text(output), current_time)))
 
     def read_dialog(self, thread_id: str):
         try:
-            self.cursor.execute("SELECT thread_id, role, message FROM Dialog WHERE thread_id = ?", (thread_id,))
-            rows = self.cursor.fetchall()
+            self.flush()
+            with self.lock:
+                self.cursor.execute("SELECT thread_id, role, message FROM Dialog WHERE thread_id = ? ORDER BY seq",
+                                    (thread_id,))
+                rows = self.cursor.fetchall()
             return rows if rows else None  # Return None if no rows are found
         except sqlite3.Error as e:
             print(f"An error occurred while reading from Dialog: {e}")
@@ -132,8 +225,11 @@ class SqliteSaver:
 
     def read_thought(self, thread_id: str):
         try:
-            self.cursor.execute("SELECT thread_id, message FROM Thoughts WHERE thread_id = ?", (thread_id,))
-            rows = self.cursor.fetchall()
+            self.flush()
+            with self.lock:
+                self.cursor.execute("SELECT thread_id, message FROM Thoughts WHERE thread_id = ? ORDER BY seq",
+                                    (thread_id,))
+                rows = self.cursor.fetchall()
             return rows if rows else None  # Return None if no rows are found
         except sqlite3.Error as e:
             print(f"An error occurred while reading from Thoughts: {e}")
@@ -143,8 +239,10 @@ class SqliteSaver:
 
     def read_tool(self, thread_id: str):
         try:
-            self.cursor.execute("SELECT * FROM Tools WHERE thread_id = ?", (thread_id,))
-            rows = self.cursor.fetchall()
+            self.flush()
+            with self.lock:
+                self.cursor.execute("SELECT * FROM Tools WHERE thread_id = ? ORDER BY seq", (thread_id,))
+                rows = self.cursor.fetchall()
             return rows if rows else None  # Return None if no rows are found
         except sqlite3.Error as e:
             print(f"An error occurred while reading from Tools: {e}")
@@ -0,0 +1,289 @@
+import json
+import re
+import threading
+from typing import Any, Optional
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from pydantic import BaseModel, ValidationError
+from simulator.healthcare_analytics import ExceptionEvent, track_event
+
+# The structured output parsing paths of all the schemas: {schema name: {path: count}}, the paths are 'parsed' (valid
+# output), 'repaired' (repaired locally), 'reprompted' (fixed by a re-prompt) and 'failed'
+STRUCTURED_OUTPUT_STATS = {}
+_STATS_LOCK = threading.Lock()
+
+# The maximal number of local coercion rounds (each round fixes all the current validation errors)
+MAX_COERCION_ROUNDS = 5
+
+REPROMPT_TEMPLATE = ("The following output does not match the required JSON schema. Return only the fixed JSON "
+                     "object, keeping the original content.\n\n## Schema:\n{schema}\n\n## Validation error:\n{error}")
+
+_CODE_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_QUOTED = re.compile(r"'([^']*)'")
+
+
+def record_path(schema_name: str, path: str):
+    with _STATS_LOCK:
+        stats = STRUCTURED_OUTPUT_STATS.setdefault(schema_name, {})
+        stats[path] = stats.get(path, 0) + 1
+
+
+def complete_json(text: str) -> str:
+    """
+    Complete a truncated JSON text: close the open string, drop the dangling key or comma, and close the open
+    objects and lists
+    """
+    stack = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip()
+    # A dangling comma, or an object key without its value
+    text = re.sub(r',\s*$', '', text)
+    text = re.sub(r',?\s*"[^"]*"\s*:\s*$', '', text)
+    return text + ''.join(reversed(stack))
+
+
+def repair_json(text: str) -> Optional[Any]:
+    """
+    Extract a JSON value from a model text: the content of a code fence, the first JSON object or list followed by
+    prose, or a truncated JSON
+    :return: The parsed value, None if no JSON value could be recovered
+    """
+    fence = _CODE_FENCE.search(text)
+    if fence is not None:
+        text = fence.group(1)
+    starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+    if not starts:
+        return None
+    text = text[min(starts):]
+    decoder = json.JSONDecoder()
+    try:
+        # Ignores the trailing prose
+        return decoder.raw_decode(text)[0]
+    except json.JSONDecodeError:
+        pass
+    try:
+        return decoder.raw_decode(complete_json(text))[0]
+    except json.JSONDecodeError:
+        return None
+
+
+def _get_parent(data: Any, loc: tuple) -> tuple[Any, Any]:
+    """
+    :return: The container of the value at loc and the value key, (None, None) if the location does not exist
+    """
+    parent = data
+    for key in loc[:-1]:
+        try:
+            parent = parent[key]
+        except (KeyError, IndexError, TypeError):
+            return None, None
+    return parent, loc[-1]
+
+
+def _fix_value(error: dict) -> tuple[bool, Any]:
+    """
+    Fix the value of a validation error
+    :return: (fixed, the fixed value)
+    """
+    value = error.get('input', None)
+    error_type = error['type']
+    if error_type in ('enum', 'literal_error') and isinstance(value, str):
+        for expected in _QUOTED.findall(str(error.get('ctx', {}).get('expected', ''))):
+            if expected.strip().lower() == value.strip().lower():
+                return True, expected
+    elif error_type in ('int_from_float', 'int_parsing'):
+        try:
+            return True, int(round(float(value)))
+        except (TypeError, ValueError):
+            pass
+    elif error_type == 'list_type' and isinstance(value, (str, dict)):
+        return True, [value]
+    elif error_type == 'string_type':
+        if isinstance(value, list):
+            return True, '\n'.join(str(item) for item in value)
+        if isinstance(value, (int, float)):
+            return True, str(value)
+    elif error_type in ('model_type', 'dict_type', 'model_attributes_type') and isinstance(value, str):
+        repaired = repair_json(value)
+        if isinstance(repaired, dict):
+            return True, repaired
+    return False, None
+
+
+def coerce_to_schema(schema: type[BaseModel], data: Any) -> BaseModel:
+    """
+    Validate the data against a pydantic schema, with tolerant coercion of the common model mistakes (a wrapping
+    object, the case of an enum value, a float instead of an int, a single value instead of a list...)
+    :raise ValidationError: If the data cannot be coerced
+    """
+    if isinstance(data, list) and len(data) == 1 and isinstance(data[0], dict):
+        data = data[0]
+    if isinstance(data, dict) and len(data) == 1 and not set(data) & set(schema.model_fields):
+        # The answer is wrapped in an object (e.g. {"Rank": {...}} or {"properties": {...}})
+        inner = next(iter(data.values()))
+        if isinstance(inner, dict):
+            data = inner
+    for _ in range(MAX_COERCION_ROUNDS):
+        try:
+            return schema.model_validate(data)
+        except ValidationError as e:
+            errors = e.errors()
+            fixed_any = False
+            for error in errors:
+                parent, key = _get_parent(data, tuple(error['loc']))
+                if parent is None:
+                    continue
+                if error['type'] == 'extra_forbidden':
+                    parent.pop(key, None)
+                    fixed_any = True
+                    continue
+                fixed, value = _fix_value(error)
+                if fixed:
+                    parent[key] = value
+                    fixed_any = True
+            if not fixed_any:
+                raise
+    return schema.model_validate(data)
+
+
+def get_raw_candidates(raw: Any) -> list[Any]:
+    """
+    The candidate answers of a raw model message: the tool calls arguments, the invalid tool calls arguments and
+    the text content
+    """
+    candidates = [tool_call['args'] for tool_call in getattr(raw, 'tool_calls', None) or []]
+    candidates += [tool_call['args'] for tool_call in getattr(raw, 'invalid_tool_calls', None) or []
+                   if tool_call.get('args')]
+    content = getattr(raw, 'content', '')
+    if isinstance(content, list):
+        content = ''.join(block.get('text', '') if isinstance(block, dict) else str(block) for block in content)
+    if content:
+        candidates.append(content)
+    return candidates
+
+
+def get_raw_text(raw: Any) -> str:
+    return '\n'.join(candidate if isinstance(candidate, str) else json.dumps(candidate)
+                     for candidate in get_raw_candidates(raw))
+
+
+class RepairingStructuredOutput(Runnable):
+    """
+    A structured output runnable repairing the outputs that fail to parse: the output is first repaired locally
+    (code fence extraction, JSON completion and tolerant coercion against the schema), and only then fixed by a
+    minimal re-prompt of the model
+    """
+
+    def __init__(self, llm: Any, schema: type[BaseModel], reprompt: bool = True):
+        """
+        :param llm: The chat model
+        :param schema: The pydantic schema of the output
+        :param reprompt: If True, the outputs that cannot be repaired locally are fixed by a re-prompt
+        """
+        self.llm = llm
+        self.schema = schema
+        self.runnable = llm.with_structured_output(schema, include_raw=True)
+        self.reprompt = reprompt
+
+    @property
+    def InputType(self) -> Any:
+        return self.runnable.InputType
+
+    @property
+    def OutputType(self) -> Any:
+        return self.schema
+
+    def repair(self, output: dict) -> tuple[Optional[BaseModel], Optional[str]]:
+        """
+        :return: The parsed output (None if not repaired) and the parsing path
+        """
+        if output.get('parsed', None) is not None and output.get('parsing_error', None) is None:
+            return output['parsed'], 'parsed'
+        for candidate in get_raw_candidates(output.get('raw', None)):
+            data = repair_json(candidate) if isinstance(candidate, str) else candidate
+            if data is None:
+                continue
+            try:
+                return coerce_to_schema(self.schema, data), 'repaired'
+            except ValidationError:
+                continue
+        return None, None
+
+    def get_reprompt_messages(self, output: dict) -> list:
+        error = output.get('parsing_error', None) or 'The output is not a valid JSON object'
+        schema = json.dumps(self.schema.model_json_schema())
+        return [SystemMessage(content=REPROMPT_TEMPLATE.format(schema=schema, error=str(error)[:2000])),
+                HumanMessage(content=get_raw_text(output.get('raw', None)) or '(empty output)')]
+
+    def get_error(self, output: dict) -> Exception:
+        error = output.get('parsing_error', None)
+        if isinstance(error, Exception):
+            return error
+        return ValueError(f"Failed to parse the {self.schema.__name__} output: {error or 'no structured output'}")
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        output = self.runnable.invoke(input, config, **kwargs)
+        parsed, path = self.repair(output)
+        if parsed is None and self.reprompt:
+            try:
+                parsed = self.llm.with_structured_output(self.schema).invoke(self.get_reprompt_messages(output),
+                                                                              config)
+                path = 'reprompted' if parsed is not None else None
+            except Exception as e:
+                track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                           error_message=f"The structured output re-prompt failed: {e}"))
+        return self.finish(output, parsed, path)
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        output = await self.runnable.ainvoke(input, config, **kwargs)
+        parsed, path = self.repair(output)
+        if parsed is None and self.reprompt:
+            try:
+                parsed = await self.llm.with_structured_output(self.schema).ainvoke(
+                    self.get_reprompt_messages(output), config)
+                path = 'reprompted' if parsed is not None else None
+            except Exception as e:
+                track_event(ExceptionEvent(exception_type=type(e).__name__,
+                                           error_message=f"The structured output re-prompt failed: {e}"))
+        return self.finish(output, parsed, path)
+
+    def finish(self, output: dict, parsed: Optional[BaseModel], path: Optional[str]) -> BaseModel:
+        record_path(self.schema.__name__, path if parsed is not None else 'failed')
+        if parsed is None:
+            raise self.get_error(output)
+        return parsed
+
+
+def with_structured_output_repair(llm: Any, schema: Any, reprompt: bool = True) -> Runnable:
+    """
+    The structured output runnable of an llm, repairing the outputs that fail to parse when the llm returns its raw
+    output (include_raw) and the schema is a pydantic model
+    :param llm: The chat model
+    :param schema: The output schema
+    :param reprompt: If True, the outputs that cannot be repaired locally are fixed by a re-prompt
+    :return: The structured output runnable
+    """
+    if not isinstance(schema, type) or not issubclass(schema, BaseModel):
+        return llm.with_structured_output(schema)
+    try:
+        return RepairingStructuredOutput(llm, schema, reprompt=reprompt)
+    except NotImplementedError:
+        # The llm does not return its raw output (e.g. a cascade, which escalates the invalid outputs instead)
+        return llm.with_structured_output(schema)
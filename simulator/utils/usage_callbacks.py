@@ -0,0 +1,134 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Optional
+from langchain_community.callbacks.openai_info import OpenAICallbackHandler
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.tracers.context import register_configure_hook
+
+
+def get_cache_usage(message: Any) -> tuple[int, int]:
+    """
+    :return: The (cache read, cache creation) input tokens of a response message
+    """
+    usage_metadata = getattr(message, 'usage_metadata', None) or {}
+    details = usage_metadata.get('input_token_details', None) or {}
+    return details.get('cache_read', 0) or 0, details.get('cache_creation', 0) or 0
+
+
+class CacheUsageMixin:
+    """
+    Counts the input tokens served from (and written to) the provider prompt cache
+    """
+    cached_tokens: int = 0
+    cache_creation_tokens: int = 0
+
+    def count_cache_usage(self, response: LLMResult):
+        cached_tokens = cache_creation_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                cache_read, cache_creation = get_cache_usage(getattr(generation, 'message', None))
+                cached_tokens += cache_read
+                cache_creation_tokens += cache_creation
+        with self._lock:
+            self.cached_tokens += cached_tokens
+            self.cache_creation_tokens += cache_creation_tokens
+
+
+class UsageCallbackHandler(CacheUsageMixin, BaseCallbackHandler):
+    """
+    Counts the tokens of the providers without a cost callback (their cost is not computed)
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.total_cost = 0
+        self._lock = threading.Lock()
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage_metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None) or {}
+                prompt_tokens += usage_metadata.get('input_tokens', 0)
+                completion_tokens += usage_metadata.get('output_tokens', 0)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.total_tokens += prompt_tokens + completion_tokens
+        self.count_cache_usage(response)
+
+    def __copy__(self) -> 'UsageCallbackHandler':
+        return self
+
+    def __deepcopy__(self, memo: Any) -> 'UsageCallbackHandler':
+        return self
+
+
+usage_callback_var: ContextVar[Optional[UsageCallbackHandler]] = ContextVar('usage_callback', default=None)
+register_configure_hook(usage_callback_var, True)
+
+
+@contextmanager
+def get_usage_callback():
+    """
+    Get the usage callback handler (tokens and prompt cache usage) in a context manager
+    """
+    cb = UsageCallbackHandler()
+    token = usage_callback_var.set(cb)
+    try:
+        yield cb
+    finally:
+        usage_callback_var.reset(token)
+
+
+class OpenAICacheCallbackHandler(CacheUsageMixin, OpenAICallbackHandler):
+    """
+    The openai callback handler (cost and tokens), also counting the prompt cache usage
+    """
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        super().on_llm_end(response, **kwargs)
+        self.count_cache_usage(response)
+
+
+openai_cache_callback_var: ContextVar[Optional[OpenAICacheCallbackHandler]] = ContextVar('openai_cache_callback',
+                                                                                         default=None)
+register_configure_hook(openai_cache_callback_var, True)
+
+
+@contextmanager
+def get_openai_cache_callback():
+    """
+    Get the openai callback handler, also counting the prompt cache usage, in a context manager
+    """
+    cb = OpenAICacheCallbackHandler()
+    token = openai_cache_callback_var.set(cb)
+    try:
+        yield cb
+    finally:
+        openai_cache_callback_var.reset(token)
+
+
+def add_usage(handlers: list, input_tokens: int, output_tokens: int, cost: float = 0):
+    """
+    Add a usage that was not reported by a response (e.g. a cancelled request) to the usage callback handlers
+    :param handlers: The callback handlers, the ones not counting the usage are skipped
+    :param input_tokens: The input tokens
+    :param output_tokens: The output tokens
+    :param cost: The cost
+    """
+    counted = set()
+    for handler in handlers:
+        if not hasattr(handler, 'total_tokens') or id(handler) in counted:
+            continue
+        counted.add(id(handler))
+        with handler._lock:
+            handler.prompt_tokens += input_tokens
+            handler.completion_tokens += output_tokens
+            handler.total_tokens += input_tokens + output_tokens
+            handler.total_cost += cost
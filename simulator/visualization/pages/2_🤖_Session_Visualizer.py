@@ -82,7 +82,7 @@ def on_select_thread():
 
     try:
         with col2:
-            cursor.execute("SELECT * FROM Dialog WHERE thread_id = ? ORDER BY time ASC", (thread_id,))
+            cursor.execute("SELECT * FROM Dialog WHERE thread_id = ? ORDER BY rowid ASC", (thread_id,))
             rows = cursor.fetchall()
             for i,row in enumerate(rows):
                 if row[1] == 'AI':
@@ -93,7 +93,7 @@ def on_select_thread():
                         continue
                     st.chat_message('User').write(row[2])
         with col1:
-            cursor.execute("SELECT * FROM Tools WHERE thread_id = ? ORDER BY time ASC", (thread_id,))
+            cursor.execute("SELECT * FROM Tools WHERE thread_id = ? ORDER BY rowid ASC", (thread_id,))
             rows = cursor.fetchall()
             for row in rows:
                 logger_chat.log_message(f"- Invoke function: {row[1]}", 'debug')
@@ -106,7 +106,7 @@ def on_select_thread():
             st.markdown(mk, unsafe_allow_html=True)
 
         with col3:
-            cursor.execute("SELECT * FROM Thoughts WHERE thread_id = ? ORDER BY time ASC", (thread_id,))
+            cursor.execute("SELECT * FROM Thoughts WHERE thread_id = ? ORDER BY rowid ASC", (thread_id,))
             rows = cursor.fetchall()
             for row in rows:
                 if row[1] == '':
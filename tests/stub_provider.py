@@ -0,0 +1,68 @@
+from typing import Any, Optional
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import Field
+
+
+def count_tokens(text: str) -> int:
+    """
+    The stub tokenizer (~4 characters per token)
+    """
+    return len(text) // 4
+
+
+def get_text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    return ''.join(block['text'] for block in content)
+
+
+class StubCachingChatModel(BaseChatModel):
+    """
+    A local chat model simulating a provider that caches the prompt prefixes marked with cache_control.
+    The prefix up to the last marked block is written to the cache on its first request, and read from the cache by
+    the following requests with the same prefix. The usage is reported in the usage metadata, as the providers do.
+    """
+    answer: str = 'ok'
+    cached_prefixes: set = Field(default_factory=set)
+    requests: list = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return 'stub'
+
+    @staticmethod
+    def get_cached_prefix(messages: list[BaseMessage]) -> Optional[str]:
+        """
+        :return: The text of the messages up to the end of the last block marked with cache_control
+        """
+        prefix = None
+        text = ''
+        for message in messages:
+            blocks = message.content if isinstance(message.content, list) else [{'text': message.content}]
+            for block in blocks:
+                text += block['text']
+                if 'cache_control' in block:
+                    prefix = text
+        return prefix
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        self.requests.append(messages)
+        input_tokens = count_tokens(''.join(get_text(message.content) for message in messages))
+        prefix = self.get_cached_prefix(messages)
+        cache_read = cache_creation = 0
+        if prefix is not None and prefix in self.cached_prefixes:
+            cache_read = count_tokens(prefix)
+        elif prefix is not None:
+            cache_creation = count_tokens(prefix)
+            self.cached_prefixes.add(prefix)
+        output_tokens = count_tokens(self.answer)
+        message = AIMessage(content=self.answer,
+                            usage_metadata={'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                                            'total_tokens': input_tokens + output_tokens,
+                                            'input_token_details': {'cache_read': cache_read,
+                                                                    'cache_creation': cache_creation}})
+        return ChatResult(generations=[ChatGeneration(message=message)])
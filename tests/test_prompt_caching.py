@@ -0,0 +1,93 @@
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from simulator.utils.llm_utils import set_llm_chain
+from simulator.utils.prompt_caching import (CACHE_CONTROL, get_static_prefixes, mark_static_prefix,
+                                            order_static_first, set_prompt_caching)
+from simulator.utils.usage_callbacks import get_usage_callback
+from tests.stub_provider import StubCachingChatModel, count_tokens
+
+TASK_DESCRIPTION = 'You are simulating the customers of an airline. ' * 20
+
+
+def get_prompt() -> ChatPromptTemplate:
+    return ChatPromptTemplate.from_messages([
+        ('system', 'The policies to test: {policies}'),
+        ('system', 'Task: {task_description}'),
+        MessagesPlaceholder('messages'),
+    ])
+
+
+def get_stub_llm(llm_type: str = 'anthropic') -> StubCachingChatModel:
+    llm = StubCachingChatModel()
+    set_prompt_caching(llm, {'type': llm_type, 'prompt_caching': True})
+    return llm
+
+
+def test_order_static_first():
+    prompt = order_static_first(get_prompt(), ['task_description'])
+    assert prompt.messages[0].prompt.template == 'Task: {task_description}'
+    assert prompt.messages[1].prompt.template == 'The policies to test: {policies}'
+    assert isinstance(prompt.messages[2], MessagesPlaceholder)
+
+
+def test_order_static_first_without_static_variables():
+    prompt = get_prompt()
+    assert order_static_first(prompt) is prompt
+
+
+def test_get_static_prefixes():
+    prompt = ChatPromptTemplate.from_messages([
+        ('system', 'Task: {task_description}'),
+        ('system', 'Policies: {policies}, be strict'),
+        ('human', '{question}'),
+    ])
+    values = {'task_description': 'T', 'policies': 'P', 'question': 'Q'}
+    assert get_static_prefixes(prompt, values, ['task_description']) == [('Task: T', True), ('Policies: ', False)]
+
+
+def test_mark_static_prefix_boundary():
+    messages = [SystemMessage(content='Task: T'), SystemMessage(content='Policies: P'), HumanMessage(content='Q')]
+    marked = mark_static_prefix(messages, [('Task: T', True), ('Policies: ', False)])
+    assert marked[0].content == 'Task: T'
+    assert marked[1].content == [{'type': 'text', 'text': 'Policies: ', 'cache_control': CACHE_CONTROL},
+                                 {'type': 'text', 'text': 'P'}]
+    assert marked[2] is messages[2]
+    # The messages are not changed when the rendered messages do not start with the static prefix
+    assert mark_static_prefix(messages, [('Other', True)]) is messages
+
+
+def test_chain_marks_the_static_prefix():
+    llm = get_stub_llm()
+    chain = set_llm_chain(llm, prompt=get_prompt(), static_variables=['task_description'])
+    chain.invoke({'task_description': TASK_DESCRIPTION, 'policies': 'P1',
+                  'messages': [HumanMessage(content='Hi')]})
+    messages = llm.requests[-1]
+    # The static message is sent first, the boundary is at the end of the static part of the next message
+    assert messages[0].content == f'Task: {TASK_DESCRIPTION}'
+    assert messages[1].content == [{'type': 'text', 'text': 'The policies to test: ', 'cache_control': CACHE_CONTROL},
+                                   {'type': 'text', 'text': 'P1'}]
+    assert messages[2].content == 'Hi'
+
+
+def test_prefix_mode_only_reorders():
+    llm = get_stub_llm('openai')
+    chain = set_llm_chain(llm, prompt=get_prompt(), static_variables=['task_description'])
+    chain.invoke({'task_description': TASK_DESCRIPTION, 'policies': 'P1', 'messages': []})
+    messages = llm.requests[-1]
+    assert messages[0].content == f'Task: {TASK_DESCRIPTION}'
+    assert StubCachingChatModel.get_cached_prefix(messages) is None
+
+
+def test_cached_tokens_reported():
+    llm = get_stub_llm()
+    chain = set_llm_chain(llm, prompt=get_prompt(), static_variables=['task_description'])
+    prefix_tokens = count_tokens(f'Task: {TASK_DESCRIPTION}The policies to test: ')
+    with get_usage_callback() as callback:
+        chain.invoke({'task_description': TASK_DESCRIPTION, 'policies': 'P1', 'messages': []})
+    assert callback.cached_tokens == 0
+    assert callback.cache_creation_tokens == prefix_tokens
+    with get_usage_callback() as callback:
+        for policies in ('P2', 'P3'):
+            chain.invoke({'task_description': TASK_DESCRIPTION, 'policies': policies, 'messages': []})
+    assert callback.cached_tokens == 2 * prefix_tokens
+    assert callback.cache_creation_tokens == 0